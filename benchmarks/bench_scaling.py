@@ -0,0 +1,177 @@
+"""Scaling benchmarks: time and peak memory of the core steps over input size.
+
+    python benchmarks/bench_scaling.py [--sizes 10 100 1000] [--only pools demux] [-o results.json] [--compare old.json]
+
+Each benchmark runs on synthetic inputs from synthetic.py. Timings are the
+best of --repeat runs after a warm-up; peak memory is the tracemalloc peak of one extra run.
+The scaling exponent is the slope of log(time) against log(size).
+"""
+import argparse
+import contextlib
+import sys
+import datetime
+import importlib.metadata
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import synthetic
+
+os.environ["MISEQ_TOOLS_NO_PLOTS"] = "1"
+
+from miseq_tools import utils
+from miseq_tools.pooling import _pools
+from miseq_tools.samplesheet import check_indexes
+from miseq_tools.quant_kapa import _kapaquant
+from miseq_tools.demux_stats import demux, read_demux_counts
+
+# each setup takes (size, tmpdir) and returns the function to time
+
+def setup_pools(n, tmpdir, solver="fast"):
+    # read targets within 20x of each other, which the greedy solver can pool at every default size
+    rng = np.random.default_rng(0)
+    num_reads = pd.Series(rng.integers(1000000, 20000000, n), index=[f"Pool{i}" for i in range(n)])
+    concs = pd.Series(rng.uniform(5, 80, n), index=num_reads.index)
+    return lambda: _pools(num_reads, concs, min_ul_total=10 * n, solver=solver)
+
+def setup_parse_samplesheet(n, tmpdir):
+    fname = synthetic.samplesheet(os.path.join(tmpdir, "sheet.csv"), n_pools=max(n // 4, 1), samples_per_pool=4)
+    def run():
+        # bypass the memo so every run parses
+        utils._load_samplesheet.cache_clear()
+        sheet = utils.load_samplesheet(fname)
+        return utils.pooled_bp(sheet), utils.pooled_reads(sheet)
+    return run
+
+def setup_check_indexes(n, tmpdir):
+    fname = synthetic.samplesheet(os.path.join(tmpdir, "sheet.csv"), n_pools=max(n // 4, 1), samples_per_pool=4)
+    df = utils.parse_samplesheet(fname)
+    return lambda: check_indexes(df)
+
+def setup_kapaquant(n, tmpdir):
+    fname = synthetic.samplesheet(os.path.join(tmpdir, "sheet.csv"), n_pools=n, samples_per_pool=1)
+    kapafolder = synthetic.kapa_folder(os.path.join(tmpdir, "kapa"), fname)
+    return lambda: _kapaquant(kapafolder, fname, 1e4, 399)
+
+def setup_demux_stats(n, tmpdir, lanes=4):
+    fname = synthetic.samplesheet(os.path.join(tmpdir, "sheet.csv"), n_pools=max(n // 4, 1), samples_per_pool=4)
+    stats = synthetic.stats_json(os.path.join(tmpdir, "Stats.json"), fname, n_lanes=lanes, n_unknown=n)
+    return lambda: read_demux_counts(stats)
+
+def setup_demux(n, tmpdir, lanes=4):
+    fname = synthetic.samplesheet(os.path.join(tmpdir, "sheet.csv"), n_pools=max(n // 4, 1), samples_per_pool=4)
+    stats = synthetic.stats_json(os.path.join(tmpdir, "Stats.json"), fname, n_lanes=lanes, n_unknown=n)
+    def run():
+        cwd = os.getcwd()
+        os.chdir(tmpdir)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                demux(fname, stats)
+        finally:
+            os.chdir(cwd)
+    return run
+
+BENCHMARKS = {
+    "pools": setup_pools,
+    "pools_legacy": lambda n, tmpdir: setup_pools(n, tmpdir, solver="legacy"),
+    "pools_milp": lambda n, tmpdir: setup_pools(n, tmpdir, solver="milp"),
+    "parse_samplesheet": setup_parse_samplesheet,
+    "check_indexes": setup_check_indexes,
+    "kapaquant": setup_kapaquant,
+    "demux_stats": setup_demux_stats,
+    "demux": setup_demux,
+}
+# the old pooling loop, the exact solver and the qPCR plate layout do not scale to the largest sizes
+MAX_SIZE = {"pools_legacy": 1000, "pools_milp": 1000, "kapaquant": 100}
+
+def measure(func, repeat):
+    # warm up caches and lazy imports first
+    func()
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+def scaling_exponent(sizes, times):
+    if len(sizes) < 2:
+        return None
+    return float(np.polyfit(np.log(sizes), np.log(times), 1)[0])
+
+def environment():
+    try:
+        version = importlib.metadata.version("miseq_tools")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except OSError:
+        commit = None
+    return dict(
+        version=version,
+        commit=commit,
+        date=datetime.datetime.now().isoformat(timespec="seconds"),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        pandas=pd.__version__,
+        machine=platform.machine(),
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000], help="Input sizes (pools or samples)")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS.keys(), help="Only run these benchmarks")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size; the best is reported")
+    parser.add_argument("-o", dest="fname_out", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results JSON to compare against")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    results = []
+    for name in args.only or BENCHMARKS:
+        for n in args.sizes:
+            if n > MAX_SIZE.get(name, n):
+                continue
+            # a size that fails is reported rather than ending the whole run
+            try:
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    func = BENCHMARKS[name](n, tmpdir)
+                    seconds, peak = measure(func, args.repeat)
+            except Exception as e:
+                print(f"{name} at size {n} failed: {e}", file=sys.stderr)
+                results.append(dict(benchmark=name, size=n, seconds=np.nan, peak_bytes=np.nan, error=str(e) or type(e).__name__))
+                continue
+            results.append(dict(benchmark=name, size=n, seconds=seconds, peak_bytes=peak, error=None))
+    df = pd.DataFrame(results)
+    exponents = {name: scaling_exponent(group["size"], group["seconds"]) for name, group in df.dropna(subset="seconds").groupby("benchmark", sort=False)}
+
+    table = df.set_index(["benchmark", "size"])
+    table["peak_MiB"] = table.pop("peak_bytes") / 2 ** 20
+    if args.compare:
+        with open(args.compare) as f:
+            old = pd.DataFrame(json.load(f)["results"]).set_index(["benchmark", "size"])
+        table["vs_old"] = table["seconds"] / old["seconds"].reindex(table.index)
+    print(table.to_string(float_format="{:.4g}".format))
+    print()
+    print("Scaling exponents (time ~ size^k):")
+    for name, k in exponents.items():
+        print(f"  {name:<20} {'n/a' if k is None else f'{k:.2f}'}")
+
+    if args.fname_out:
+        with open(args.fname_out, "wt") as f:
+            json.dump(dict(environment=environment(), results=results, scaling_exponents=exponents), f, indent=2)
+
+if __name__ == "__main__":
+    main()
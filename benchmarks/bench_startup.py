@@ -0,0 +1,74 @@
+"""Cold-start benchmark: time every subcommand's --help and a minimal invocation.
+
+    python benchmarks/bench_startup.py [--repeat N] [-o results.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+import synthetic
+import miseq_tools.store
+
+def invocations(tmpdir):
+    sheet = synthetic.samplesheet(os.path.join(tmpdir, "sheet.csv"), n_pools=8, samples_per_pool=2)
+    quant = synthetic.quant_csv(os.path.join(tmpdir, "quant.csv"), sheet)
+    kapa = synthetic.kapa_folder(os.path.join(tmpdir, "kapa"), sheet)
+    stats = synthetic.stats_json(os.path.join(tmpdir, "Stats.json"), sheet)
+    pd.DataFrame({"samplesheet": [sheet], "quant_csv": [quant]}).to_csv(os.path.join(tmpdir, "manifest.csv"), index=False)
+    pd.DataFrame({"kapafolder": [kapa], "samplesheet": [sheet]}).to_csv(os.path.join(tmpdir, "kapa_manifest.csv"), index=False)
+    qubit_input = "\n".join(["10"] * 8) + "\n"
+    store = os.path.join(tmpdir, "store")
+    miseq_tools.store.append(store, "qubit", pd.read_csv(quant), "bench", "2024-01-01")
+    # in the order they run, so render finds the results of kapa, qubit and demux; None runs only --help
+    return {
+        "sheet": (["sheet", sheet, "-o", "samplesheet.csv"], None),
+        "kapa": (["kapa", kapa, sheet], None),
+        "qubit": (["qubit", sheet], qubit_input),
+        "combine": (["combine", "--kapa", quant, "--qubit", quant], None),
+        "pool": (["pool", sheet, quant], None),
+        "pool-batch": (["pool-batch", os.path.join(tmpdir, "manifest.csv"), "--workers", "1"], None),
+        "pre": (["pre", sheet, kapa], qubit_input),
+        "demux": (["demux", sheet, stats], None),
+        "kapa-batch": (["kapa-batch", os.path.join(tmpdir, "kapa_manifest.csv"), "-o", "kapa_batch", "--workers", "1"], None),
+        "shard": (["shard", sheet, "--capacity", "10", "-o", "shard"], None),
+        "rebalance": (["rebalance", sheet, quant, stats, "-o", "rebalance", "--min-ul-total", "100"], None),
+        "render": (["render", tmpdir, "--workers", "1"], None),
+        "history": (["history", store, "qubit", "-o", "history.csv"], None),
+        "watch": (["watch", kapa, "--samplesheet", sheet, "--once", "--settle", "0", "--workers", "1", "-o", "watch", "--state", os.path.join(tmpdir, "watch.json")], None),
+        "serve": (None, None),
+    }
+
+def run(args, stdin, cwd):
+    t = time.perf_counter()
+    out = subprocess.run([sys.executable, "-m", "miseq_tools", *args], input=stdin, capture_output=True, text=True, cwd=cwd)
+    elapsed = time.perf_counter() - t
+    assert out.returncode == 0, f"{' '.join(args)} failed:\n{out.stderr}"
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per command; the median is reported")
+    parser.add_argument("-o", dest="fname_out", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, (cmd, stdin) in invocations(tmpdir).items():
+            for kind, argv, stdin_ in (("help", [name, "--help"], None), ("run", cmd, stdin)):
+                if argv is None:
+                    continue
+                times = [run(argv, stdin_, tmpdir) for _ in range(args.repeat)]
+                results.append(dict(subcommand=name, kind=kind, median_s=statistics.median(times), min_s=min(times)))
+    df = pd.DataFrame(results).set_index(["subcommand", "kind"])
+    print(df.to_string(float_format="{:.3f}".format))
+    if args.fname_out:
+        with open(args.fname_out, "wt") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from miseq_tools.utils import parse_samplesheet, pooled_bp, load_samplesheet
+
+BASES = np.array(list("ACGT"))
+
+def random_indexes(n, length=8, rng=None):
+    rng = rng if rng is not None else np.random.default_rng(0)
+    assert n <= 4 ** length, f"Cannot make {n} unique indexes of length {length}"
+    codes = rng.choice(4 ** length, size=n, replace=False)
+    digits = (codes[:, None] // 4 ** np.arange(length)[::-1]) % 4
+    return ["".join(row) for row in BASES[digits]]
+
+def samplesheet(path, n_pools, samples_per_pool=1, index_len=8, seed=0):
+    rng = np.random.default_rng(seed)
+    n = n_pools * samples_per_pool
+    pools = np.repeat([f"Pool{i}" for i in range(1, n_pools + 1)], samples_per_pool)
+    first = np.arange(n) % samples_per_pool == 0
+    df = pd.DataFrame({
+        "Sample_ID": [f"{pool}_S{j}" for pool, j in zip(pools, np.arange(n) % samples_per_pool)],
+        "I7_Index_ID": [f"i7_{i}" for i in range(n)],
+        "index": random_indexes(n, index_len, rng),
+        "I5_Index_ID": [f"i5_{i}" for i in range(n)],
+        "index2": random_indexes(n, index_len, rng),
+        "Pool label": np.where(first, pools, None),
+        "Reads (million)": rng.uniform(0.1, 2, n).round(3),
+        "Amplicon size (bp)": rng.integers(200, 600, n),
+    })
+    # read info lives in columns 9 and 10 of the first four lines, header included
+    assert n >= 3, "Synthetic sample sheets need at least 3 rows"
+    info = [("Read 1", 151), ("Read 2", 151), ("Index 1 (i7)", index_len), ("Index 2 (i5)", index_len)]
+    df[""] = ""
+    df[info[0][0]] = [k for k, _ in info[1:]] + [""] * (n - 3)
+    df[str(info[0][1])] = [v for _, v in info[1:]] + [""] * (n - 3)
+    df.to_csv(path, index=False)
+    return path
+
+def quant_csv(path, samplesheet_path, seed=0):
+    rng = np.random.default_rng(seed)
+    bp = pooled_bp(load_samplesheet(samplesheet_path))
+    nm = rng.uniform(5, 60, len(bp))
+    pd.DataFrame({"bp": bp, "ng/uL": nm * bp * 617.9 * 1e-6, "nM": nm}).to_csv(path)
+    return path
+
+def kapa_folder(path, samplesheet_path, replicates=3, dilution=1e4, standard_bp=399, seed=0):
+    rng = np.random.default_rng(seed)
+    bp = pooled_bp(load_samplesheet(samplesheet_path))
+    os.makedirs(path, exist_ok=True)
+    slope, intercept = -3.32, 12.0
+    rows = "ABCDEFGHIJKLMNOP"
+    wells = (f"{r}{c:02d}" for r in rows for c in range(1, 25))
+    records = []
+    for level, row in zip(range(6), rows):
+        sq = 20e-12 / 10 ** level
+        for rep in range(replicates):
+            cq = intercept + slope * np.log10(sq * 1e12) + rng.normal(0, 0.05)
+            records.append(dict(Well=f"{row}{rep + 1:02d}", Content="Std", Cq=cq, SQ=sq))
+    used = {r["Well"] for r in records}
+    wells = (w for w in wells if w not in used)
+    width = max(2, len(str(len(bp))))
+    nm = rng.uniform(5, 60, len(bp))
+    pm = nm * 1e3 / dilution * bp.to_numpy() / standard_bp
+    for i, conc in enumerate(pm, 1):
+        for rep in range(replicates):
+            cq = intercept + slope * np.log10(conc) + rng.normal(0, 0.05)
+            records.append(dict(Well=next(wells), Content=f"Unkn-{i:0{width}d}", Cq=cq, SQ=np.nan))
+    df = pd.DataFrame(records)
+    df.insert(0, "", "")
+    df.insert(2, "Fluor", "SYBR")
+    df.to_csv(os.path.join(path, "synthetic -  Quantification Summary_0.csv"), index=False)
+    return path
+
+def stats_json(path, samplesheet_path, n_lanes=1, n_unknown=100, seed=0):
+    rng = np.random.default_rng(seed)
+    samples = parse_samplesheet(samplesheet_path)
+    conversion_results = []
+    unknown_barcodes = []
+    for lane in range(1, n_lanes + 1):
+        reads = rng.poisson(samples["Reads (million)"].to_numpy() * 1e6 / n_lanes)
+        undetermined = int(reads.sum() * 0.05)
+        conversion_results.append({
+            "LaneNumber": lane,
+            "TotalClustersRaw": int(reads.sum() + undetermined) * 2,
+            "TotalClustersPF": int(reads.sum() + undetermined),
+            "Yield": int(reads.sum() + undetermined) * 302,
+            "DemuxResults": [{
+                "SampleId": sample_id,
+                "SampleName": sample_id,
+                "IndexMetrics": [{"IndexSequence": f"{i7}+{i5}", "MismatchCounts": {"0": int(n), "1": 0}}],
+                "NumberReads": int(n),
+                "Yield": int(n) * 302,
+                "ReadMetrics": [{"ReadNumber": 1, "Yield": int(n) * 151, "YieldQ30": int(n) * 140, "QualityScoreSum": 0, "TrimmedBases": 0}],
+            } for sample_id, i7, i5, n in zip(samples["Sample_ID"], samples["index"], samples["index2"], reads)],
+            "Undetermined": {"NumberReads": undetermined, "Yield": undetermined * 302, "ReadMetrics": []},
+        })
+        barcodes = zip(random_indexes(n_unknown, 8, rng), random_indexes(n_unknown, 8, rng))
+        counts = np.sort(rng.integers(1, 10000, n_unknown))[::-1]
+        unknown_barcodes.append({"Lane": lane, "Barcodes": {f"{i7}+{i5}": int(n) for (i7, i5), n in zip(barcodes, counts)}})
+    with open(path, "wt") as f:
+        json.dump({
+            "Flowcell": "SYNTHETIC",
+            "RunNumber": 1,
+            "RunId": "000000_SYNTHETIC_0001_000000000-SYNTH",
+            "ReadInfosForLanes": [],
+            "ConversionResults": conversion_results,
+            "UnknownBarcodes": unknown_barcodes,
+        }, f)
+    return path
@@ -0,0 +1,94 @@
+import csv
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+
+KNOWN_BARCODES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'known_barcodes')
+_COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+# in-process cache, keyed by fingerprint of the barcode files
+_indexes = {}
+
+@dataclasses.dataclass(frozen=True)
+class BarcodeIndex:
+    i7: frozenset[str]
+    i5: frozenset[str]
+    i7_rc: frozenset[str]
+    i5_rc: frozenset[str]
+
+def reverse_complement(seq: str) -> str:
+    return seq.translate(_COMPLEMENT)[::-1]
+
+def cache_dir() -> str:
+    if path := os.environ.get('MISEQ_TOOLS_CACHE'):
+        return path
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'miseq_tools')
+
+def load_barcode_index(barcode_dirs: list[str] = ()) -> BarcodeIndex:
+    # each folder is laid out like known_barcodes/, with i7/ and i5/ subfolders of name,sequence files
+    dirs = [KNOWN_BARCODES_DIR] + [os.path.abspath(d) for d in barcode_dirs]
+    files = _barcode_files(dirs)
+    fingerprint = _fingerprint(files)
+    if fingerprint in _indexes:
+        return _indexes[fingerprint]
+
+    dirs_key = hashlib.sha256('\0'.join(dirs).encode()).hexdigest()[:16]
+    fname_cache = os.path.join(cache_dir(), f'barcodes-{dirs_key}.json')
+    index = _read_cache(fname_cache, fingerprint)
+    if index is None:
+        index = _build(files)
+        _write_cache(fname_cache, fingerprint, index)
+    _indexes[fingerprint] = index
+    return index
+
+def _barcode_files(dirs: list[str]) -> list[tuple[str, str]]:
+    files = []
+    for d in dirs:
+        for read in ('i7', 'i5'):
+            dir_read = os.path.join(d, read)
+            if not os.path.isdir(dir_read):
+                continue
+            files.extend((read, os.path.join(dir_read, fname)) for fname in sorted(os.listdir(dir_read)))
+    return files
+
+def _fingerprint(files: list[tuple[str, str]]) -> str:
+    h = hashlib.sha256()
+    for read, path in files:
+        st = os.stat(path)
+        h.update(f'{read}\0{path}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+def _build(files: list[tuple[str, str]]) -> BarcodeIndex:
+    seqs = {'i7': set(), 'i5': set()}
+    for read, path in files:
+        with open(path, newline='') as f:
+            for row in csv.reader(f, delimiter='\t' if path.endswith('.tsv') else ','):
+                if len(row) >= 2:
+                    seqs[read].add(row[1].strip())
+    return BarcodeIndex(
+        i7=frozenset(seqs['i7']),
+        i5=frozenset(seqs['i5']),
+        i7_rc=frozenset(map(reverse_complement, seqs['i7'])),
+        i5_rc=frozenset(map(reverse_complement, seqs['i5'])),
+    )
+
+def _read_cache(fname: str, fingerprint: str) -> BarcodeIndex | None:
+    try:
+        with open(fname, 'rt') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('fingerprint') != fingerprint:
+        return None
+    return BarcodeIndex(**{field.name: frozenset(cached[field.name]) for field in dataclasses.fields(BarcodeIndex)})
+
+def _write_cache(fname: str, fingerprint: str, index: BarcodeIndex):
+    try:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(f'{fname}.{os.getpid()}.tmp', 'wt') as f:
+            json.dump({'fingerprint': fingerprint, **{field.name: sorted(getattr(index, field.name)) for field in dataclasses.fields(BarcodeIndex)}}, f)
+        os.replace(f'{fname}.{os.getpid()}.tmp', fname)
+    except OSError as e:
+        logging.debug(f'Could not write barcode cache {fname}: {e}')
@@ -0,0 +1,69 @@
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+from . import store
+
+# Corrects KAPA and Qubit nM with what past runs actually demultiplexed to. A pool pipetted by its nM
+# gets reads in proportion to true nM / used nM, so log(used nM * actual/intended) estimates the true nM,
+# and is regressed on log KAPA nM, log Qubit nM and log bp. Only the weighted normal equations are kept,
+# so each refit reads just the runs demultiplexed since the last one.
+
+FEATURES = ['intercept', 'log KAPA nM', 'log Qubit nM', 'log bp']
+# pipetting and clustering noise on top of the counting noise of actual reads
+NOISE = 0.1
+
+def update(store_dir, fname_model=None) -> dict:
+    fname_model = fname_model or os.path.join(store_dir, 'calibration.json')
+    model = load(fname_model)
+    new = _observations(store_dir, exclude_run_ids=model['runs'])
+    if not new.empty:
+        X = design(new['KAPA nM'], new['Qubit nM'], new['bp'])
+        w = new['weight'].to_numpy()
+        model['xtwx'] = (np.array(model['xtwx']) + X.T @ (X * w[:, None])).tolist()
+        model['xtwy'] = (np.array(model['xtwy']) + X.T @ (w * new['y'].to_numpy())).tolist()
+        model['n'] += len(new)
+        model['runs'] = sorted(set(model['runs']) | set(new['run_id']))
+        model['coef'] = _solve(model).tolist()
+        logging.info(f'Calibration updated with {len(new)} pools from {new["run_id"].nunique()} runs ({model["n"]} pools in total)')
+        with open(f'{fname_model}.tmp', 'wt') as f:
+            json.dump(model, f, indent=2)
+        os.replace(f'{fname_model}.tmp', fname_model)
+    return model
+
+def load(fname_model) -> dict:
+    try:
+        with open(fname_model, 'rt') as f:
+            model = json.load(f)
+    except FileNotFoundError:
+        model = dict(features=FEATURES, xtwx=np.zeros((len(FEATURES), len(FEATURES))).tolist(), xtwy=[0.] * len(FEATURES), n=0, runs=[], coef=None)
+    assert model['features'] == FEATURES, f'{fname_model} was fit with features {model["features"]}'
+    return model
+
+def apply(model: dict, kapa_nM: pd.Series, qubit_nM: pd.Series, bp: pd.Series) -> pd.Series:
+    return pd.Series(np.exp(design(kapa_nM, qubit_nM, bp) @ np.array(model['coef'])), index=kapa_nM.index)
+
+def design(kapa_nM, qubit_nM, bp) -> np.ndarray:
+    return np.column_stack([np.ones(len(kapa_nM)), np.log(kapa_nM), np.log(qubit_nM), np.log(bp)])
+
+def _solve(model: dict) -> np.ndarray:
+    # a touch of ridge so a history where e.g. every amplicon is the same size still solves
+    xtwx = np.array(model['xtwx'])
+    return np.linalg.solve(xtwx + 1e-6 * np.trace(xtwx) * np.eye(len(xtwx)), np.array(model['xtwy']))
+
+def _observations(store_dir, exclude_run_ids=()) -> pd.DataFrame:
+    # pools with both a recorded combine and a recorded demux
+    try:
+        demux = store.read(store_dir, 'demux', exclude_run_ids=exclude_run_ids, columns=['Pool label', 'intended', 'actual'])
+        combined = store.read(store_dir, 'combined', run_ids=demux['run_id'].unique().tolist(), columns=['Pool label', 'bp', 'nM', 'KAPA nM', 'Qubit nM'])
+    except FileNotFoundError:
+        return pd.DataFrame(columns=['run_id', 'KAPA nM', 'Qubit nM', 'bp', 'y', 'weight'])
+    # a run rerun on another date is stored under each date; only its latest results count, and only once
+    demux, combined = (df[df['run_date'] == df.groupby('run_id')['run_date'].transform('max')] for df in (demux, combined))
+    df = demux.merge(combined.drop(columns='run_date'), on=['run_id', 'Pool label'])
+    df = df[(df[['intended', 'actual', 'nM', 'KAPA nM', 'Qubit nM', 'bp']] > 0).all(axis=1)]
+    # share of the run's reads, since runs differ in how many clusters passed filter
+    by_run = df.groupby('run_id')
+    ratio = (df['actual'] / by_run['actual'].transform('sum')) / (df['intended'] / by_run['intended'].transform('sum'))
+    return df.assign(y=np.log(df['nM'] * ratio), weight=1 / (1 / df['actual'] + NOISE ** 2))
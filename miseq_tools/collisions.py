@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+# 2-bit codes; anything else (N, padding) is a wildcard that never counts as a mismatch
+_CODES = np.full(256, -1, dtype=np.int64)
+for _i, _base in enumerate(b'ACGT'):
+    _CODES[_base] = _i
+_LOW_BITS = np.uint64(0x5555555555555555)
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def index_collisions(i7, i5=None, max_mismatches: int = 2, block_size: int = 1024) -> tuple[pd.DataFrame, int]:
+    # returns pairs (positions a < b, mismatches per index) within max_mismatches, and the smallest distance of any pair.
+    # indexes of different lengths are compared over their common prefix, like bcl2fastq/BCL Convert
+    # do when shorter indexes are padded with N out to the index read length
+    reads = [_encode(i7)] + ([_encode(i5)] if i5 is not None else [])
+    n = len(reads[0][0])
+    pairs = []
+    min_distance = np.iinfo(np.int64).max
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        # only compare against later samples, so each pair is seen once
+        dists = [_hamming(packed[start:stop], mask[start:stop], packed[start:], mask[start:]) for packed, mask in reads]
+        # a pair is only ambiguous if every index is close, so the pair's distance is its best-separated index
+        dist = np.maximum.reduce(dists)
+        upper = np.arange(stop - start)[:, None] < np.arange(n - start)[None, :]
+        if upper.any():
+            min_distance = min(min_distance, int(dist[upper].min()))
+        a, b = np.nonzero(upper & (dist <= max_mismatches))
+        pairs.append(pd.DataFrame({
+            'a': a + start,
+            'b': b + start,
+            **{name: d[a, b] for name, d in zip(('i7', 'i5'), dists)},
+        }))
+    pairs = pd.concat(pairs, ignore_index=True) if pairs else pd.DataFrame(columns=['a', 'b', 'i7'])
+    return pairs, (min_distance if n > 1 else None)
+
+def nearest_pairs(i7, i5, ref_i7, ref_i5=None, max_mismatches: int = 2, block_size: int = 4096) -> tuple[np.ndarray, np.ndarray]:
+    # for each query index pair, the position of the one reference pair it is closest to (judged by its worse index)
+    # and the distance, or -1 if none is within max_mismatches or several are equally close
+    queries = [_encode(i7)] + ([_encode(i5)] if ref_i5 is not None else [])
+    refs = [_encode(ref_i7)] + ([_encode(ref_i5)] if ref_i5 is not None else [])
+    n = len(queries[0][0])
+    nearest = np.full(n, -1, dtype=np.int64)
+    distance = np.full(n, -1, dtype=np.int64)
+    if not len(refs[0][0]):
+        return nearest, distance
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        dist = np.maximum.reduce([_hamming(q_packed[start:stop], q_mask[start:stop], r_packed, r_mask) for (q_packed, q_mask), (r_packed, r_mask) in zip(queries, refs)])
+        best = dist.min(axis=1)
+        unique = (dist == best[:, None]).sum(axis=1) == 1
+        found = unique & (best <= max_mismatches)
+        nearest[start:stop] = np.where(found, dist.argmin(axis=1), -1)
+        distance[start:stop] = np.where(found, best, -1)
+    return nearest, distance
+
+def safe_barcode_mismatches(min_distance: int | None) -> int:
+    # reads up to m mismatches from two indexes only overlap if the indexes are within 2m
+    if min_distance is None:
+        return 2
+    return int(np.clip((min_distance - 1) // 2, 0, 2))
+
+def _encode(seqs) -> tuple[np.ndarray, np.ndarray]:
+    seqs = pd.Series(seqs, dtype=object).fillna('').astype(str).str.upper()
+    length = max(1, seqs.str.len().max() if len(seqs) else 1)
+    assert length <= 32, 'Indexes longer than 32 bp are not supported'
+    chars = np.frombuffer(seqs.to_numpy(dtype=f'S{length}').tobytes(), dtype=np.uint8).reshape(-1, length)
+    codes = _CODES[chars]
+    valid = codes >= 0
+    # left-align so that indexes of different lengths share their prefix
+    shifts = (2 * (31 - np.arange(length))).astype(np.uint64)
+    packed = np.bitwise_or.reduce(np.where(valid, codes, 0).astype(np.uint64) << shifts, axis=1)
+    mask = np.bitwise_or.reduce(valid.astype(np.uint64) << shifts, axis=1)
+    return packed, mask
+
+def _hamming(packed_a, mask_a, packed_b, mask_b) -> np.ndarray:
+    x = packed_a[:, None] ^ packed_b[None, :]
+    x = (x | (x >> np.uint64(1))) & _LOW_BITS
+    # skip masking when every index is full length without Ns, which is the usual case
+    if not (mask_a.min() == mask_a.max() == mask_b.min() == mask_b.max()):
+        x &= mask_a[:, None] & mask_b[None, :]
+    return _popcount(x)
+
+def _popcount(x: np.ndarray) -> np.ndarray:
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).astype(np.int64)
+    return _POPCOUNT8[x.view(np.uint8).reshape(*x.shape, 8)].sum(axis=-1, dtype=np.int64)
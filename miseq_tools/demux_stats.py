@@ -1,38 +1,343 @@
 import pandas as pd
 import json
-import matplotlib.pyplot as plt
+import re
+import logging
+import dataclasses
+import os
+from array import array
 import numpy as np
 from .utils import parse_samplesheet
+from .barcodes import reverse_complement
+from .collisions import nearest_pairs
+from . import plots, profiling, store
 
-def demux(samplesheet, stats):
-    df_intended = parse_samplesheet(samplesheet)
-    df_intended.set_index(["Pool label", "Sample_ID"], inplace=True)
-    df_intended = df_intended["Reads (million)"] * 1e6
-    df_intended.rename("intended", inplace=True)
-
-    df_actual = json.load(open(stats, "rt"))
-    df_actual = pd.concat([pd.DataFrame(df_actual_lane["DemuxResults"], columns=["SampleId", "NumberReads"]).set_index("SampleId").squeeze("columns") for df_actual_lane in df_actual["ConversionResults"]], names=["Lane"], keys=range(1, 1 + len(df_actual["ConversionResults"])), axis="columns")
-    df_actual = df_actual.sum(axis="columns").rename("actual")
-
-    df = pd.merge(left=df_intended, right=df_actual, left_on="Sample_ID", right_index=True, how="outer")
-    df_pool = df.groupby("Pool label").sum()
-    lim_min = min(df_pool['intended'].min(), df_pool['actual'].min())
-    lim_max = max(df_pool['intended'].max(), df_pool['actual'].max())
-    lim_range = np.log10(lim_max) - np.log10(lim_min)
-    lim = np.log10(lim_min) - 0.1 * lim_range, np.log10(lim_max) + 0.1 * lim_range
-    lim = 10 ** np.array(lim)
-    fig, ax = plt.subplots(figsize=(3, 3))
-    ax.plot(np.linspace(*lim), np.linspace(*lim), color="k", linewidth=0.5)
-    ax.scatter(df_pool["intended"], df_pool["actual"])
-    for label, row in df_pool.iterrows():
-        ax.annotate(xy=(row["intended"], row["actual"]), text=label, ha="left", va="center", xytext=(5, 0), textcoords="offset points", fontsize=6)
-    ax.set_xscale("log")
-    ax.set_yscale("log")
-    ax.set_xlim(*lim)
-    ax.set_ylim(*lim)
-    ax.set_xlabel("Intended num reads")
-    ax.set_ylabel("Actual num reads")
-    fig.savefig("demux_stats.pdf", bbox_inches="tight")
-    plt.close(fig)
+_WHITESPACE = re.compile(r'\s*')
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+
+@dataclasses.dataclass
+class DemuxCounts:
+    samples: list[str]
+    lanes: np.ndarray
+    reads: np.ndarray # samples x lanes
+    total_clusters_raw: np.ndarray
+    total_clusters_pf: np.ndarray
+    undetermined: np.ndarray
+    unknown_barcodes: pd.DataFrame = dataclasses.field(default_factory=lambda: pd.DataFrame(columns=["Lane", "index", "index2", "reads"]))
+
+    def actual(self) -> pd.Series:
+        return pd.Series(self.reads.sum(axis=1), index=pd.Index(self.samples, name="SampleId"), name="actual")
+
+    def lane_summary(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            "TotalClustersRaw": self.total_clusters_raw,
+            "TotalClustersPF": self.total_clusters_pf,
+            "Assigned": self.reads.sum(axis=0),
+            "Undetermined": self.undetermined,
+        }, index=pd.Index(self.lanes, name="Lane"))
+
+def demux(samplesheet, stats, max_mismatches=2, outdir='.'):
+    counts, df_pool = _demux_pools(samplesheet, stats)
+    samples = parse_samplesheet(samplesheet)
+    with profiling.stage("attribute"):
+        unknown = attribute_unknown(samples, counts.unknown_barcodes, max_mismatches)
+        df_sample = sample_report(samples, counts, unknown)
+    for lane, row in counts.lane_summary().iterrows():
+        logging.info(f'Lane {lane}: {row["TotalClustersPF"]:,} PF clusters, {row["Undetermined"]:,} undetermined ({100 * row["Undetermined"] / max(row["TotalClustersPF"], 1):.1f}%)')
+    for lane, top in counts.unknown_barcodes.groupby("Lane"):
+        top = top.nlargest(3, "reads")
+        logging.info(f'Lane {lane} top unknown barcodes: {", ".join(f"{i7}+{i5} ({n:,})" for i7, i5, n in top[["index", "index2", "reads"]].itertuples(index=False))}')
+    for lane, causes in unknown.groupby("Lane"):
+        causes = causes.groupby("cause")["reads"].sum().sort_values(ascending=False)
+        logging.info(f'Lane {lane} unknown barcodes by likely cause: {", ".join(f"{cause} ({n:,})" for cause, n in causes.items())}')
+
+    with profiling.stage("write"):
+        os.makedirs(outdir, exist_ok=True)
+        df_pool.to_csv(os.path.join(outdir, "demux_stats.csv"))
+        df_sample.to_csv(os.path.join(outdir, "demux_samples.csv"))
+        unknown.to_csv(os.path.join(outdir, "demux_unknown.csv"), index=False)
+        store.record("demux", df_pool, samplesheet)
+    if plots.enabled():
+        with profiling.stage("plot"):
+            plots.plot_demux(df_pool, os.path.join(outdir, "demux_stats.pdf"))
 
     print((df_pool["actual"] / df_pool["intended"]).rename("actual/intended"))
+
+def _demux_pools(samplesheet, stats) -> tuple[DemuxCounts, pd.DataFrame]:
+    # intended and actual reads per pool
+    with profiling.stage("parse"):
+        df_intended = parse_samplesheet(samplesheet)
+        df_intended.set_index(["Pool label", "Sample_ID"], inplace=True)
+        df_intended = df_intended["Reads (million)"] * 1e6
+        df_intended.rename("intended", inplace=True)
+        counts = read_demux_counts(stats)
+    df = pd.merge(left=df_intended, right=counts.actual(), left_on="Sample_ID", right_index=True, how="outer")
+    return counts, df.groupby("Pool label").sum()
+
+# in the order they're tried; the first that explains an unknown barcode is its likely cause
+CAUSES = ("no call", "exact match", "index hopping", "i7 reverse complement", "i5 reverse complement", "both reverse complement", "i7/i5 swapped", "mismatches", "unknown")
+
+def attribute_unknown(samples: pd.DataFrame, unknown_barcodes: pd.DataFrame, max_mismatches=2) -> pd.DataFrame:
+    # each unknown barcode with its likely cause and the sample its reads probably belong to;
+    # for index hopping that's the i7's sample, with the i5's sample in Sample_ID_i5
+    i7 = samples["index"].fillna("").astype(str).str.upper()
+    i5 = samples["index2"].fillna("").astype(str).str.upper()
+    ids = samples["Sample_ID"].astype(str)
+    # classify each distinct index pair once, however many lanes it turns up in
+    upper = unknown_barcodes.assign(**{col: unknown_barcodes[col].fillna("").astype(str).str.upper() for col in ("index", "index2")})
+    pairs = upper[["index", "index2"]].drop_duplicates(ignore_index=True)
+    q7, q5 = pairs["index"], pairs["index2"]
+    cause = pd.Series(None, index=pairs.index, dtype=object)
+    sample = pd.Series(None, index=pairs.index, dtype=object)
+
+    def assign(name, matched):
+        which = cause.isna() & matched.notna()
+        cause[which] = name
+        sample[which] = matched[which]
+
+    cause[q7.str.fullmatch("N+") | q5.str.fullmatch("N+")] = "no call"
+    from_i7, from_i5 = q7.map(_unique_lookup(i7, ids)), q5.map(_unique_lookup(i5, ids))
+    assign("exact match", from_i7.where(from_i7 == from_i5))
+    hopped = cause.isna() & from_i7.notna() & from_i5.notna()
+    assign("index hopping", from_i7.where(hopped))
+    sample_i5 = from_i5.where(hopped)
+
+    # precomputed lookups from each way an index pair commonly goes wrong back to the sample
+    rc7, rc5 = i7.map(reverse_complement), i5.map(reverse_complement)
+    key = q7 + "+" + q5
+    assign("i7 reverse complement", key.map(_unique_lookup(rc7 + "+" + i5, ids)))
+    assign("i5 reverse complement", key.map(_unique_lookup(i7 + "+" + rc5, ids)))
+    assign("both reverse complement", key.map(_unique_lookup(rc7 + "+" + rc5, ids)))
+    assign("i7/i5 swapped", key.map(_unique_lookup(i5 + "+" + i7, ids)))
+
+    rest = cause.isna()
+    nearest, _ = nearest_pairs(q7[rest], q5[rest], i7, i5 if (i5 != "").any() else None, max_mismatches)
+    assign("mismatches", pd.Series(ids.to_numpy()[nearest], index=q7.index[rest]).where(nearest >= 0).reindex(pairs.index))
+    cause = cause.fillna("unknown")
+
+    pairs = pairs.assign(cause=cause, Sample_ID=sample, Sample_ID_i5=sample_i5)
+    return upper.merge(pairs, on=["index", "index2"], how="left")
+
+def _unique_lookup(keys: pd.Series, ids: pd.Series) -> pd.Series:
+    # keys shared by several samples, or empty, can't say which sample a read came from
+    keep = ~keys.duplicated(keep=False) & ~keys.isin(["", "+"])
+    return pd.Series(ids[keep].to_numpy(), index=keys[keep].to_numpy())
+
+def sample_report(samples: pd.DataFrame, counts: DemuxCounts, unknown: pd.DataFrame) -> pd.DataFrame:
+    # intended and actual reads per sample, and the unknown reads that likely belong to it by cause;
+    # reads that hopped are split evenly between the two samples
+    df = samples.set_index("Sample_ID")[["Pool label"]].copy()
+    df["intended"] = samples.set_index("Sample_ID")["Reads (million)"] * 1e6
+    df["actual"] = counts.actual().reindex(df.index, fill_value=0)
+    df["actual/intended"] = df["actual"] / df["intended"]
+    hopped = unknown["cause"] == "index hopping"
+    lost = pd.concat([
+        unknown.loc[~hopped & unknown["Sample_ID"].notna(), ["Sample_ID", "cause", "reads"]],
+        unknown.loc[hopped, ["Sample_ID", "cause"]].assign(reads=unknown.loc[hopped, "reads"] / 2),
+        unknown.loc[hopped, ["Sample_ID_i5", "cause"]].rename(columns={"Sample_ID_i5": "Sample_ID"}).assign(reads=unknown.loc[hopped, "reads"] / 2),
+    ])
+    lost = lost.pivot_table(index="Sample_ID", columns="cause", values="reads", aggfunc="sum", fill_value=0)
+    lost = lost.reindex(index=df.index, columns=[c for c in CAUSES if c in lost.columns], fill_value=0)
+    df["unknown"] = lost.sum(axis=1)
+    return df.join(lost.add_prefix("unknown: "))
+
+STATS_FILES = ("Stats.json", "Demultiplex_Stats.csv")
+
+def read_demux_counts(path) -> DemuxCounts:
+    # accepts bcl2fastq's Stats.json, BCL Convert's Demultiplex_Stats.csv, or a folder containing either
+    if os.path.isdir(path):
+        path = _find_stats(path)
+    if os.path.basename(path).endswith(".csv"):
+        return _read_demultiplex_stats_csv(path)
+    return _read_stats_json(path)
+
+def _find_stats(folder) -> str:
+    # shallowest match wins, e.g. a run folder's Data/Intensities/BaseCalls/Stats or Analysis/1/Data/Reports
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames.sort()
+        for fname in STATS_FILES:
+            if fname in filenames:
+                return os.path.join(dirpath, fname)
+    raise FileNotFoundError(f"Could not find {' or '.join(STATS_FILES)} in {folder}")
+
+def _read_demultiplex_stats_csv(fname, chunksize=1 << 16) -> DemuxCounts:
+    sample_rows = dict()
+    rows, lanes, reads = array("q"), array("q"), array("q")
+    undetermined = dict()
+    for chunk in pd.read_csv(fname, usecols=["Lane", "SampleID", "# Reads"], dtype={"SampleID": str}, chunksize=chunksize):
+        is_undetermined = chunk["SampleID"] == "Undetermined"
+        for lane, n in chunk[is_undetermined].groupby("Lane")["# Reads"].sum().items():
+            undetermined[lane] = undetermined.get(lane, 0) + n
+        chunk = chunk[~is_undetermined]
+        rows.extend(sample_rows.setdefault(sample_id, len(sample_rows)) for sample_id in chunk["SampleID"])
+        lanes.extend(chunk["Lane"].astype(np.int64))
+        reads.extend(chunk["# Reads"].astype(np.int64))
+
+    lane_numbers = np.unique(np.concatenate([np.frombuffer(lanes, dtype=np.int64), np.fromiter(undetermined, dtype=np.int64)]))
+    reads_matrix = np.zeros((len(sample_rows), len(lane_numbers)), dtype=np.int64)
+    np.add.at(reads_matrix, (np.frombuffer(rows, dtype=np.int64), np.searchsorted(lane_numbers, np.frombuffer(lanes, dtype=np.int64))), np.frombuffer(reads, dtype=np.int64))
+    undetermined = np.array([undetermined.get(lane, 0) for lane in lane_numbers], dtype=np.int64)
+    # BCL Convert only reports passing-filter clusters
+    total_clusters_pf = reads_matrix.sum(axis=0) + undetermined
+
+    counts = DemuxCounts(
+        samples=list(sample_rows),
+        lanes=lane_numbers,
+        reads=reads_matrix,
+        total_clusters_raw=total_clusters_pf,
+        total_clusters_pf=total_clusters_pf,
+        undetermined=undetermined,
+    )
+    fname_unknown = os.path.join(os.path.dirname(fname), "Top_Unknown_Barcodes.csv")
+    if os.path.exists(fname_unknown):
+        # single-index runs have no index2 column
+        usecols = [col for col in pd.read_csv(fname_unknown, nrows=0).columns if col in ("Lane", "index", "index2", "# Reads")]
+        unknown_barcodes = pd.concat(pd.read_csv(fname_unknown, usecols=usecols, dtype={"index": str, "index2": str}, chunksize=chunksize))
+        if "index2" not in unknown_barcodes.columns:
+            unknown_barcodes["index2"] = ""
+        counts.unknown_barcodes = unknown_barcodes.rename(columns={"# Reads": "reads"})[["Lane", "index", "index2", "reads"]].reset_index(drop=True)
+    return counts
+
+def _read_stats_json(fname, chunk_size=1 << 20) -> DemuxCounts:
+    # walks ConversionResults without loading the whole file, keeping only read counts
+    sample_rows = dict()
+    lanes = []
+    unknown = []
+    with open(fname, "rt") as f:
+        stream = _JSONStream(f, chunk_size)
+        for key in stream.items():
+            if key == "UnknownBarcodes":
+                unknown.extend(_read_unknown_barcodes(stream))
+                continue
+            if key != "ConversionResults":
+                stream.skip()
+                continue
+            for _ in stream.elements():
+                lane = dict(rows=array("q"), reads=array("q"), LaneNumber=len(lanes) + 1, TotalClustersRaw=0, TotalClustersPF=0, Undetermined=0)
+                for lane_key in stream.items():
+                    if lane_key == "DemuxResults":
+                        for _ in stream.elements():
+                            sample = stream.value()
+                            lane["rows"].append(sample_rows.setdefault(sample["SampleId"], len(sample_rows)))
+                            lane["reads"].append(sample["NumberReads"])
+                    elif lane_key == "Undetermined":
+                        lane["Undetermined"] = stream.value().get("NumberReads", 0)
+                    elif lane_key in lane:
+                        lane[lane_key] = stream.value()
+                    else:
+                        stream.skip()
+                lanes.append(lane)
+
+    reads = np.zeros((len(sample_rows), len(lanes)), dtype=np.int64)
+    for j, lane in enumerate(lanes):
+        np.add.at(reads[:, j], np.frombuffer(lane["rows"], dtype=np.int64), np.frombuffer(lane["reads"], dtype=np.int64))
+    return DemuxCounts(
+        samples=list(sample_rows),
+        lanes=np.array([lane["LaneNumber"] for lane in lanes], dtype=np.int64),
+        reads=reads,
+        total_clusters_raw=np.array([lane["TotalClustersRaw"] for lane in lanes], dtype=np.int64),
+        total_clusters_pf=np.array([lane["TotalClustersPF"] for lane in lanes], dtype=np.int64),
+        undetermined=np.array([lane["Undetermined"] for lane in lanes], dtype=np.int64),
+        **(dict(unknown_barcodes=pd.concat(unknown, ignore_index=True)) if unknown else {}),
+    )
+
+def _read_unknown_barcodes(stream):
+    # one {"Lane": n, "Barcodes": {"i7+i5": reads}} per lane; each lane's barcodes are decoded in one go,
+    # as there can be tens of thousands of them
+    for _ in stream.elements():
+        lane, barcodes = None, {}
+        for key in stream.items():
+            if key == "Lane":
+                lane = stream.value()
+            elif key == "Barcodes":
+                barcodes = stream.value()
+            else:
+                stream.skip()
+        indexes = pd.Series(list(barcodes), dtype=object).str.split("+", n=1, expand=True).reindex(columns=[0, 1])
+        yield pd.DataFrame({
+            "Lane": lane,
+            "index": indexes[0].to_numpy(dtype=object),
+            "index2": indexes[1].to_numpy(dtype=object),
+            "reads": np.fromiter(barcodes.values(), dtype=np.int64, count=len(barcodes)),
+        })
+
+# minimal pull parser: containers are walked incrementally, only leaf values are decoded whole
+class _JSONStream:
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        self.eof = not chunk
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self) -> str:
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                raise ValueError("Unexpected end of JSON")
+            self._fill()
+
+    def _expect(self, chars: str) -> str:
+        c = self.peek()
+        if c not in chars:
+            raise ValueError(f"Expected one of {chars!r} but got {c!r}")
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number that runs to the end of the buffer might continue in the next chunk,
+                # even if its start decodes on its own, like 12 of 12.5 split after the dot
+                if self.eof or _NUMBER_TAIL.match(self.buf, end).end() < len(self.buf):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    # yields each key of an object; the caller must consume the value before the next iteration
+    def items(self):
+        self._expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(":")
+            yield key
+            if self._expect(",}") == "}":
+                return
+
+    # yields once per element of an array; the caller must consume the element before the next iteration
+    def elements(self):
+        self._expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self._expect(",]") == "]":
+                return
+
+    def skip(self):
+        c = self.peek()
+        if c == "{":
+            for _ in self.items():
+                self.skip()
+        elif c == "[":
+            for _ in self.elements():
+                self.skip()
+        else:
+            self.value()
@@ -1,71 +1,192 @@
 import argparse
-from .samplesheet import format_samplesheet
-from .quant_kapa import kapaquant
-from .quant_qubit import qubitquant
-from .pooling import pooling
-from .quant_combine import quant_combine
-from .demux_stats import demux
+import importlib
+import importlib.util
+import os
 import logging
-import matplotlib.pyplot as plt
+import sys
+from .pipeline import PRE_STAGES
+from . import profiling
+
+# keep in sync with pooling.SOLVERS; importing pooling here would pull in pandas for every subcommand
+SOLVERS = ("fast", "legacy", "milp")
+
+# subcommand modules pull in pandas/matplotlib/seaborn/scipy/Bio, so only import them once the subcommand runs
+def _lazy(spec):
+    module, name = spec.split(":")
+    def func(**kwargs):
+        with profiling.stage("import"):
+            func = getattr(importlib.import_module(f".{module}", __package__), name)
+        return func(**kwargs)
+    return func
 
 def main():
     parser = argparse.ArgumentParser(description="Tools for running Miseq", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     # subparser for sample sheet
     subparsers = parser.add_subparsers(required=True)
     parser.add_argument("--mpl-style", help="Matplotlib style to use")
+    parser.add_argument("--no-plots", help="Skip all figures; use the render subcommand to draw them later", action="store_true")
     parser.add_argument("--log-level", help="Log level", default="INFO", choices=logging._nameToLevel.keys())
+    parser.add_argument("--profile", help="Write wall time, CPU time and peak memory of each stage to this JSON file", dest="fname_profile")
+    parser.add_argument("--store", help="Also append kapa, qubit, combine and demux results to this Parquet results store (needs pyarrow)", dest="results_store")
+    parser.add_argument("--run-id", help="Run the results are stored under (default: the sample sheet's file name, without extension)")
+    parser.add_argument("--run-date", help="Date the results are stored under, as YYYY-MM-DD (default: today)")
+    parser.add_argument("--profile-pstats", help="Also write a cProfile dump to this file, for pstats or snakeviz", dest="fname_pstats")
+    # options shared by several subcommands, defined once and added to each with parents=[...]
+    kapa_options = argparse.ArgumentParser(add_help=False)
+    kapa_options.add_argument("--dilution", help="Dilution factor of samples", type=float, default=1e4)
+    kapa_options.add_argument("--standard-bp", help="Amplicon size (bp) of standards. 452 for KAPA, 399 for NEB.", type=int, default=399)
+    kapa_options.add_argument("--drop-outliers", help="Leave outlier replicate wells out of each pool's average", action="store_true")
+    kapa_options.add_argument("--outlier-z", help="Robust z-score (from the pool's median and MAD of Cq) above which a well is an outlier", type=float, default=3.5)
+    kapa_options.add_argument("--outlier-min-cq", help="Wells within this many cycles of the pool's median are never outliers", type=float, default=0.5)
+    pooling_options = argparse.ArgumentParser(add_help=False)
+    pooling_options.add_argument("--min-ul-pipettable", help="Minimum volume pipettable", type=float, default=2)
+    pooling_options.add_argument("--max-ul-pipettable", help="Maximum volume pipettable", type=float, default=10)
+    pooling_options.add_argument("--min-ul-total", help="Minimum total volume", type=float, default=10)
+    pooling_options.add_argument("--solver", help="Pooling solver to use", default="fast", choices=SOLVERS)
+    pooling_options.add_argument("--time-limit", help="Seconds the milp solver may search before settling for the fast solver's plan, if there is one", type=float, default=60)
+
     parser_samplesheet = subparsers.add_parser("sheet", help="Format sample sheet for Miseq", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser_samplesheet.set_defaults(func=format_samplesheet)
+    parser_samplesheet.set_defaults(func=_lazy("samplesheet:format_samplesheet"))
     parser_samplesheet.add_argument("fname_in", help="Input file")
     parser_samplesheet.add_argument("--nextseq", help="Reverse complements i5 for NextSeq 550", action="store_true")
     parser_samplesheet.add_argument("-o", help="Output file", dest="fname_out", default="samplesheet.csv")
+    parser_samplesheet.add_argument("--max-mismatches", help="Warn about index pairs within this many mismatches of each other", type=int, default=2)
+    parser_samplesheet.add_argument("--barcodes", help="Extra folder of known barcodes with i7/ and i5/ subfolders, like known_barcodes/ (repeatable)", dest="barcode_dirs", action="append", default=[])
 
-    parser_kapa = subparsers.add_parser("kapa", help="Analyze qPCR library quantification data", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser_kapa.set_defaults(func=kapaquant)
-    parser_kapa.add_argument("kapafolder", help="Folder containing qPCR data")
+    parser_kapa = subparsers.add_parser("kapa", help="Analyze qPCR library quantification data", parents=[kapa_options], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_kapa.set_defaults(func=_lazy("quant_kapa:kapaquant"))
+    parser_kapa.add_argument("kapafolder", help="Folder containing qPCR data, or its Quantification Summary CSV")
     parser_kapa.add_argument("samplesheet", help="Sample sheet to use")
-    parser_kapa.add_argument("--dilution", help="Dilution factor of samples", type=float, default=1e4)
-    parser_kapa.add_argument("--standard-bp", help="Amplicon size (bp) of standards. 452 for KAPA, 399 for NEB.", type=int, default=399)
+
+    parser_kapa_batch = subparsers.add_parser("kapa-batch", help="Analyze many qPCR plates in parallel", parents=[kapa_options], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_kapa_batch.set_defaults(func=_lazy("quant_kapa:kapa_batch"))
+    parser_kapa_batch.add_argument("manifest", help="CSV with kapafolder and samplesheet columns (and optionally plate), one row per plate")
+    parser_kapa_batch.add_argument("-o", help="Output folder", dest="outdir", default=".")
+    parser_kapa_batch.add_argument("--workers", help="Number of worker processes (default: number of CPUs)", type=int)
+    parser_kapa_batch.add_argument("--plots", help="Also plot each plate", dest="plot", action="store_true")
 
     parser_qubit = subparsers.add_parser("qubit", help="Analyze Qubit quantification data", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser_qubit.add_argument("samplesheet", help="Sample sheet to use")
-    parser_qubit.set_defaults(func=qubitquant)
+    parser_qubit.add_argument("--export", help="Qubit (Flex) or plate reader CSV export; pools missing from it are asked for", dest="qubit_export")
+    parser_qubit.add_argument("--wells", help="CSV with Well and Pool label columns, for exports that only name wells", dest="well_map")
+    parser_qubit.add_argument("--no-prompt", help="Fail instead of asking for pools missing from the export", dest="prompt", action="store_false")
+    parser_qubit.set_defaults(func=_lazy("quant_qubit:qubitquant"))
 
     parser_combine = subparsers.add_parser("combine", help="Combine KAPA and Qubit quantification data", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser_combine.add_argument("--kapa", help="KAPA quantification data", dest="kapa_fname", default="quant_kapa.csv")
     parser_combine.add_argument("--qubit", help="Qubit quantification data", dest="qubit_fname", default="quant_qubit.csv")
-    parser_combine.set_defaults(func=quant_combine)
+    parser_combine.add_argument("--calibrated", help="Instead of averaging, correct KAPA and Qubit with a model fit to the demux results of past runs in the --store results store", action="store_true")
+    parser_combine.add_argument("--model", help="Calibration model, refit with any new runs before use (default: calibration.json in the results store)", dest="fname_model")
+    parser_combine.add_argument("--samplesheet", help="Sample sheet of the run, to name it in the --store results store (or give --run-id)")
+    parser_combine.set_defaults(func=_lazy("quant_combine:quant_combine"))
 
-    parser_pooling = subparsers.add_parser("pool", help="Figure out pooling", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_pooling = subparsers.add_parser("pool", help="Figure out pooling", parents=[pooling_options], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser_pooling.add_argument("samplesheet", help="Sample sheet to use")
     parser_pooling.add_argument("quant_csv", help="Quantification data")
-    parser_pooling.add_argument("--min-ul-pipettable", help="Minimum volume pipettable", type=float, default=2)
-    parser_pooling.add_argument("--max-ul-pipettable", help="Maximum volume pipettable", type=float, default=10)
-    parser_pooling.add_argument("--min-ul-total", help="Minimum total volume", type=float, default=10)
-    parser_pooling.set_defaults(func=pooling)
+    parser_pooling.set_defaults(func=_lazy("pooling:pooling"))
+
+    parser_pool_batch = subparsers.add_parser("pool-batch", help="Figure out pooling for many runs in parallel", parents=[pooling_options], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_pool_batch.add_argument("manifest", help="CSV with samplesheet and quant_csv columns (and optionally run), one row per run")
+    parser_pool_batch.add_argument("-o", help="Output folder", dest="outdir", default=".")
+    parser_pool_batch.add_argument("--workers", help="Number of worker processes (default: number of CPUs)", type=int)
+    parser_pool_batch.set_defaults(func=_lazy("pooling:pool_batch"))
+
+    parser_shard = subparsers.add_parser("shard", help="Split a sample sheet across runs and lanes that each hold a limited number of reads", parents=[pooling_options], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_shard.set_defaults(func=_lazy("shard:shard"))
+    parser_shard.add_argument("fname_in", help="Input file")
+    parser_shard.add_argument("--capacity", help="Reads (million) one run holds, across all its lanes", type=float, required=True)
+    parser_shard.add_argument("--lanes", help="Lanes per run; pools sharing a lane must not have colliding indexes", type=int, default=1)
+    parser_shard.add_argument("--quant", help="Quantification data, to also write a pooling plan for each run and lane", dest="quant_csv")
+    parser_shard.add_argument("-o", help="Output folder", dest="outdir", default=".")
+    parser_shard.add_argument("--nextseq", help="Reverse complements i5 for NextSeq 550", action="store_true")
+    parser_shard.add_argument("--max-mismatches", help="Index pairs within this many mismatches of each other can't share a lane", type=int, default=2)
+    parser_shard.add_argument("--barcodes", help="Extra folder of known barcodes with i7/ and i5/ subfolders, like known_barcodes/ (repeatable)", dest="barcode_dirs", action="append", default=[])
 
     parser_pre = subparsers.add_parser("pre", help="Full pre-Miseq pipeline: includes sheet, kapa, qubit, combine, and pool", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser_pre.add_argument("samplesheet", help="Sample sheet to use")
     parser_pre.add_argument("kapafolder", help="Folder containing KAPA data")
-    def pipeline_pre(**kwargs):
-        format_samplesheet(fname_in=kwargs['samplesheet'], fname_out='samplesheet.csv')
-        kapaquant(kapafolder=kwargs['kapafolder'], samplesheet=kwargs['samplesheet'], dilution=1e4, standard_bp=399)
-        qubitquant(samplesheet=kwargs['samplesheet'])
-        quant_combine(kapa_fname="quant_kapa.csv", qubit_fname="quant_qubit.csv")
-        pooling(samplesheet=kwargs['samplesheet'], quant_csv="quant_combined.csv")
-    parser_pre.set_defaults(func=pipeline_pre)
+    parser_pre.add_argument("--cache-dir", help="Folder for intermediate results (default: .miseq_tools/<sample sheet name>)")
+    parser_pre.add_argument("--force", help="Rerun every stage even if its inputs are unchanged", action="store_true")
+    parser_pre.add_argument("--from-stage", help="Rerun this stage and every stage after it", choices=PRE_STAGES)
+    parser_pre.add_argument("--qubit-export", help="Qubit (Flex) or plate reader CSV export; pools missing from it are asked for")
+    parser_pre.add_argument("--qubit-wells", help="CSV with Well and Pool label columns, for exports that only name wells", dest="well_map")
+    parser_pre.add_argument("--no-prompt", help="Fail instead of asking for pools missing from the Qubit export, to run unattended", dest="prompt", action="store_false")
+    parser_pre.set_defaults(func=_lazy("pipeline:pipeline_pre"))
 
     parser_demux = subparsers.add_parser("demux", help="Demuxing stats", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser_demux.set_defaults(func=demux)
+    parser_demux.set_defaults(func=_lazy("demux_stats:demux"))
     parser_demux.add_argument("samplesheet", help="Sample sheet to use")
-    parser_demux.add_argument("stats", help="Stats.json file from Miseq")
+    parser_demux.add_argument("stats", help="Stats.json from bcl2fastq, Demultiplex_Stats.csv from BCL Convert, or a run folder containing either")
+    parser_demux.add_argument("-o", help="Output folder", dest="outdir", default=".")
+    parser_demux.add_argument("--max-mismatches", help="Unknown barcodes within this many mismatches (in each index) of just one sample are attributed to it", type=int, default=2)
+
+    parser_rebalance = subparsers.add_parser("rebalance", help="Pooling for a top-up run that makes up each pool's shortfall, with concentrations corrected by the demux results", parents=[pooling_options], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_rebalance.set_defaults(func=_lazy("rebalance:rebalance"))
+    parser_rebalance.add_argument("samplesheet", help="Sample sheet of the last run")
+    parser_rebalance.add_argument("quant_csv", help="Quantification data the last run was pooled with")
+    parser_rebalance.add_argument("stats", help="Stats.json from bcl2fastq, Demultiplex_Stats.csv from BCL Convert, or a run folder containing either")
+    parser_rebalance.add_argument("-o", help="Output folder for rebalance.csv", dest="outdir", default=".")
+
+    parser_render = subparsers.add_parser("render", help="Draw figures from the results saved by kapa, kapa-batch, combine and demux", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_render.set_defaults(func=_lazy("plots:render"))
+    parser_render.add_argument("folders", help="Folders with saved results", nargs="*", default=["."])
+    parser_render.add_argument("--workers", help="Number of worker processes (default: number of CPUs)", type=int)
+
+    parser_watch = subparsers.add_parser("watch", help="Run kapa and demux on qPCR exports and demux stats as they appear in these folders", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_watch.set_defaults(func=_lazy("watch:watch"))
+    parser_watch.add_argument("folders", help="Folders to watch, including subfolders", nargs="+")
+    parser_watch.add_argument("--samplesheet", help="Sample sheet for every run (default: the nearest CSV with Sample_ID and Pool label columns in or above each file's folder)")
+    parser_watch.add_argument("-o", help="Output folder, mirroring the watched folders (default: a miseq_tools folder next to each file)", dest="outdir")
+    parser_watch.add_argument("--interval", help="Seconds between scans", type=float, default=10)
+    parser_watch.add_argument("--settle", help="Seconds a file must be unchanged before it counts as finished", type=float, default=30)
+    parser_watch.add_argument("--workers", help="Number of worker processes (default: number of CPUs)", type=int)
+    parser_watch.add_argument("--state", help="Record of files already processed (default: .miseq_tools/watch.json)", dest="fname_state")
+    parser_watch.add_argument("--once", help="Process what's there now, wait for it to finish, and exit", action="store_true")
+
+    parser_serve = subparsers.add_parser("serve", help="Serve sheet, pool, kapa and demux as JSON endpoints, without paying for the imports on every call", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_serve.set_defaults(func=_lazy("serve:serve"))
+    parser_serve.add_argument("--host", help="Address to listen on", default="127.0.0.1")
+    parser_serve.add_argument("--port", help="Port to listen on", type=int, default=8000)
+    parser_serve.add_argument("--socket", help="Listen on this Unix socket instead of a TCP port")
+    parser_serve.add_argument("--workers", help="Number of requests to handle at once (default: a few more than the number of CPUs)", type=int)
+
+    parser_history = subparsers.add_parser("history", help="Results of past runs from a Parquet results store, as CSV", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_history.set_defaults(func=_lazy("store:history"))
+    parser_history.add_argument("store", help="Results store folder, as given to --store")
+    # keep in sync with store.TABLES
+    parser_history.add_argument("table", help="Results to read", choices=("kapa", "qubit", "combined", "demux"))
+    parser_history.add_argument("--since", help="Only runs on or after this date (YYYY-MM-DD)")
+    parser_history.add_argument("--until", help="Only runs on or before this date (YYYY-MM-DD)")
+    parser_history.add_argument("--run-id", help="Only this run (repeatable)", dest="run_ids", action="append")
+    parser_history.add_argument("--columns", help="Only these columns (repeatable)", action="append")
+    parser_history.add_argument("-o", help="Output CSV (default: stdout)", dest="fname_out")
 
     args = vars(parser.parse_args())
 
+    # global flags are passed on as environment variables, so worker processes see them too,
+    # and pre's stage cache (pipeline.ENV) knows when they change
+    if args.pop("no_plots", False):
+        os.environ["MISEQ_TOOLS_NO_PLOTS"] = "1"
+
+    if store := args.pop("results_store", None):
+        if importlib.util.find_spec("pyarrow") is None:
+            parser.error('--store needs pyarrow: pip install "miseq_tools[store]"')
+        os.environ["MISEQ_TOOLS_STORE"] = os.path.abspath(store)
+    for flag in ("run_id", "run_date"):
+        if value := args.pop(flag, None):
+            os.environ[f"MISEQ_TOOLS_{flag.upper()}"] = value
+
     if mpl_style := args.pop("mpl_style", None):
+        import matplotlib.pyplot as plt
         plt.style.use(mpl_style)
     if log_level := args.pop("log_level", None):
         logging.basicConfig(format='%(levelname)-10s%(message)s', level=log_level)
     func = args.pop("func")
 
-    func(**args)
+    fname_profile, fname_pstats = args.pop("fname_profile", None), args.pop("fname_pstats", None)
+    if fname_profile or fname_pstats:
+        profiling.start(pstats=bool(fname_pstats))
+    try:
+        func(**args)
+    finally:
+        profiling.finish(fname_profile, fname_pstats, command=sys.argv[1:])
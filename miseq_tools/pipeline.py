@@ -0,0 +1,103 @@
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+from typing import Callable
+from . import profiling
+
+PRE_STAGES = ("sheet", "kapa", "qubit", "combine", "pool")
+
+# global flags reach the stages as these environment variables, so they change what a stage does just like its params
+ENV = ("MISEQ_TOOLS_NO_PLOTS", "MISEQ_TOOLS_STORE", "MISEQ_TOOLS_RUN_ID", "MISEQ_TOOLS_RUN_DATE")
+
+@dataclasses.dataclass
+class Stage:
+    name: str
+    func: Callable[..., None]
+    inputs: list[str]
+    outputs: list[str]
+    params: dict = dataclasses.field(default_factory=dict)
+
+def pipeline_pre(samplesheet, kapafolder, cache_dir=None, force=False, from_stage=None, qubit_export=None, well_map=None, prompt=True):
+    from .samplesheet import format_samplesheet
+    from .quant_kapa import kapaquant
+    from .quant_qubit import qubitquant
+    from .quant_combine import quant_combine
+
+    if cache_dir is None:
+        cache_dir = os.path.join('.miseq_tools', os.path.splitext(os.path.basename(samplesheet))[0])
+    os.makedirs(cache_dir, exist_ok=True)
+    quant_kapa = os.path.join(cache_dir, 'quant_kapa.csv')
+    quant_qubit = os.path.join(cache_dir, 'quant_qubit.csv')
+    quant_combined = os.path.join(cache_dir, 'quant_combined.csv')
+    fname_pooling = os.path.join(cache_dir, 'pooling.txt')
+    stages = [
+        Stage('sheet', format_samplesheet, [samplesheet], ['samplesheet.csv'], dict(fname_in=samplesheet, fname_out='samplesheet.csv')),
+        Stage('kapa', kapaquant, [kapafolder, samplesheet], [quant_kapa], dict(kapafolder=kapafolder, samplesheet=samplesheet, dilution=1e4, standard_bp=399, outdir=cache_dir)),
+        Stage('qubit', qubitquant, [samplesheet] + [f for f in (qubit_export, well_map) if f], [quant_qubit], dict(samplesheet=samplesheet, outdir=cache_dir, qubit_export=qubit_export, well_map=well_map, prompt=prompt)),
+        Stage('combine', quant_combine, [quant_kapa, quant_qubit], [quant_combined], dict(kapa_fname=quant_kapa, qubit_fname=quant_qubit, outdir=cache_dir, samplesheet=samplesheet)),
+        Stage('pool', _pooling_to_file, [samplesheet, quant_combined], [fname_pooling], dict(samplesheet=samplesheet, quant_csv=quant_combined, fname_out=fname_pooling)),
+    ]
+    assert tuple(stage.name for stage in stages) == PRE_STAGES
+    run_stages(stages, cache_dir, force=force, from_stage=from_stage)
+    logging.info(f'Intermediate results are in {cache_dir}')
+    with open(fname_pooling, 'rt') as f:
+        print(f.read(), end='')
+
+def run_stages(stages: list[Stage], cache_dir: str, force: bool = False, from_stage: str = None):
+    # a stage is skipped if its inputs, parameters and outputs hash the same as on its last successful run;
+    # outputs too, as one outside the cache (samplesheet.csv) can be overwritten by a run for another sheet
+    assert from_stage is None or from_stage in [stage.name for stage in stages], f'Unknown stage {from_stage}'
+    fname_state = os.path.join(cache_dir, 'state.json')
+    try:
+        with open(fname_state, 'rt') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = dict()
+
+    for stage in stages:
+        force = force or stage.name == from_stage
+        fingerprint = _fingerprint(stage)
+        if not force and state.get(stage.name) == dict(fingerprint=fingerprint, outputs=_hash_outputs(stage)):
+            logging.info(f'Skipping {stage.name}: up to date')
+            profiling.count('stages_skipped')
+            continue
+        logging.info(f'Running {stage.name}')
+        with profiling.stage(stage.name):
+            stage.func(**stage.params)
+        state[stage.name] = dict(fingerprint=fingerprint, outputs=_hash_outputs(stage))
+        with open(f'{fname_state}.tmp', 'wt') as f:
+            json.dump(state, f, indent=2)
+        os.replace(f'{fname_state}.tmp', fname_state)
+
+def _fingerprint(stage: Stage) -> str:
+    h = hashlib.sha256()
+    h.update(stage.name.encode())
+    h.update(json.dumps(stage.params, sort_keys=True, default=str).encode())
+    h.update(json.dumps({name: os.environ.get(name) for name in ENV}, sort_keys=True).encode())
+    for path in stage.inputs:
+        for fname in _files(path):
+            h.update(fname.encode())
+            h.update(_hash_file(fname).encode())
+    return h.hexdigest()
+
+def _hash_outputs(stage: Stage) -> dict[str, str | None]:
+    return {fname: _hash_file(fname) if os.path.exists(fname) else None for fname in stage.outputs}
+
+def _files(path: str) -> list[str]:
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(dirpath, fname) for dirpath, _, filenames in os.walk(path) for fname in filenames)
+
+def _hash_file(fname: str) -> str:
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _pooling_to_file(samplesheet, quant_csv, fname_out):
+    from .pooling import _solve, _format_pools
+    with open(fname_out, 'wt') as f:
+        f.write(_format_pools(_solve(samplesheet, quant_csv)) + '\n')
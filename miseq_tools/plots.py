@@ -0,0 +1,143 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+# matplotlib and seaborn are only imported once something is actually plotted
+
+def enabled() -> bool:
+    # set by the global --no-plots flag
+    return not os.environ.get('MISEQ_TOOLS_NO_PLOTS')
+
+def _pyplot():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def render(folders: list[str], workers: int = None):
+    # rebuild figures from the results a previous run saved in each folder
+    jobs = []
+    for folder in folders:
+        files = set(os.listdir(folder))
+        path = lambda fname: os.path.join(folder, fname)
+        if 'quant_kapa_wells.csv' in files:
+            jobs.append((_render_kapa, path('quant_kapa_wells.csv'), folder))
+        if {'quant_kapa.csv', 'quant_qubit.csv'} <= files:
+            jobs.append((_render_combined, path('quant_kapa.csv'), path('quant_qubit.csv'), path('quant_combined.pdf')))
+        if 'demux_stats.csv' in files:
+            jobs.append((_render_demux, path('demux_stats.csv'), path('demux_stats.pdf')))
+    if not jobs:
+        logging.warning(f'Nothing to render in {", ".join(folders)}')
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(*job) for job in jobs]
+        for future in futures:
+            future.result()
+
+def _render_kapa(fname_wells, outdir):
+    import pandas as pd
+    wells = pd.read_csv(fname_wells)
+    # wells from kapa-batch are tagged by plate
+    if 'plate' in wells.columns:
+        for plate, plate_wells in wells.groupby('plate', sort=False):
+            plot_standards(plate_wells, os.path.join(outdir, f'{plate}_quant_kapa_standards.pdf'))
+            plot_wells(plate_wells, os.path.join(outdir, f'{plate}_quant_kapa.pdf'))
+    else:
+        plot_standards(wells, os.path.join(outdir, 'quant_kapa_standards.pdf'))
+        plot_wells(wells, os.path.join(outdir, 'quant_kapa.pdf'))
+
+def _render_combined(fname_kapa, fname_qubit, fname):
+    import pandas as pd
+    plot_combined(pd.read_csv(fname_kapa, index_col=0), pd.read_csv(fname_qubit, index_col=0), fname)
+
+def _render_demux(fname_pools, fname):
+    import pandas as pd
+    plot_demux(pd.read_csv(fname_pools, index_col=0), fname)
+
+def plot_standards(wells, fname, fit: dict = None):
+    import numpy as np
+    plt = _pyplot()
+    data = wells[wells['Pool label'] == 'Standards'].groupby('Content')[['Cq', 'SQ']].mean()
+    x = np.log10(data.SQ * 1e12) # pM
+    y = data.Cq
+    if fit is None:
+        import scipy.stats
+        fit = scipy.stats.linregress(x, y)._asdict()
+    fig, ax = plt.subplots()
+    ax.scatter(x, y)
+    ax.plot(x, fit['slope'] * x + fit['intercept'], 'r')
+    ax.set_xlabel('log10(pM)')
+    ax.set_ylabel('Cq')
+    ax.set_title('Standard curve')
+    fig.savefig(fname, bbox_inches='tight')
+    plt.close(fig)
+
+def plot_wells(wells, fname, order=None):
+    import numpy as np
+    import seaborn as sns
+    plt = _pyplot()
+    std = wells[wells['Pool label'] == 'Standards']
+    if order is None:
+        order = wells.loc[wells['Pool label'] != 'Standards', 'Pool label'].unique().tolist()
+    fig, ax = plt.subplots()
+    # wells saved before replicate QC have no outlier column
+    sns.swarmplot(data=wells, x='Pool label', y='Cq', ax=ax, order=["Standards"] + order, hue='outlier' if 'outlier' in wells.columns else None)
+    ax.set_xlabel("")
+    for tick in ax.get_xticklabels():
+        tick.set_rotation(45)
+        tick.set_ha('right')
+    range_cq = std.Cq.min(), std.Cq.max()
+    range_cq_diff = range_cq[1] - range_cq[0]
+    ax.set_ylim(range_cq[0] - 0.1 * range_cq_diff, range_cq[1] + 0.1 * range_cq_diff)
+    ax.yaxis.set_major_locator(plt.MaxNLocator(integer=True))
+    # second y-axis
+    ax2 = ax.twinx()
+    ax2.set_ylabel('Concentration (pM)')
+    range_sq = std.SQ.max(), std.SQ.min()
+    range_sq_log = np.log10(range_sq) + 12 # convert M to pM
+    range_sq_log_diff = range_sq_log[0] - range_sq_log[1]
+    ax2.set_ylim(np.power(10, [range_sq_log[0] + 0.1 * range_sq_log_diff, range_sq_log[1] - 0.1 * range_sq_log_diff]))
+    ax2.set_yscale("log")
+    ax2.spines['right'].set_visible(True)
+    fig.savefig(fname, bbox_inches='tight')
+    plt.close(fig)
+
+def plot_combined(kapa, qubit, fname):
+    # matched by pool label, as the two files can list pools in any order
+    qubit = qubit.reindex(kapa.index)
+    plt = _pyplot()
+    fig, ax = plt.subplots()
+    ax.scatter(qubit['nM'], kapa['nM'])
+    ax.set_xlabel('Qubit nM')
+    ax.set_ylabel('KAPA nM')
+    lim_max = 1.1 * max(kapa['nM'].max(), qubit['nM'].max())
+    ax.set_xlim(0, lim_max)
+    ax.set_ylim(0, lim_max)
+    ax.set_aspect('equal')
+    ax.plot([0, lim_max], [0, lim_max], 'k')
+    for i, nM, nM2 in zip(qubit.index, qubit["nM"], kapa["nM"]):
+        ax.annotate(xy=(nM, nM2), text=i, xytext=(5, 0), textcoords='offset points', ha='left', va='center')
+    fig.savefig(fname, bbox_inches='tight')
+    plt.close(fig)
+
+def plot_demux(df_pool, fname):
+    import numpy as np
+    plt = _pyplot()
+    lim_min = min(df_pool['intended'].min(), df_pool['actual'].min())
+    lim_max = max(df_pool['intended'].max(), df_pool['actual'].max())
+    lim_range = np.log10(lim_max) - np.log10(lim_min)
+    lim = np.log10(lim_min) - 0.1 * lim_range, np.log10(lim_max) + 0.1 * lim_range
+    lim = 10 ** np.array(lim)
+    fig, ax = plt.subplots(figsize=(3, 3))
+    ax.plot(np.linspace(*lim), np.linspace(*lim), color="k", linewidth=0.5)
+    ax.scatter(df_pool["intended"], df_pool["actual"])
+    for label, row in df_pool.iterrows():
+        ax.annotate(xy=(row["intended"], row["actual"]), text=label, ha="left", va="center", xytext=(5, 0), textcoords="offset points", fontsize=6)
+    ax.set_xscale("log")
+    ax.set_yscale("log")
+    ax.set_xlim(*lim)
+    ax.set_ylim(*lim)
+    ax.set_xlabel("Intended num reads")
+    ax.set_ylabel("Actual num reads")
+    fig.savefig(fname, bbox_inches="tight")
+    plt.close(fig)
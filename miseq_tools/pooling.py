@@ -1,20 +1,171 @@
 import pandas as pd
-from .utils import parse_samplesheet, pooled_reads
+import numpy as np
+import os
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from .utils import load_samplesheet, pooled_reads, read_manifest, capture_errors
+from . import profiling
 
 def pooling(samplesheet: str, quant_csv: str, **kwargs):
-    samples = parse_samplesheet(samplesheet)
-    num_reads = (pooled_reads(samples) * 1e6).astype(int)
-    concs = pd.read_csv(quant_csv, index_col=0)["nM"]
-    pools = _pools(num_reads, concs, **kwargs)
-    _check_samples_used_exactly_once(pools, set(num_reads.index))
-    _check_dilution(pools, num_reads, concs)
+    pools = _solve(samplesheet, quant_csv, **kwargs)
+    with profiling.stage('write'):
+        print(_format_pools(pools))
+
+def pool_batch(manifest: str, outdir: str = '.', workers: int = None, **kwargs):
+    runs = read_manifest(manifest, ['samplesheet', 'quant_csv'], 'run', 'samplesheet')
+    os.makedirs(outdir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(capture_errors, _solve, row.samplesheet, row.quant_csv, **kwargs) for row in runs.itertuples()]
+        results = [future.result() for future in futures]
+
+    summary = []
+    for run, (pools, error) in zip(runs['run'], results):
+        if error is not None:
+            logging.error(f'{run}: {error}')
+            summary.append(dict(run=run, status='failed', pools=0, samples=0, ul_total=np.nan, error=error))
+            continue
+        with open(os.path.join(outdir, f'{run}_pooling.txt'), 'wt') as f:
+            f.write(_format_pools(pools) + '\n')
+        summary.append(dict(
+            run=run,
+            status='ok',
+            pools=len(pools),
+            samples=sum(len(set(pool) - {'Water', 'Prev Pool'}) for pool in pools),
+            ul_total=sum(pools[-1].values()),
+            error='',
+        ))
+    summary = pd.DataFrame(summary).set_index('run')
+    summary.to_csv(os.path.join(outdir, 'pooling_batch.csv'))
+    print(summary.drop(columns='error').to_string())
+
+def _solve(samplesheet: str, quant_csv: str, **kwargs) -> list[dict[str, float]]:
+    with profiling.stage('parse'):
+        num_reads = (pooled_reads(load_samplesheet(samplesheet)) * 1e6).astype(int)
+        concs = pd.read_csv(quant_csv, index_col=0)["nM"]
+    with profiling.stage('solve'):
+        pools = _pools(num_reads, concs, **kwargs)
+    with profiling.stage('validate'):
+        _check_samples_used_exactly_once(pools, set(num_reads.index))
+        _check_dilution(pools, num_reads, concs)
+    return pools
+
+def _format_pools(pools: list[dict[str, float]]) -> str:
+    lines = []
     for i, pool in enumerate(pools, 1):
-        print(f"Pool {i}")
+        lines.append(f"Pool {i}")
         # show water first, then descending order of volume
         for sample, ul in sorted(pool.items(), key=lambda item: (item[0] == 'Water', item[1]), reverse=True):
-            print(f"[ ] {sample:<10}:\t{ul:.2f} uL")
+            lines.append(f"[ ] {sample:<10}:\t{ul:.2f} uL")
+    return "\n".join(lines)
 
 def _pools(num_reads: dict[str, int],
+           concs: dict[str, float],
+           min_ul_pipettable: float = 2,
+           max_ul_pipettable: float = 10,
+           min_ul_total: float = 10,
+           solver: str = 'fast',
+           time_limit: float = 60,
+           ) -> list[dict[str, float]]:
+    # only the exact solver searches, so only it takes a time limit
+    pools = SOLVERS[solver](num_reads, concs,
+                            min_ul_pipettable=min_ul_pipettable,
+                            max_ul_pipettable=max_ul_pipettable,
+                            min_ul_total=min_ul_total,
+                            **(dict(time_limit=time_limit) if solver == 'milp' else {}))
+    _check_volumes(pools, min_ul_pipettable, max_ul_pipettable)
+    return pools
+
+def _pools_fast(num_reads: dict[str, int],
+                concs: dict[str, float],
+                min_ul_pipettable: float = 2,
+                max_ul_pipettable: float = 10,
+                min_ul_total: float = 10,
+                max_iter: int = 1000,
+                ) -> list[dict[str, float]]:
+    num_reads = pd.Series(num_reads)
+    concs = pd.Series(concs).reindex(num_reads.index)
+    assert not concs.isna().any(), f"Missing concentration for {concs.index[concs.isna()].tolist()}"
+    names = num_reads.index.to_numpy()
+    assert all(not str(sample_name).startswith('Water') for sample_name in names)
+    assert all(not sample_name == 'Prev Pool' for sample_name in names)
+    reads = num_reads.to_numpy(dtype=float)
+    ul = min_ul_total * (reads / reads.sum() * 4) / concs.to_numpy(dtype=float)
+    ul_water = min_ul_total - ul.sum()
+    assert ul_water >= 0, "Some sample(s) is/are not concentrated enough."
+
+    # sample volumes never change, so sort them once; only the few water entries move between iterations
+    order = np.argsort(ul, kind='stable')
+    ul_sorted = ul[order]
+    # water entries keyed by split number: 0 is 'Water', i is 'Water i'
+    water = {0: ul_water}
+
+    for _ in range(max_iter):
+        profiling.count('pools_iterations')
+        # merge water entries into the sorted sample volumes; water keys are encoded as -1 - i
+        water_keys = np.array([i for i, v in water.items() if v != 0], dtype=int)
+        water_ul = np.array([water[i] for i in water_keys], dtype=float)
+        water_order = np.argsort(water_ul, kind='stable')
+        water_keys, water_ul = water_keys[water_order], water_ul[water_order]
+        pos = np.searchsorted(ul_sorted, water_ul, side='right')
+        vols = np.insert(ul_sorted, pos, water_ul)
+        keys = np.insert(order, pos, -1 - water_keys)
+        tiers = _tiers(vols, min_ul_pipettable, max_ul_pipettable)
+        ul_cumsum = np.cumsum(vols)
+
+        # check previous pool volumes and dilute with water if necessary
+        for i, (start, stop, dilution_factor) in enumerate(tiers, 1):
+            if start == 0:
+                continue
+            ul_prev_pool = ul_cumsum[start - 1] * dilution_factor
+            if ul_prev_pool >= min_ul_pipettable:
+                continue
+            ul_water_split = (max_ul_pipettable - ul_prev_pool) / dilution_factor
+            if i >= 2:
+                ul_water_split = min(ul_water_split, max_ul_pipettable / tiers[i - 2][2])
+            # without enough water left to split off, tiers collapse into one with unpipettable volumes
+            assert water[0] >= ul_water_split, f"No pooling plan within {min_ul_pipettable}-{max_ul_pipettable} uL: not enough water to dilute pool {i - 1}; try --solver milp"
+            water[0] -= ul_water_split
+            water[i] = water.get(i, 0) + ul_water_split
+            break
+        else:
+            break
+    else:
+        raise RuntimeError(f"Pooling did not converge after {max_iter} iterations; try --solver milp")
+
+    # calculate volumes per pool
+    pools = []
+    for start, stop, dilution_factor in tiers:
+        pool = dict()
+        ul_diluted = vols[start:stop] * dilution_factor
+        for key, ul_sample in zip(keys[start:stop].tolist(), ul_diluted.tolist()):
+            if key < 0:
+                pool['Water'] = pool.get('Water', 0) + ul_sample
+            else:
+                pool[names[key]] = ul_sample
+        if start > 0:
+            pool['Prev Pool'] = ul_cumsum[start - 1] * dilution_factor
+        pools.append(pool)
+
+    return pools
+
+# split ascending volumes into (start, stop, dilution factor) tiers, most diluted first
+def _tiers(vols: np.ndarray, min_ul_pipettable: float, max_ul_pipettable: float) -> list[tuple[int, int, float]]:
+    profiling.count('assign_dilution_factors')
+    tiers = []
+    start = 0
+    while start < len(vols):
+        dilution_factor = min_ul_pipettable / vols[start]
+        if dilution_factor <= 1:
+            tiers.append((start, len(vols), 1.0))
+            break
+        stop = start + np.searchsorted(vols[start:] * dilution_factor, max_ul_pipettable, side='right')
+        stop = max(stop, start + 1)
+        tiers.append((start, stop, dilution_factor))
+        start = stop
+    return tiers
+
+def _pools_legacy(num_reads: dict[str, int],
            concs: dict[str, float],
            min_ul_pipettable: float = 2,
            max_ul_pipettable: float = 10,
@@ -32,6 +183,7 @@ def _pools(num_reads: dict[str, int],
 
     # initial assign dilution factor groups
     def _assign_dilution_factors(_ul):
+        profiling.count('assign_dilution_factors')
         _dilution_factors = pd.Series(None, index=_ul.index, dtype=float)
         while any(_dilution_factors.isna()):
             remaining_samples = _dilution_factors[_dilution_factors.isna()].index
@@ -66,6 +218,7 @@ def _pools(num_reads: dict[str, int],
     ul_old = None
     ul_new = ul.copy()
     while ul_old is None or not ul_old.equals(ul_new):
+        profiling.count('pools_iterations')
         ul_old = ul_new.copy()
         dilution_factors = _assign_dilution_factors(ul_new)
         ul_new = _split_water(ul_new, dilution_factors)
@@ -89,6 +242,194 @@ def _pools(num_reads: dict[str, int],
 
     return pools
 
+def _pools_milp(num_reads: dict[str, int],
+                concs: dict[str, float],
+                min_ul_pipettable: float = 2,
+                max_ul_pipettable: float = 10,
+                min_ul_total: float = 10,
+                max_ul_total: float = None,
+                time_limit: float = 60,
+                ) -> list[dict[str, float]]:
+    # Pooling as a mixed-integer linear program: pick the tier of every sample, where water goes, and each tier's
+    # dilution, so every volume is pipettable with as few tiers and water additions as possible.
+    # Tiers are numbered from the most diluted. With e[k] the undiluted volume that becomes 1 uL in tier k,
+    # a sample of undiluted volume u in tier k is pipetted as u / e[k], so every bound is linear in e:
+    #   min_ul_pipettable * e[k] <= u <= max_ul_pipettable * e[k]
+    # and the same holds for water. The previous pool's undiluted volume is the sum of all earlier tiers;
+    # as in the other solvers it only has a minimum, since a large transfer can be pipetted in several goes.
+    # The final pool is at most max_ul_total (default: min_ul_total), or a single huge pool would always do.
+    # time_limit bounds the whole search, however many models it takes.
+    # The greedy plan, where there is one, bounds the search and is kept unless the search finds a better one in time.
+    start = time.monotonic()
+    num_reads = pd.Series(num_reads)
+    concs = pd.Series(concs).reindex(num_reads.index)
+    assert not concs.isna().any(), f"Missing concentration for {concs.index[concs.isna()].tolist()}"
+    assert all(not str(sample_name).startswith('Water') for sample_name in num_reads.index)
+    assert all(not sample_name == 'Prev Pool' for sample_name in num_reads.index)
+    reads = num_reads.to_numpy(dtype=float)
+    ul = min_ul_total * (reads / reads.sum() * 4) / concs.to_numpy(dtype=float)
+    ul_water = min_ul_total - ul.sum()
+    assert ul_water >= 0, "Some sample(s) is/are not concentrated enough."
+
+    # the most diluted samples go in the earliest tiers, so tiers are contiguous runs of the sorted volumes
+    order = np.argsort(ul, kind='stable')
+    u = ul[order]
+    # keep clear of the bounds so solver tolerance can't put a volume just outside them
+    lo, hi = min_ul_pipettable * (1 + 1e-6), max_ul_pipettable * (1 - 1e-6)
+    e_final = min_ul_total / (max_ul_total or min_ul_total)
+
+    # the model grows with the number of tiers allowed, so start from the fewest that could work: samples too dilute
+    # for the final pool need tiers spanning at most max/min each, then there is the final pool
+    n_tiers, i = 1, 0
+    while i < len(u) and u[i] < lo * e_final:
+        n_tiers += 1
+        i = np.searchsorted(u, u[i] * hi / lo, side='right')
+    # very dilute samples can also need tiers of just water to step the dilution down
+    max_tiers = max(n_tiers, len(u) + 1 + int(np.ceil(np.log(lo / u[0]) / np.log(hi / lo))))
+
+    # costed as in _solve_milp: each tier as much as two water additions
+    try:
+        fast = _pools_fast(num_reads, concs, min_ul_pipettable, max_ul_pipettable, min_ul_total)
+        _check_volumes(fast, min_ul_pipettable, max_ul_pipettable)
+        fast_cost = 2 * len(fast) + sum('Water' in pool for pool in fast)
+    except (AssertionError, RuntimeError):
+        fast, fast_cost = None, np.inf
+    # no plan has fewer tiers than n_tiers, or no water addition if there is any water
+    if fast_cost <= 2 * n_tiers + (ul_water > 0):
+        return fast
+    # a plan with more tiers than this costs more than the greedy one whatever its water
+    max_tiers = min(max_tiers, (fast_cost - 1) // 2) if fast is not None else max_tiers
+
+    deadline = start + time_limit
+    while (solution := _solve_milp(u, ul_water, n_tiers, lo, hi, e_final, deadline - time.monotonic())) is None:
+        if fast is not None and (time.monotonic() >= deadline or n_tiers >= max_tiers):
+            if time.monotonic() >= deadline:
+                logging.warning(f"No better pooling plan than the greedy one found within {time_limit} s")
+            return fast
+        assert time.monotonic() < deadline, f"No pooling plan found within {time_limit} s"
+        assert n_tiers < max_tiers, f"No pooling plan within {min_ul_pipettable}-{max_ul_pipettable} uL"
+        n_tiers += 1
+    # an extra tier costs as much as two water additions, so more tiers only help if they save at least three;
+    # this only improves a plan we already have, so it gets no longer than finding that plan took
+    tier, e, water = solution
+    if (extra := min((np.count_nonzero(water) - 1) // 2, max_tiers - n_tiers)) > 0:
+        elapsed = time.monotonic() - start
+        if (better := _solve_milp(u, ul_water, n_tiers + extra, lo, hi, e_final, min(deadline - time.monotonic(), max(elapsed, 1)))) is not None:
+            tier, e, water = better
+    if fast_cost < 2 * len(e) + np.count_nonzero(water):
+        return fast
+
+    names = num_reads.index[order]
+    pools = []
+    ul_prev = 0
+    for k in range(len(e)):
+        pool = {name: float(ul_sample / e[k]) for name, ul_sample in zip(names[tier == k], u[tier == k])}
+        if water[k] > 0:
+            pool['Water'] = float(water[k] / e[k])
+        if k > 0:
+            pool['Prev Pool'] = float(ul_prev / e[k])
+        ul_prev += u[tier == k].sum() + water[k]
+        pools.append(pool)
+    _check_dilution(pools, num_reads, concs)
+    return pools
+
+def _solve_milp(u: np.ndarray, ul_water: float, K: int, lo: float, hi: float, e_final: float, time_limit: float):
+    # returns the tier of each sample, and e and the undiluted water of each tier, or None if there is no plan with K tiers
+    # or none was found within time_limit
+    if time_limit <= 0:
+        return None
+    import scipy.optimize
+    import scipy.sparse
+    n = len(u)
+    # variables: s[i, k - 1] sample i is in tier k or later (k >= 1), y[k] tier k is used, z[k] tier k gets water,
+    # e[k] as above (at most 1, so the final pool is at least min_ul_total), w[k] undiluted water in tier k
+    s = np.arange(n * (K - 1)).reshape(n, K - 1)
+    y, z, e, w = (s.size + np.arange(K) + j * K for j in range(4))
+    n_vars = s.size + 4 * K
+    rows, cols, vals, lbs, ubs = [], [], [], [], []
+    def constrain(terms, lb=-np.inf, ub=np.inf):
+        for col, val in terms:
+            rows.append(len(lbs))
+            cols.append(col)
+            vals.append(val)
+        lbs.append(lb)
+        ubs.append(ub)
+    def in_tier(i, k, coef):
+        # sample i is in tier k: s[i, k] - s[i, k + 1], where s[i, 0] = 1 and s[i, K] = 0; returns terms and constant
+        terms = [(s[i, k - 1], coef)] if k > 0 else []
+        if k + 1 < K:
+            terms.append((s[i, k], -coef))
+        return terms, coef if k == 0 else 0
+
+    for i in range(n):
+        for k in range(K):
+            if k + 1 < K:
+                if k > 0:
+                    constrain([(s[i, k], 1), (s[i, k - 1], -1)], ub=0)
+                if i + 1 < n:
+                    constrain([(s[i, k], 1), (s[i + 1, k], -1)], ub=0)
+            # divided through by u[i]: the solver's feasibility tolerance is absolute, and e is tiny in the most diluted tiers
+            if u[i] < lo:
+                terms, const = in_tier(i, k, lo / u[i] - 1)
+                constrain([(e[k], lo / u[i]), *terms], ub=lo / u[i] - const)
+            if k + 1 < K:
+                terms, const = in_tier(i, k, 1)
+                constrain([*terms, (y[k + 1], 1), (e[k], -hi / u[i])], ub=1 - const)
+    for k in range(K):
+        if k > 0:
+            # a tier is used if any sample reaches it, and tiers are used in order
+            constrain([(s[n - 1, k - 1], 1), (y[k], -1)], ub=0)
+            constrain([(y[k], 1), (y[k - 1], -1)], ub=0)
+            constrain([(e[k - 1], 1), (e[k], -1)], ub=0)
+        # the last tier makes the final pool, of min_ul_total / e[k] uL
+        constrain([(e[k], 1), (y[k], -1), *([(y[k + 1], 1)] if k + 1 < K else [])], lb=e_final - 1)
+        # water
+        constrain([(z[k], 1), (y[k], -1)], ub=0)
+        constrain([(w[k], 1), (z[k], -ul_water)], ub=0)
+        constrain([(e[k], lo), (w[k], -1), (z[k], lo)], ub=lo)
+        if k + 1 < K:
+            constrain([(w[k], 1), (e[k], -hi), (y[k + 1], ul_water)], ub=ul_water)
+        # previous pool: everything in tiers before k
+        if k > 0:
+            constrain([(e[k], lo), (y[k], lo), *((s[i, k - 1], u[i]) for i in range(n)), *((w[j], -1) for j in range(k))], ub=lo + u.sum())
+    constrain(zip(w, np.ones(K)), ul_water, ul_water)
+
+    # each tier costs a pool and a transfer, each water addition a pipetting step; then prefer the least dilution
+    cost = np.zeros(n_vars)
+    cost[y] = 2
+    cost[z] = 1
+    cost[e] = -1e-3
+    lower, upper = np.zeros(n_vars), np.ones(n_vars)
+    lower[y[0]] = 1
+    upper[w] = ul_water
+    integrality = np.ones(n_vars)
+    integrality[e] = integrality[w] = 0
+    result = scipy.optimize.milp(
+        cost,
+        constraints=scipy.optimize.LinearConstraint(scipy.sparse.csr_array((vals, (rows, cols)), shape=(len(lbs), n_vars)), lbs, ubs),
+        integrality=integrality,
+        bounds=scipy.optimize.Bounds(lower, upper),
+        # the integer part of the cost is at most a few dozen, so 1% is enough to prove it optimal
+        options=dict(time_limit=time_limit, mip_rel_gap=1e-2),
+    )
+    # infeasible, or out of time; a solution cut short by the time limit isn't trusted
+    if result.status in (1, 2):
+        return None
+    assert result.x is not None, f"Pooling solver failed: {result.message}"
+    x = result.x
+    used = int(np.rint(x[y]).sum())
+    tier = np.rint(x[s]).sum(axis=1).astype(int)
+    water = np.where(np.rint(x[z]) > 0, x[w], 0)[:used]
+    if water.sum():
+        water *= ul_water / water.sum()
+    return tier, x[e][:used], water
+
+SOLVERS = {
+    'fast': _pools_fast,
+    'legacy': _pools_legacy,
+    'milp': _pools_milp,
+}
+
 def _check_dilution(pools: list[dict[str, float]], num_reads: pd.Series, concs: pd.Series):
     volume_so_far = pd.Series(0, index=num_reads.index, dtype=float)
     for pool in pools:
@@ -102,6 +443,16 @@ def _check_dilution(pools: list[dict[str, float]], num_reads: pd.Series, concs:
     fracs_final = concs_final / 4
     pd.testing.assert_series_equal(fracs_final[num_reads.index], num_reads / num_reads.sum(), check_names=False)
 
+def _check_volumes(pools: list[dict[str, float]], min_ul_pipettable: float, max_ul_pipettable: float):
+    # everything is at least pipettable; the final pool, previous pool transfers and water (which may be several
+    # additions) can exceed the maximum, as they are pipetted in several goes
+    tol = 1e-6
+    for i, pool in enumerate(pools, 1):
+        for sample, ul in pool.items():
+            assert ul >= min_ul_pipettable * (1 - tol), f"{sample} in pool {i} is {ul:.3g} uL, below the {min_ul_pipettable} uL minimum"
+            if i < len(pools) and sample not in ('Prev Pool', 'Water'):
+                assert ul <= max_ul_pipettable * (1 + tol), f"{sample} in pool {i} is {ul:.3g} uL, above the {max_ul_pipettable} uL maximum"
+
 def _check_samples_used_exactly_once(pools: list[dict[str, float]], all_samples: set[str]):
     unused_samples = all_samples.copy()
     for pool in pools:
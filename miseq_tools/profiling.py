@@ -0,0 +1,85 @@
+import collections
+import contextlib
+import json
+import os
+import time
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+# only the process that ran --profile is traced; worker processes are not
+_trace = None
+
+class _Trace:
+    def __init__(self, pstats=False):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.stages = []
+        # names of the stages currently running, so nested stages are recorded as e.g. kapa/fit
+        self.stack = []
+        self.counters = collections.Counter()
+        self.profiler = None
+        if pstats:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+def start(pstats=False):
+    global _trace
+    _trace = _Trace(pstats)
+
+def finish(fname_trace=None, fname_pstats=None, **info):
+    global _trace
+    trace, _trace = _trace, None
+    if trace is None:
+        return
+    if trace.profiler is not None:
+        trace.profiler.disable()
+        if fname_pstats:
+            trace.profiler.dump_stats(fname_pstats)
+    if fname_trace:
+        with open(fname_trace, 'wt') as f:
+            json.dump(dict(
+                **info,
+                wall_s=time.perf_counter() - trace.start_wall,
+                cpu_s=time.process_time() - trace.start_cpu,
+                peak_rss_bytes=_peak_rss(),
+                stages=trace.stages,
+                counters=dict(trace.counters),
+            ), f, indent=2)
+
+@contextlib.contextmanager
+def stage(name):
+    if _trace is None:
+        yield
+        return
+    _trace.stack.append(name)
+    path = '/'.join(_trace.stack)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        _trace.stack.pop()
+        _trace.stages.append(dict(
+            name=path,
+            start_s=start_wall - _trace.start_wall,
+            wall_s=time.perf_counter() - start_wall,
+            cpu_s=time.process_time() - start_cpu,
+            # the process's high-water mark so far, not the stage's own peak; it never falls, so only a rise
+            # marks a stage that set a new peak
+            process_peak_rss_bytes=_peak_rss(),
+        ))
+
+def count(name, n=1):
+    if _trace is not None:
+        _trace.counters[name] += n
+
+def _peak_rss():
+    # peak memory of the process since it started
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if os.uname().sysname == 'Darwin' else rss * 1024
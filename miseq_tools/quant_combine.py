@@ -1,28 +1,44 @@
 import pandas as pd
-import matplotlib.pyplot as plt
+import os
+import logging
+from . import plots, profiling, store
 
-def quant_combine(kapa_fname, qubit_fname):
+# fewer pools than this in the stored history and calibrated falls back to the mean
+MIN_CALIBRATION_POOLS = 20
 
-    kapa = pd.read_csv(kapa_fname, index_col=0)
-    qubit = pd.read_csv(qubit_fname, index_col=0)
+def quant_combine(kapa_fname, qubit_fname, outdir='.', calibrated=False, fname_model=None, samplesheet=None):
 
-    fig, ax = plt.subplots()
-    ax.scatter(qubit['nM'], kapa['nM'])
-    ax.set_xlabel('Qubit nM')
-    ax.set_ylabel('KAPA nM')
-    lim_max = 1.1 * max(kapa['nM'].max(), qubit['nM'].max())
-    ax.set_xlim(0, lim_max)
-    ax.set_ylim(0, lim_max)
-    ax.set_aspect('equal')
-    ax.plot([0, lim_max], [0, lim_max], 'k')
-    for (i, nM), (j, nM2) in zip(qubit["nM"].items(), kapa["nM"].items()):
-        ax.annotate(xy=(nM, nM2), text=i, xytext=(5, 0), textcoords='offset points', ha='left', va='center')
-        assert i == j
-    fig.savefig('quant_combined.pdf', bbox_inches='tight')
-    plt.close(fig)
+    with profiling.stage('parse'):
+        kapa = pd.read_csv(kapa_fname, index_col=0)
+        qubit = pd.read_csv(qubit_fname, index_col=0)
+    missing = kapa.index.symmetric_difference(qubit.index)
+    assert missing.empty, f'Pools not in both KAPA and Qubit data: {", ".join(map(str, missing))}'
+    # aligned by pool label, so the two files can list pools in any order
+    qubit = qubit.reindex(kapa.index)
+
+    if plots.enabled():
+        with profiling.stage('plot'):
+            plots.plot_combined(kapa, qubit, os.path.join(outdir, 'quant_combined.pdf'))
 
     df_out = kapa['bp'].to_frame()
     assert (kapa['bp'] == qubit['bp']).all()
     df_out[['ng/uL', 'nM']] = ((kapa[['ng/uL', 'nM']] + qubit[['ng/uL', 'nM']]) / 2)
+    if calibrated:
+        with profiling.stage('calibrate'):
+            _calibrate(df_out, kapa, qubit, fname_model)
+
+    with profiling.stage('write'):
+        df_out.to_csv(os.path.join(outdir, 'quant_combined.csv'))
+        # both measurements too, so KAPA/Qubit agreement can be followed across runs
+        store.record('combined', df_out.assign(**{'KAPA nM': kapa['nM'], 'Qubit nM': qubit['nM']}), samplesheet)
 
-    df_out.to_csv('quant_combined.csv')
+def _calibrate(df_out, kapa, qubit, fname_model=None):
+    from . import calibration
+    assert store.enabled(), 'Calibrated combine learns from past runs, so needs the global --store flag'
+    model = calibration.update(os.environ['MISEQ_TOOLS_STORE'], fname_model)
+    if model['n'] < MIN_CALIBRATION_POOLS:
+        logging.warning(f'Only {model["n"]} pools with demux results in the store, need {MIN_CALIBRATION_POOLS} to calibrate; using the mean of KAPA and Qubit')
+        return
+    logging.info(f'Calibration: {", ".join(f"{name} {coef:.3f}" for name, coef in zip(model["features"], model["coef"]))}')
+    df_out['nM'] = calibration.apply(model, kapa['nM'], qubit['nM'], kapa['bp'])
+    df_out['ng/uL'] = df_out['nM'] * df_out['bp'] * 617.9 * 1e-6
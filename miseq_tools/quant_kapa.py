@@ -3,27 +3,126 @@ import os
 import numpy as np
 import scipy.stats
 import logging
-from .utils import parse_samplesheet, pooled_bp
-import matplotlib.pyplot as plt
-import seaborn as sns
+from concurrent.futures import ProcessPoolExecutor
+from .utils import load_samplesheet, pooled_bp, read_manifest, capture_errors
+from . import plots, profiling, store
 
-def kapaquant(kapafolder, samplesheet, dilution, standard_bp: int):
-    samples = parse_samplesheet(samplesheet)
-    amplicon_sizes = pooled_bp(samples)
+def kapaquant(kapafolder, samplesheet, dilution, standard_bp: int, outdir='.', drop_outliers=False, outlier_z=3.5, outlier_min_cq=0.5):
+    wells, fit, quant = _kapaquant(kapafolder, samplesheet, dilution, standard_bp, drop_outliers, outlier_z, outlier_min_cq)
+    with profiling.stage('write'):
+        quant.to_csv(os.path.join(outdir, 'quant_kapa.csv'))
+        wells.to_csv(os.path.join(outdir, 'quant_kapa_wells.csv'), index=False)
+        store.record('kapa', quant, samplesheet)
+    if plots.enabled():
+        with profiling.stage('plot'):
+            plots.plot_standards(wells, os.path.join(outdir, 'quant_kapa_standards.pdf'), fit)
+            plots.plot_wells(wells, os.path.join(outdir, 'quant_kapa.pdf'), order=quant.index.tolist())
 
-    fname = next(filter(lambda x: x.endswith('.csv') and 'Quantification Summary' in x, os.listdir(kapafolder)))
-    if not fname:
-        logging.error(f'Could not find quantification summary data in {kapafolder}')
-        return
+def kapa_batch(manifest, outdir='.', workers=None, dilution=1e4, standard_bp: int = 399, plot=False, drop_outliers=False, outlier_z=3.5, outlier_min_cq=0.5):
+    plates = read_manifest(manifest, ['kapafolder', 'samplesheet'], 'plate', 'kapafolder')
+    os.makedirs(outdir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(capture_errors, _kapaquant, row.kapafolder, row.samplesheet, dilution, standard_bp, drop_outliers, outlier_z, outlier_min_cq) for row in plates.itertuples()]
+        results = dict(zip(plates['plate'], (future.result() for future in futures)))
 
-    df = pd.read_csv(os.path.join(kapafolder, fname))
-    df.drop(columns=df.columns[0], inplace=True)
-    df.drop(index=df.index[df.Content == 'Unkn'], inplace=True)
-    df.Content = df.Content.where(df.Content != 'Std', other=df.Content + df.Well.str.slice(0, 1))
-    df.sort_values(by=['Content', 'Well'], inplace=True)
+        quants, wells, qc, done = [], [], [], dict()
+        samplesheets = plates.set_index('plate')['samplesheet']
+        for plate, (result, error) in results.items():
+            if error is not None:
+                logging.error(f'{plate}: {error}')
+                qc.append(dict(plate=plate, status='failed', error=error))
+                continue
+            plate_wells, fit, quant = done[plate] = result
+            quants.append(quant.assign(plate=plate))
+            # each plate is a run of its own, so stored under its own sample sheet even with --run-id
+            store.record('kapa', quant, run_id=store.run_name(samplesheets[plate]))
+            wells.append(plate_wells.assign(plate=plate))
+            qc.append(dict(plate=plate, status='ok', error='', **_qc(fit), outliers=int(quant['outliers'].sum()), cv_max=quant['CV'].max()))
+        qc = pd.DataFrame(qc).set_index('plate')
+        qc.to_csv(os.path.join(outdir, 'quant_kapa_qc.csv'))
+        if quants:
+            pd.concat(quants).reset_index().set_index(['plate', 'Pool label']).to_csv(os.path.join(outdir, 'quant_kapa_batch.csv'))
+            pd.concat(wells).set_index('plate').to_csv(os.path.join(outdir, 'quant_kapa_wells.csv'))
+        print(qc.drop(columns='error').to_string())
+
+        # plotting is the slow part, so it only happens on request and after all the numbers are written
+        if plot and plots.enabled():
+            futures = [executor.submit(_plot_plate, plate, plate_wells, fit, quant.index.tolist(), outdir)
+                       for plate, (plate_wells, fit, quant) in done.items()]
+            for future in futures:
+                future.result()
+
+def _kapaquant(kapafolder, samplesheet, dilution, standard_bp: int, drop_outliers=False, outlier_z=3.5, outlier_min_cq=0.5) -> tuple[pd.DataFrame, dict, pd.DataFrame]:
+    with profiling.stage('parse'):
+        amplicon_sizes = pooled_bp(load_samplesheet(samplesheet))
+
+        # a folder, or the quantification summary itself when the folder has more than one
+        if os.path.isfile(kapafolder):
+            kapafolder, fname = os.path.split(kapafolder)
+        else:
+            fname = next(filter(lambda x: x.endswith('.csv') and 'Quantification Summary' in x, os.listdir(kapafolder)), None)
+        if not fname:
+            raise FileNotFoundError(f'Could not find quantification summary data in {kapafolder}')
+
+        df = pd.read_csv(os.path.join(kapafolder, fname))
+        df.drop(columns=df.columns[0], inplace=True)
+        df.drop(index=df.index[df.Content == 'Unkn'], inplace=True)
+        df.Content = df.Content.where(df.Content != 'Std', other=df.Content + df.Well.str.slice(0, 1))
+        df.sort_values(by=['Content', 'Well'], inplace=True)
 
     # standard curve
     std = df[df.Content.str.startswith('Std')]
+    with profiling.stage('fit'):
+        fit = _fit_standards(std)
+
+    unkn = df[df.Content.str.startswith('Unkn')].copy()
+    unkn['sample_id'] = unkn.Content.str.extract(r'Unkn-(\d+)', expand=False).astype(int)
+    # any number of replicates per pool; wells numbered past the last pool are ignored
+    unkn = unkn[unkn.sample_id <= len(amplicon_sizes)]
+    unkn['Pool label'] = amplicon_sizes.index[unkn.sample_id - 1]
+    missing = amplicon_sizes.index.difference(unkn['Pool label'])
+    assert missing.empty, f'No qPCR wells for {", ".join(missing)}'
+
+    with profiling.stage('qc'):
+        unkn['outlier'] = _flag_outliers(unkn['Cq'], unkn['Pool label'], outlier_z, outlier_min_cq)
+        replicates = _replicate_stats(unkn, fit, drop_outliers).reindex(amplicon_sizes.index)
+    for pool, pool_wells in unkn[unkn.outlier].groupby('Pool label', sort=False):
+        logging.warning(f'{pool}: outlier wells {", ".join(pool_wells.Well)}{" (dropped)" if drop_outliers else ""}')
+
+    conc = np.power(10, (replicates['Cq'] - fit['intercept']) / fit['slope']) # pM
+    conc_size_adjusted = conc * standard_bp / amplicon_sizes # pM
+    conc_undiluted = conc_size_adjusted * dilution / 1e3 # nM
+    conc_undiluted_mass = conc_undiluted * amplicon_sizes * 617.9 * 1e-6 # ng/uL
+    quant = pd.concat([amplicon_sizes, conc_undiluted_mass, conc_undiluted], axis=1, keys=['bp', 'ng/uL', 'nM']).join(replicates[['replicates', 'outliers', 'CV']])
+
+    # per-well table with everything needed to plot later
+    std_plot = std.copy()
+    std_plot["Pool label"] = "Standards"
+    std_plot["outlier"] = False
+    wells = pd.concat([std_plot, unkn])[['Well', 'Content', 'Cq', 'SQ', 'Pool label', 'outlier']]
+
+    return wells, fit, quant
+
+def _flag_outliers(cq: pd.Series, pool: pd.Series, max_z=3.5, min_cq=0.5) -> pd.Series:
+    # robust z-score against each pool's median and MAD, for all pools at once
+    dev = (cq - cq.groupby(pool).transform('median')).abs()
+    mad = dev.groupby(pool).transform('median')
+    # the MAD is 0 whenever most replicates agree exactly, so differences below min_cq cycles are never outliers
+    limit = np.maximum(max_z * 1.4826 * mad, min_cq)
+    return (dev > limit) | cq.isna()
+
+def _replicate_stats(unkn: pd.DataFrame, fit: dict, drop_outliers=False) -> pd.DataFrame:
+    used = unkn[~unkn.outlier] if drop_outliers else unkn
+    pool = used['Pool label']
+    well_conc = np.power(10, (used.Cq - fit['intercept']) / fit['slope'])
+    return pd.DataFrame({
+        'Cq': used.Cq.groupby(pool).mean(),
+        'replicates': used.Cq.groupby(pool).count(),
+        'outliers': unkn.outlier.groupby(unkn['Pool label']).sum(),
+        'CV': well_conc.groupby(pool).std() / well_conc.groupby(pool).mean(),
+    })
+
+def _fit_standards(std: pd.DataFrame) -> dict:
     data = std.groupby('Content')[['Cq', 'SQ']].mean()
     if not (std.groupby('Content')['SQ'].std() == 0).all():
         logging.error('Concentration is not constant for all replicates of standards')
@@ -44,51 +143,20 @@ def kapaquant(kapafolder, samplesheet, dilution, standard_bp: int):
     if r_value**2 < 0.99:
         logging.warning(f'R² is {r_value**2:.4f}, expected >0.99')
     logging.info(f'Intercept: {intercept:.3f}')
+    return dict(slope=slope, intercept=intercept, r2=r_value**2, efficiency=efficiency, delta_cq=deltaCq[1:].tolist())
 
-    fig, ax = plt.subplots()
-    ax.scatter(x, y)
-    ax.plot(x, slope * x + intercept, 'r')
-    ax.set_xlabel('log10(pM)')
-    ax.set_ylabel('Cq')
-    ax.set_title('Standard curve')
-    fig.savefig('quant_kapa_standards.pdf', bbox_inches='tight')
-    plt.close(fig)
-
-    unkn = df[df.Content.str.startswith('Unkn')].iloc[:len(amplicon_sizes) * 3]
-    avg_cq = unkn.groupby('Content')['Cq'].mean()
-    avg_cq.index = amplicon_sizes.index
-    conc = np.power(10, (avg_cq - intercept) / slope) # pM
-    conc_size_adjusted = conc * standard_bp / amplicon_sizes # pM
-    conc_undiluted = conc_size_adjusted * dilution / 1e3 # nM
-    conc_undiluted_mass = conc_undiluted * amplicon_sizes * 617.9 * 1e-6 # ng/uL
+def _qc(fit: dict) -> dict:
+    delta_cq = np.array(fit['delta_cq'])
+    return dict(
+        efficiency=fit['efficiency'],
+        r2=fit['r2'],
+        slope=fit['slope'],
+        intercept=fit['intercept'],
+        delta_cq_min=min(fit['delta_cq'], default=np.nan),
+        delta_cq_max=max(fit['delta_cq'], default=np.nan),
+        passed=bool(0.9 <= fit['efficiency'] <= 1.1 and fit['r2'] >= 0.99 and ((delta_cq >= 3.1) & (delta_cq <= 3.6)).all()),
+    )
 
-    fig, ax = plt.subplots()
-    pools = amplicon_sizes.index.to_series(index=pd.RangeIndex(1, len(amplicon_sizes) + 1))
-    unkn_plot = unkn.copy()
-    unkn_plot["sample_id"] = unkn_plot.Content.str.extract(r'Unkn-(\d+)').astype(int)
-    unkn_plot = unkn_plot.join(pools, on="sample_id")
-    std_plot = std.copy()
-    std_plot["Pool label"] = "Standards"
-    data_plot = pd.concat([std_plot, unkn_plot])
-    sns.swarmplot(data=data_plot, x='Pool label', y='Cq', ax=ax, order=["Standards"] + pools.tolist())
-    ax.set_xlabel("")
-    for tick in ax.get_xticklabels():
-        tick.set_rotation(45)
-        tick.set_ha('right')
-    range_cq = std.Cq.min(), std.Cq.max()
-    range_cq_diff = range_cq[1] - range_cq[0]
-    ax.set_ylim(range_cq[0] - 0.1 * range_cq_diff, range_cq[1] + 0.1 * range_cq_diff)
-    ax.yaxis.set_major_locator(plt.MaxNLocator(integer=True))
-    # second y-axis
-    ax2 = ax.twinx()
-    ax2.set_ylabel('Concentration (pM)')
-    range_sq = std.SQ.max(), std.SQ.min()
-    range_sq_log = np.log10(range_sq) + 12 # convert M to pM
-    range_sq_log_diff = range_sq_log[0] - range_sq_log[1]
-    ax2.set_ylim(np.power(10, [range_sq_log[0] + 0.1 * range_sq_log_diff, range_sq_log[1] - 0.1 * range_sq_log_diff]))
-    ax2.set_yscale("log")
-    ax2.spines['right'].set_visible(True)
-    fig.savefig('quant_kapa.pdf', bbox_inches='tight')
-    plt.close(fig)
-
-    pd.concat([amplicon_sizes, conc_undiluted_mass, conc_undiluted], axis=1, keys=['bp', 'ng/uL', 'nM']).to_csv('quant_kapa.csv')
+def _plot_plate(plate, wells, fit, order, outdir):
+    plots.plot_standards(wells, os.path.join(outdir, f'{plate}_quant_kapa_standards.pdf'), fit)
+    plots.plot_wells(wells, os.path.join(outdir, f'{plate}_quant_kapa.pdf'), order=order)
@@ -1,10 +1,69 @@
 import pandas as pd
-from .utils import parse_samplesheet, pooled_bp
+import os
+import re
+from .utils import load_samplesheet, pooled_bp
+from . import profiling, store
 
-def qubitquant(samplesheet):
-    samples = parse_samplesheet(samplesheet)
-    amplicon_sizes = pooled_bp(samples)
-    concs = [float(input(f'ng/uL for {sample}: ')) for sample in amplicon_sizes.index]
-    concs = pd.Series(concs, index=amplicon_sizes.index)
+# ng/uL per unit, for the units Qubit and plate reader exports use
+_UNITS = {'ng/ul': 1, 'ng/µl': 1, 'ug/ml': 1, 'µg/ml': 1, 'ng/ml': 1e-3, 'pg/ul': 1e-3, 'pg/µl': 1e-3}
+
+def qubitquant(samplesheet, outdir='.', qubit_export=None, well_map=None, prompt=True):
+    with profiling.stage('parse'):
+        amplicon_sizes = pooled_bp(load_samplesheet(samplesheet))
+        concs = read_qubit_export(qubit_export, well_map).reindex(amplicon_sizes.index) if qubit_export else pd.Series(float('nan'), index=amplicon_sizes.index)
+    # only pools missing from the export are asked for
+    missing = concs.index[concs.isna()]
+    assert prompt or missing.empty, f'No Qubit reading for {", ".join(map(str, missing))}'
+    for sample in missing:
+        concs[sample] = float(input(f'ng/uL for {sample}: '))
     concs_molar = 1e6 * concs / (amplicon_sizes * 617.9)
-    pd.concat([amplicon_sizes, concs, concs_molar], axis=1, keys=['bp', 'ng/uL', 'nM']).to_csv('quant_qubit.csv')
+    with profiling.stage('write'):
+        quant = pd.concat([amplicon_sizes, concs, concs_molar], axis=1, keys=['bp', 'ng/uL', 'nM'])
+        quant.to_csv(os.path.join(outdir, 'quant_qubit.csv'))
+        store.record('qubit', quant, samplesheet)
+
+def read_qubit_export(fname, well_map=None) -> pd.Series:
+    # ng/uL per pool from a Qubit (Flex) or plate reader CSV export; replicate readings are averaged
+    df = pd.read_csv(fname, encoding='utf-8-sig', encoding_errors='replace')
+    columns = {_normalize(c): c for c in df.columns}
+    conc = _find_column(columns, ['original sample conc.', 'original sample conc', 'ng/ul', 'concentration', 'conc'], fname)
+    units = _units_column(df.columns, conc)
+    if well_map is not None:
+        wells = pd.read_csv(well_map)
+        wells = wells.set_index(_find_column({_normalize(c): c for c in wells.columns}, ['well'], well_map))['Pool label']
+        labels = df[_find_column(columns, ['well', 'well position'], fname)].map(_normalize_well).map(wells.rename(index=_normalize_well))
+    else:
+        labels = df[_find_column(columns, ['pool label', 'sample name', 'sample id', 'name'], fname)]
+
+    values = pd.to_numeric(df[conc], errors='coerce')
+    if units is not None:
+        scale = df[units].map(_normalize).map(_UNITS)
+        unknown = df.loc[scale.isna() & df[units].notna(), units].unique()
+        assert len(unknown) == 0, f'Unknown concentration units in {fname}: {", ".join(map(str, unknown))}'
+        values = values * scale.fillna(1)
+    # out of range readings ("Too Low", "Out of range") are left for the prompt
+    return values.groupby(labels).mean().dropna().rename('ng/uL')
+
+def _find_column(columns: dict[str, str], names: list[str], fname) -> str:
+    for name in names:
+        if name in columns:
+            return columns[name]
+    raise KeyError(f'No {names[0]} column in {fname}')
+
+def _units_column(columns, conc) -> str | None:
+    # the units of the chosen concentration, not of the tube concentration Qubit exports list first:
+    # the column right after it, else one named after it
+    columns = list(columns)
+    following = columns[columns.index(conc) + 1:columns.index(conc) + 2]
+    if following and 'unit' in _normalize(following[0]):
+        return following[0]
+    prefix = _normalize(conc).rstrip('.')
+    return next((c for c in columns if c != conc and 'unit' in _normalize(c) and _normalize(c).startswith(prefix)), None)
+
+def _normalize(s) -> str:
+    return re.sub(r'\s+', ' ', str(s).replace('®', '')).strip().lower()
+
+def _normalize_well(well) -> str:
+    # A1, A01 and a01 are the same well
+    match = re.fullmatch(r'([A-Za-z]+)0*(\d+)', str(well).strip())
+    return f'{match.group(1).upper()}{match.group(2)}' if match else str(well).strip()
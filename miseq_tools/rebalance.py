@@ -0,0 +1,42 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+from .demux_stats import _demux_pools
+from .pooling import _pools, _format_pools, _check_samples_used_exactly_once, _check_dilution
+from . import profiling
+
+def rebalance(samplesheet, quant_csv, stats, outdir='.', **kwargs):
+    # pooling plan for a top-up run that makes up each pool's shortfall from the last one
+    _, df_pool = _demux_pools(samplesheet, stats)
+    concs = pd.read_csv(quant_csv, index_col=0)['nM']
+    targets = rebalance_targets(df_pool, concs)
+    num_reads = targets.loc[targets['deficit'] > 0, 'deficit'].round().astype(int)
+    num_reads = num_reads[num_reads > 0]
+    assert not num_reads.empty, 'Every pool already has at least its intended reads'
+    effective = targets.loc[num_reads.index, 'effective nM']
+    with profiling.stage('solve'):
+        pools = _pools(num_reads, effective, **kwargs)
+    with profiling.stage('validate'):
+        _check_samples_used_exactly_once(pools, set(num_reads.index))
+        _check_dilution(pools, num_reads, effective)
+    with profiling.stage('write'):
+        os.makedirs(outdir, exist_ok=True)
+        targets.to_csv(os.path.join(outdir, 'rebalance.csv'))
+        print(_format_pools(pools))
+
+def rebalance_targets(df_pool: pd.DataFrame, concs: pd.Series) -> pd.DataFrame:
+    # A pool pipetted at its quantified nM gets reads in proportion to its true nM, so the ratio of its
+    # share of the run's reads to its intended share corrects the quantification.
+    missing = df_pool.index.difference(concs.index)
+    assert missing.empty, f'No quantification for {", ".join(map(str, missing))}'
+    df = df_pool[['intended', 'actual']].fillna(0).join(concs.rename('nM'))
+    share = (df['actual'] / df['actual'].sum()) / (df['intended'] / df['intended'].sum())
+    df['effective nM'] = df['nM'] * share
+    # nothing to correct from when a pool got no reads at all
+    failed = df['actual'] == 0
+    if failed.any():
+        logging.warning(f'No reads for {", ".join(map(str, df.index[failed]))}; using their quantified nM')
+    df['effective nM'] = df['effective nM'].where(~failed, df['nM'])
+    df['deficit'] = np.maximum(df['intended'] - df['actual'], 0)
+    return df
@@ -2,34 +2,51 @@ import pandas as pd
 import logging
 import datetime
 from .utils import parse_samplesheet
-import os
+from .barcodes import load_barcode_index
+from .collisions import index_collisions, safe_barcode_mismatches
 import Bio.Seq
+from . import profiling
 
-def check_indexes(df):
-    dir_known_i7 = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'known_barcodes', 'i7')
-    known_i7 = pd.concat([pd.read_csv(os.path.join(dir_known_i7, fname), header=None, index_col=0, delimiter="\t" if fname.endswith('.tsv') else ",").squeeze() for fname in os.listdir(dir_known_i7)])
-    dir_known_i5 = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'known_barcodes', 'i5')
-    known_i5 = pd.concat([pd.read_csv(os.path.join(dir_known_i5, fname), header=None, index_col=0, delimiter="\t" if fname.endswith('.tsv') else ",").squeeze() for fname in os.listdir(dir_known_i5)])
+def check_indexes(df, barcode_dirs=()):
+    known = load_barcode_index(barcode_dirs)
     # i7 rev comp
-    if (errors := df['index'].isin(known_i7.apply(Bio.Seq.reverse_complement))).any():
+    if (errors := df['index'].map(known.i7_rc.__contains__).astype(bool)).any():
         logging.warning(f'i7 might need to be reverse complemented for these samples: {df.loc[errors, "Sample_ID"].tolist()}')
     # i5 rev comp
-    if (errors := df['index2'].isin(known_i5.apply(Bio.Seq.reverse_complement))).any():
+    if (errors := df['index2'].map(known.i5_rc.__contains__).astype(bool)).any():
         logging.warning(f'i5 might need to be reverse complemented for these samples: {df.loc[errors, "Sample_ID"].tolist()}')
     # i7 and i5 swapped
-    if (errors := df['index'].isin(known_i5) | df['index2'].isin(known_i7)).any():
+    if (errors := df['index'].map(known.i5.__contains__).astype(bool) | df['index2'].map(known.i7.__contains__).astype(bool)).any():
         logging.warning(f'i7 and i5 might be swapped for these samples: {df.loc[errors, "Sample_ID"].tolist()}')
 
-def format_samplesheet(fname_in, fname_out, nextseq=False):
-    df = parse_samplesheet(fname_in)
+def check_collisions(df, max_mismatches=2):
+    collisions, min_distance = index_collisions(df['index'], df['index2'], max_mismatches=max_mismatches)
+    if len(collisions):
+        sample_ids = df['Sample_ID'].to_numpy()
+        logging.warning(f'Index pairs within {max_mismatches} mismatches (Sample_ID, Sample_ID, i7 mismatches, i5 mismatches): '
+                        f'{[[sample_ids[a], sample_ids[b], i7, i5] for a, b, i7, i5 in collisions[["a", "b", "i7", "i5"]].itertuples(index=False)]}')
+    logging.info(f'Maximum safe BarcodeMismatches: {safe_barcode_mismatches(min_distance)}')
 
-    read_info = pd.read_csv(fname_in, usecols=[9, 10], header=None, nrows=4, index_col=0).squeeze()
+def format_samplesheet(fname_in, fname_out, nextseq=False, barcode_dirs=(), max_mismatches=2):
+    with profiling.stage('parse'):
+        df = parse_samplesheet(fname_in)
+        read_info = read_run_info(fname_in)
+    with profiling.stage('validate'):
+        validate_samplesheet(df, read_info, barcode_dirs, max_mismatches)
+    with profiling.stage('write'):
+        write_samplesheet(df, read_info, fname_out, nextseq)
 
+def read_run_info(fname_in) -> pd.Series:
+    # read lengths live in columns 9 and 10 of the first four lines
+    return pd.read_csv(fname_in, usecols=[9, 10], header=None, nrows=4, index_col=0).squeeze()
+
+def validate_samplesheet(df, read_info, barcode_dirs=(), max_mismatches=2):
     # check validity
     if (errors := df['Sample_ID'].duplicated()).any():
         logging.warning(f'Duplicate Sample_ID found: {df.loc[errors, "Sample_ID"].tolist()}')
     if (errors := df[['index', 'index2']].apply(tuple, axis=1).duplicated()).any():
         logging.warning(f'Duplicate index pair found: {df.loc[errors, ["index", "index2"]].values.tolist()}')
+    check_collisions(df, max_mismatches)
     if (errors := df['Sample_ID'].str.len() > 40).any():
         logging.warning(f'Sample_ID too long: {df.loc[errors, "Sample_ID"].tolist()}')
     if (errors := ~df['Sample_ID'].str.match(r'^[a-zA-Z0-9-_]+$')).any():
@@ -40,13 +57,16 @@ def format_samplesheet(fname_in, fname_out, nextseq=False):
     if (errors := df['index2'].str.len() != read_info['Index 2 (i5)']).any():
         logging.warning(f'index2 is the wrong length: {df.loc[errors, "Sample_ID"].tolist()}')
     # check against known indexes
-    check_indexes(df)
+    check_indexes(df, barcode_dirs)
 
+def write_samplesheet(df, read_info, fname_out, nextseq=False):
+    # a Lane column, if there is one, goes first as in multi-lane sheets
+    columns = ['Lane'] * ('Lane' in df.columns) + ['Sample_ID', 'I7_Index_ID', 'index', 'I5_Index_ID', 'index2']
+    df = df[columns].copy()
     # reverse complement i5 for nextseq if necessary
     if nextseq:
         df['index2'] = df['index2'].apply(Bio.Seq.reverse_complement)
 
-    # write out
     with open(fname_out, 'wt') as f:
         f.write(f"""[Header],,,,
 IEMFileVersion,4,,,
@@ -64,6 +84,6 @@ Chemistry,Amplicon,,,
 [Settings],,,,
 ,,,,
 [Data],,,,
-Sample_ID,I7_Index_ID,index,I5_Index_ID,index2
+{",".join(columns)}
 """)
-        df[['Sample_ID', 'I7_Index_ID','index', 'I5_Index_ID', 'index2']].to_csv(f, index=False, header=False, mode='a')
+        df.to_csv(f, index=False, header=False, mode='a')
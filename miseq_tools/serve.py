@@ -0,0 +1,167 @@
+import contextlib
+import http.server
+import json
+import logging
+import os
+import socketserver
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from .barcodes import load_barcode_index
+from .demux_stats import _demux_pools
+from .pooling import _format_pools, _pools, _solve, _check_samples_used_exactly_once, _check_dilution
+from .quant_kapa import _kapaquant
+from .samplesheet import format_samplesheet
+
+# JSON endpoints for callers like a LIMS that would otherwise pay for the imports on every call.
+# Every endpoint takes a POST with a JSON object; paths in it are read on the server's filesystem.
+
+def serve(host='127.0.0.1', port=8000, socket=None, workers=None):
+    server = make_server(host, port, socket, workers)
+    host, port = (socket, None) if socket else server.server_address[:2]
+    logging.info(f'Serving on {socket or f"http://{host}:{port}"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket:
+            os.remove(socket)
+
+def make_server(host='127.0.0.1', port=8000, socket=None, workers=None):
+    # warm the barcode tables so the first /sheet request doesn't pay for them
+    load_barcode_index()
+    if socket:
+        if os.path.exists(socket):
+            os.remove(socket)
+        return _UnixServer(socket, _Handler, workers=workers)
+    return _TCPServer((host, port), _Handler, workers=workers)
+
+def sheet(samplesheet, nextseq=False, barcode_dirs=(), max_mismatches=2):
+    # the sheet is returned rather than written where the client says, so a client can't write files on the server
+    with _capture_logs() as messages, tempfile.TemporaryDirectory() as tmpdir:
+        out = os.path.join(tmpdir, 'samplesheet.csv')
+        format_samplesheet(samplesheet, out, nextseq=nextseq, barcode_dirs=barcode_dirs, max_mismatches=max_mismatches)
+        with open(out) as f:
+            text = f.read()
+    return dict(samplesheet=text, messages=messages)
+
+def pool(samplesheet=None, quant_csv=None, num_reads=None, concs=None, **kwargs):
+    # either files, as for the pool subcommand, or {pool: reads} and {pool: nM} mappings
+    with _capture_logs() as messages:
+        if samplesheet is not None:
+            pools = _solve(samplesheet, quant_csv, **kwargs)
+        else:
+            assert num_reads is not None and concs is not None, 'Need samplesheet and quant_csv, or num_reads and concs'
+            num_reads, concs = pd.Series(num_reads, dtype=int), pd.Series(concs, dtype=float)
+            pools = _pools(num_reads, concs, **kwargs)
+            _check_samples_used_exactly_once(pools, set(num_reads.index))
+            _check_dilution(pools, num_reads, concs)
+    return dict(pools=pools, text=_format_pools(pools), messages=messages)
+
+def kapa(kapafolder, samplesheet, dilution=1e4, standard_bp=399, drop_outliers=False, outlier_z=3.5, outlier_min_cq=0.5):
+    with _capture_logs() as messages:
+        wells, fit, quant = _kapaquant(kapafolder, samplesheet, dilution, standard_bp, drop_outliers, outlier_z, outlier_min_cq)
+    return dict(fit=fit, quant=_records(quant), messages=messages)
+
+def demux(samplesheet, stats):
+    with _capture_logs() as messages:
+        counts, df_pool = _demux_pools(samplesheet, stats)
+    df_pool['actual/intended'] = df_pool['actual'] / df_pool['intended']
+    return dict(pools=_records(df_pool), lanes=_records(counts.lane_summary()), messages=messages)
+
+ENDPOINTS = {
+    '/sheet': sheet,
+    '/pool': pool,
+    '/kapa': kapa,
+    '/demux': demux,
+}
+
+def _records(df: pd.DataFrame) -> list[dict]:
+    # through pandas' JSON writer so NaN becomes null
+    return json.loads(df.reset_index().to_json(orient='records'))
+
+@contextlib.contextmanager
+def _capture_logs():
+    # requests run concurrently, so only keep records from this thread
+    handler = _ListHandler(logging.INFO)
+    thread = threading.get_ident()
+    handler.addFilter(lambda record: record.thread == thread)
+    logging.getLogger().addHandler(handler)
+    try:
+        yield handler.messages
+    finally:
+        logging.getLogger().removeHandler(handler)
+
+class _ListHandler(logging.Handler):
+    def __init__(self, level):
+        super().__init__(level)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(dict(level=record.levelname, message=record.getMessage()))
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, dict(status='ok', endpoints=sorted(ENDPOINTS)))
+        else:
+            self._reply(404, dict(error=f'Unknown endpoint {self.path}'))
+
+    def do_POST(self):
+        # always read the body, or closing the connection with it unread can reset it before the client sees the reply
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path not in ENDPOINTS:
+            self._reply(404, dict(error=f'Unknown endpoint {self.path}'))
+            return
+        try:
+            params = json.loads(data or b'{}')
+            assert isinstance(params, dict), 'Request body must be a JSON object'
+            result = ENDPOINTS[self.path](**params)
+        except (AssertionError, FileNotFoundError, KeyError, TypeError, ValueError) as e:
+            self._reply(400, dict(error=str(e) or type(e).__name__))
+        except Exception as e:
+            logging.exception(f'{self.path} failed')
+            self._reply(500, dict(error=str(e) or type(e).__name__))
+        else:
+            self._reply(200, result)
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+class _PoolMixIn:
+    # like socketserver.ThreadingMixIn, but with a bounded pool of worker threads
+    def __init__(self, *args, workers=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+
+class _TCPServer(_PoolMixIn, http.server.HTTPServer):
+    pass
+
+class _UnixServer(_PoolMixIn, socketserver.UnixStreamServer):
+    pass
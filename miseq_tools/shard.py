@@ -0,0 +1,73 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+from .utils import load_samplesheet
+from .collisions import index_collisions
+from .samplesheet import read_run_info, validate_samplesheet, write_samplesheet
+from .pooling import _pools, _format_pools, _check_samples_used_exactly_once, _check_dilution
+
+def shard(fname_in, capacity: float, lanes: int = 1, quant_csv=None, outdir='.', nextseq=False, barcode_dirs=(), max_mismatches=2, **kwargs):
+    # split a sheet too big for one run across runs of `capacity` million reads, each with `lanes` lanes
+    sheet = load_samplesheet(fname_in)
+    df = sheet.samples.copy()
+    read_info = read_run_info(fname_in)
+    shards = assign_shards(sheet.pool_reads, _pool_conflicts(sheet, max_mismatches), capacity / lanes, lanes)
+    concs = pd.read_csv(quant_csv, index_col=0)["nM"] if quant_csv else None
+
+    os.makedirs(outdir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(fname_in))[0]
+    df['Lane'] = df['Pool label'].map(shards['lane'])
+    for run, run_pools in shards.groupby('run'):
+        samples = df[df['Pool label'].isin(run_pools.index)].sort_values('Lane', kind='stable')
+        for lane, lane_samples in samples.groupby('Lane'):
+            logging.info(f'Run {run}{f" lane {lane}" if lanes > 1 else ""}: {run_pools.loc[run_pools["lane"] == lane, "Reads (million)"].sum():.2f}M reads')
+            validate_samplesheet(lane_samples, read_info, barcode_dirs, max_mismatches)
+            if concs is not None:
+                num_reads = (sheet.pool_reads[lane_samples['Pool label'].unique()] * 1e6).astype(int)
+                pools = _pools(num_reads, concs.reindex(num_reads.index), **kwargs)
+                _check_samples_used_exactly_once(pools, set(num_reads.index))
+                _check_dilution(pools, num_reads, concs.reindex(num_reads.index))
+                with open(os.path.join(outdir, f'{stem}_run{run}{f"_lane{lane}" if lanes > 1 else ""}_pooling.txt'), 'wt') as f:
+                    f.write(_format_pools(pools) + '\n')
+        write_samplesheet(samples if lanes > 1 else samples.drop(columns='Lane'), read_info, os.path.join(outdir, f'{stem}_run{run}.csv'), nextseq)
+
+    shards.to_csv(os.path.join(outdir, f'{stem}_shards.csv'))
+    print(shards.groupby(['run', 'lane'])['Reads (million)'].agg(['count', 'sum']).rename(columns={'count': 'pools', 'sum': 'Reads (million)'}).to_string())
+
+def assign_shards(pool_reads: pd.Series, conflicts: dict[str, set[str]], lane_capacity: float, lanes: int = 1) -> pd.DataFrame:
+    # first-fit decreasing: biggest pools first, each into the first lane with room and no colliding indexes
+    too_big = pool_reads[pool_reads > lane_capacity]
+    assert too_big.empty, f'Pools need more reads than one lane holds ({lane_capacity}M): {too_big.to_dict()}'
+    remaining = np.empty(0)
+    members = []
+    lane_of = dict()
+    for pool, reads in pool_reads.sort_values(ascending=False, kind='stable').items():
+        # a little slack so rounding doesn't open a new lane
+        for i in np.flatnonzero(remaining >= reads - 1e-9):
+            if not conflicts.get(pool, set()) & members[i]:
+                break
+        else:
+            i = len(members)
+            remaining = np.append(remaining, lane_capacity)
+            members.append(set())
+        remaining[i] -= reads
+        members[i].add(pool)
+        lane_of[pool] = i
+    lane_of = pd.Series(lane_of).reindex(pool_reads.index)
+    return pd.DataFrame({
+        'Reads (million)': pool_reads,
+        'run': lane_of // lanes + 1,
+        'lane': lane_of % lanes + 1,
+    })
+
+def _pool_conflicts(sheet, max_mismatches=2) -> dict[str, set[str]]:
+    # pools that can't share a lane because some of their index pairs are within max_mismatches
+    collisions, _ = index_collisions(sheet.samples['index'], sheet.samples['index2'], max_mismatches=max_mismatches)
+    labels = np.asarray(sheet.pool_labels.astype(object))
+    conflicts = dict()
+    for a, b in zip(labels[collisions['a'].to_numpy(dtype=int)], labels[collisions['b'].to_numpy(dtype=int)]):
+        if a != b:
+            conflicts.setdefault(a, set()).add(b)
+            conflicts.setdefault(b, set()).add(a)
+    return conflicts
@@ -0,0 +1,84 @@
+import datetime
+import os
+import sys
+import urllib.parse
+import uuid
+import pandas as pd
+
+# History of every run's results as Parquet, one dataset per table partitioned like
+# <store>/kapa/run_date=2024-06-30/run_id=SPS303/part-0.parquet, so a query over many runs is one scan.
+# pyarrow is optional: pip install "miseq_tools[store]"
+
+TABLES = ("kapa", "qubit", "combined", "demux")
+
+def enabled() -> bool:
+    # set by the global --store flag
+    return bool(os.environ.get('MISEQ_TOOLS_STORE'))
+
+def record(table: str, df: pd.DataFrame, samplesheet=None, run_id=None):
+    # called by each stage after writing its CSV; a no-op without --store
+    if not enabled():
+        return
+    # the run is named by --run-id, else by its sample sheet, so every stage of a run stores under the same name
+    run_id = run_id or os.environ.get('MISEQ_TOOLS_RUN_ID') or (run_name(samplesheet) if samplesheet else None)
+    assert run_id, f'No run to store the {table} results under; name it with --run-id'
+    run_date = os.environ.get('MISEQ_TOOLS_RUN_DATE') or datetime.date.today().isoformat()
+    append(os.environ['MISEQ_TOOLS_STORE'], table, df, run_id, run_date)
+
+def run_name(samplesheet) -> str:
+    return os.path.splitext(os.path.basename(samplesheet))[0]
+
+def append(store, table: str, df: pd.DataFrame, run_id: str, run_date: str):
+    pa, pq, _ = _pyarrow()
+    assert table in TABLES, f'Unknown table {table}'
+    run_date = datetime.date.fromisoformat(str(run_date)).isoformat()
+    run_dir = f'run_id={urllib.parse.quote(str(run_id), safe="")}'
+    folder = os.path.join(store, table, f'run_date={run_date}', run_dir)
+    os.makedirs(folder, exist_ok=True)
+    # rerunning a stage on the same date replaces that run's rows, while a run of the same name on another date
+    # is kept as its own history; the dot prefix hides the partial file from readers
+    tmp = os.path.join(folder, f'.{uuid.uuid4().hex}.tmp')
+    pq.write_table(pa.Table.from_pandas(df.reset_index(), preserve_index=False), tmp)
+    os.replace(tmp, os.path.join(folder, 'part-0.parquet'))
+
+def read(store, table: str, since=None, until=None, run_ids=None, columns=None, exclude_run_ids=None) -> pd.DataFrame:
+    pa, _, ds = _pyarrow()
+    assert table in TABLES, f'Unknown table {table}'
+    path = os.path.join(store, table)
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f'No {table} results in {store}')
+    partitioning = ds.partitioning(pa.schema([('run_date', pa.string()), ('run_id', pa.string())]), flavor='hive')
+    dataset = ds.dataset(path, format='parquet', partitioning=partitioning)
+    # runs recorded by older versions may be missing newer columns
+    schema = pa.unify_schemas([fragment.physical_schema for fragment in dataset.get_fragments()] + [partitioning.schema], promote_options='permissive')
+    dataset = ds.dataset(path, format='parquet', partitioning=partitioning, schema=schema)
+
+    filters = []
+    if since is not None:
+        filters.append(ds.field('run_date') >= str(since))
+    if until is not None:
+        filters.append(ds.field('run_date') <= str(until))
+    if run_ids:
+        filters.append(ds.field('run_id').isin(list(run_ids)))
+    if exclude_run_ids:
+        filters.append(~ds.field('run_id').isin(list(exclude_run_ids)))
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+    if columns is not None:
+        columns = ['run_date', 'run_id'] + [c for c in columns if c not in ('run_date', 'run_id')]
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    return df[['run_date', 'run_id'] + [c for c in df.columns if c not in ('run_date', 'run_id')]].sort_values(['run_date', 'run_id'], kind='stable', ignore_index=True)
+
+def history(store, table: str, since=None, until=None, run_ids=None, columns=None, fname_out=None):
+    df = read(store, table, since, until, run_ids, columns)
+    df.to_csv(fname_out or sys.stdout, index=False)
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.dataset
+    except ImportError as e:
+        raise ImportError('The results store needs pyarrow: pip install "miseq_tools[store]"') from e
+    return pyarrow, pyarrow.parquet, pyarrow.dataset
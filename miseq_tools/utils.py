@@ -1,6 +1,31 @@
 import pandas as pd
+import numpy as np
+import os
+import dataclasses
+import functools
 
-def parse_samplesheet(f):
+@dataclasses.dataclass(frozen=True)
+class SampleSheet:
+    # shared between stages, so treat as read-only; parse_samplesheet hands out copies of samples
+    samples: pd.DataFrame
+    pool_labels: pd.Categorical
+    reads: np.ndarray # million
+    amplicon_bp: np.ndarray
+    pool_reads: pd.Series # million
+    pool_bp: pd.Series # read-weighted
+
+def load_samplesheet(f) -> SampleSheet:
+    # memoized per file version, so every stage in one process shares one parse
+    if isinstance(f, (str, os.PathLike)):
+        st = os.stat(f)
+        return _load_samplesheet(os.path.abspath(f), st.st_mtime_ns, st.st_size)
+    return _build_samplesheet(_read_samplesheet(f))
+
+@functools.lru_cache(maxsize=32)
+def _load_samplesheet(path, mtime_ns, size) -> SampleSheet:
+    return _build_samplesheet(_read_samplesheet(path))
+
+def _read_samplesheet(f) -> pd.DataFrame:
     df = pd.read_csv(f, usecols=range(8))
     df.dropna(how='all', inplace=True)
     df.drop(df.index[df['Pool label'].str.upper().isin(('PHIX', 'TOTAL'))], inplace=True)
@@ -8,10 +33,52 @@ def parse_samplesheet(f):
     df['Amplicon size (bp)'] = df['Amplicon size (bp)'].astype(float)
     return df
 
+def _build_samplesheet(df: pd.DataFrame) -> SampleSheet:
+    pool_labels = pd.Categorical(df['Pool label'], categories=df['Pool label'].dropna().unique())
+    reads = df['Reads (million)'].to_numpy(dtype=float)
+    amplicon_bp = df['Amplicon size (bp)'].to_numpy(dtype=float)
+    pool_reads, pool_bp = _pool_sums(pool_labels, reads, amplicon_bp)
+    return SampleSheet(df, pool_labels, reads, amplicon_bp, pool_reads, pool_bp)
+
+def _pool_sums(pool_labels: pd.Categorical, reads: np.ndarray, amplicon_bp: np.ndarray) -> tuple[pd.Series, pd.Series]:
+    # group sums over category codes; samples without a pool label (code -1) are left out, NaNs are skipped
+    codes = np.asarray(pool_labels.codes)
+    valid = codes >= 0
+    n = len(pool_labels.categories)
+    sum_reads = np.bincount(codes[valid], weights=np.nan_to_num(reads[valid]), minlength=n)
+    sum_weighted = np.bincount(codes[valid], weights=np.nan_to_num(reads[valid] * amplicon_bp[valid]), minlength=n)
+    index = pd.Index(pool_labels.categories.to_numpy(dtype=object), name='Pool label')
+    return pd.Series(sum_reads, index=index, name='Reads (million)'), pd.Series(sum_weighted / sum_reads, index=index)
+
+def parse_samplesheet(f):
+    return load_samplesheet(f).samples.copy()
+
 def pooled_bp(samples):
-    def _weighted_average_size(x):
-        return (x['Reads (million)'] * x['Amplicon size (bp)']).sum() / x['Reads (million)'].sum()
-    return samples.groupby('Pool label', sort=False).apply(_weighted_average_size, include_groups=False)
+    if isinstance(samples, SampleSheet):
+        return samples.pool_bp.copy()
+    pool_labels = pd.Categorical(samples['Pool label'], categories=samples['Pool label'].dropna().unique())
+    return _pool_sums(pool_labels, samples['Reads (million)'].to_numpy(dtype=float), samples['Amplicon size (bp)'].to_numpy(dtype=float))[1]
 
 def pooled_reads(samples):
-    return samples.groupby('Pool label', sort=False)['Reads (million)'].sum()
+    if isinstance(samples, SampleSheet):
+        return samples.pool_reads.copy()
+    pool_labels = pd.Categorical(samples['Pool label'], categories=samples['Pool label'].dropna().unique())
+    return _pool_sums(pool_labels, samples['Reads (million)'].to_numpy(dtype=float), samples['Amplicon size (bp)'].to_numpy(dtype=float))[0]
+
+def read_manifest(manifest, path_columns, name_column, name_from):
+    # one row per run; paths are relative to the manifest itself
+    df = pd.read_csv(manifest)
+    manifest_dir = os.path.dirname(os.path.abspath(manifest))
+    for col in path_columns:
+        df[col] = df[col].map(lambda x: os.path.join(manifest_dir, x))
+    if name_column not in df.columns:
+        df[name_column] = df[name_from].map(lambda x: os.path.splitext(os.path.basename(os.path.normpath(x)))[0])
+    assert not df[name_column].duplicated().any(), f"Duplicate {name_column}s in manifest: {df.loc[df[name_column].duplicated(), name_column].tolist()}"
+    return df
+
+# for functions run in a worker process: failures are returned rather than raised, to keep the rest of the batch going
+def capture_errors(func, *args, **kwargs) -> tuple:
+    try:
+        return func(*args, **kwargs), None
+    except Exception as e:
+        return None, str(e) or type(e).__name__
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .utils import capture_errors
+
+# Polls instrument output folders and runs kapa on each qPCR export and demux on each demux stats file,
+# once each. Which files have been processed is kept in a state file, keyed by path, size and mtime,
+# so a file is picked up again only if it's rewritten.
+
+OUTPUT_DIR = 'miseq_tools'
+# a file whose worker process dies this many times, e.g. killed for running out of memory, is recorded as failed
+MAX_CRASHES = 3
+
+def watch(folders: list[str], samplesheet=None, outdir=None, interval: float = 10, settle: float = 30, workers: int = None, fname_state=None, once=False):
+    fname_state = fname_state or os.path.join('.miseq_tools', 'watch.json')
+    asyncio.run(_watch([os.path.abspath(folder) for folder in folders], samplesheet, outdir, interval, settle, workers, fname_state, once))
+
+def find_jobs(folder: str, settle: float = 30, now: float = None) -> list[tuple[str, str]]:
+    # (kind, path) for every finished output under folder; a file still being written has a recent mtime
+    now = time.time() if now is None else now
+    jobs = []
+    # a folder or file that's renamed, removed or unreadable mid-scan is left for the next poll
+    for dirpath, dirnames, filenames in os.walk(folder, onerror=lambda e: logging.warning(f'Skipping {e.filename} for now: {e.strerror}')):
+        dirnames[:] = sorted(d for d in dirnames if d != OUTPUT_DIR and not d.startswith('.'))
+        for fname in sorted(filenames):
+            if fname.endswith('.csv') and 'Quantification Summary' in fname:
+                kind = 'kapa'
+            elif fname in ('Stats.json', 'Demultiplex_Stats.csv'):
+                kind = 'demux'
+            else:
+                continue
+            path = os.path.join(dirpath, fname)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError as e:
+                logging.warning(f'Skipping {path} for now: {e.strerror}')
+                continue
+            if now - mtime >= settle:
+                jobs.append((kind, path))
+    return jobs
+
+def find_samplesheet(path: str, root: str) -> str | None:
+    # the nearest input sample sheet (Sample_ID and Pool label columns) in the file's folder or above it, up to root
+    folder = os.path.dirname(path)
+    while True:
+        for fname in sorted(os.listdir(folder)):
+            if fname.endswith('.csv') and not fname.startswith('.') and _is_samplesheet(os.path.join(folder, fname)):
+                return os.path.join(folder, fname)
+        if os.path.samefile(folder, root) or os.path.dirname(folder) == folder:
+            return None
+        folder = os.path.dirname(folder)
+
+async def _watch(folders, samplesheet, outdir, interval, settle, workers, fname_state, once):
+    state = _read_state(fname_state)
+    running = dict()
+    crashes = dict()
+    loop = asyncio.get_running_loop()
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            for root in folders:
+                for kind, path in await asyncio.to_thread(find_jobs, root, settle):
+                    try:
+                        key = _key(path)
+                        if key in state or key in running:
+                            continue
+                        sheet = samplesheet or await asyncio.to_thread(find_samplesheet, path, root)
+                    except OSError as e:
+                        # renamed, removed or unreadable since the scan
+                        logging.warning(f'Skipping {path} for now: {e}')
+                        continue
+                    if sheet is None:
+                        # checked again on the next poll, in case the sheet is copied over after the data
+                        logging.debug(f'No sample sheet for {path} yet')
+                        continue
+                    out = os.path.join(outdir, os.path.basename(root), os.path.relpath(os.path.dirname(path), root)) if outdir else os.path.join(os.path.dirname(path), OUTPUT_DIR)
+                    if kind == 'kapa':
+                        # a folder can hold several qPCR exports, so each gets its own results
+                        out = os.path.join(out, os.path.splitext(os.path.basename(path))[0])
+                    logging.info(f'Running {kind} on {path}')
+                    args = capture_errors, _process, kind, path, sheet, os.path.normpath(out)
+                    try:
+                        running[key] = asyncio.ensure_future(loop.run_in_executor(executor, *args))
+                    except BrokenProcessPool:
+                        # a worker died since the last results were collected
+                        executor.shutdown(wait=False)
+                        executor = ProcessPoolExecutor(max_workers=workers)
+                        running[key] = asyncio.ensure_future(loop.run_in_executor(executor, *args))
+            if running:
+                done, _ = await asyncio.wait(running.values(), timeout=None if once else interval)
+                broken = False
+                for key, future in list(running.items()):
+                    if future not in done:
+                        continue
+                    del running[key]
+                    try:
+                        out, error = future.result()
+                    except BrokenProcessPool:
+                        # a dying worker takes the whole pool and every job in it down with it,
+                        # so they are all run again in a new pool on the next poll
+                        broken = True
+                        crashes[key] = crashes.get(key, 0) + 1
+                        if crashes[key] < MAX_CRASHES:
+                            logging.warning(f'{key[0]}: worker process died; retrying')
+                            continue
+                        out, error = None, 'Worker process died'
+                    if error is not None:
+                        logging.error(f'{key[0]}: {error}')
+                    else:
+                        logging.info(f'Wrote {key[0]} results to {out}')
+                    # failures are recorded too, so a bad file isn't retried on every poll until it changes
+                    state[key] = dict(out=out, error=error)
+                _write_state(fname_state, state)
+                if broken:
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(max_workers=workers)
+            elif once:
+                return
+            else:
+                await asyncio.sleep(interval)
+    finally:
+        executor.shutdown()
+
+def _process(kind, path, samplesheet, outdir) -> str:
+    os.makedirs(outdir, exist_ok=True)
+    # results go to a scratch folder first, then each file is moved into place, so a reader
+    # never sees a half-written file and two runs never write into the same file
+    with tempfile.TemporaryDirectory(dir=outdir, prefix='.tmp') as tmpdir:
+        if kind == 'kapa':
+            from .quant_kapa import kapaquant
+            # the file that was found, not the first export listed in its folder
+            kapaquant(path, samplesheet, dilution=1e4, standard_bp=399, outdir=tmpdir)
+        else:
+            from .demux_stats import demux
+            demux(samplesheet, path, outdir=tmpdir)
+        for fname in os.listdir(tmpdir):
+            os.replace(os.path.join(tmpdir, fname), os.path.join(outdir, fname))
+    return outdir
+
+def _is_samplesheet(fname) -> bool:
+    try:
+        with open(fname, 'rt', encoding='utf-8-sig', errors='replace') as f:
+            header = f.readline()
+        return 'Sample_ID' in header and 'Pool label' in header
+    except OSError:
+        return False
+
+def _key(path) -> tuple[str, int, int]:
+    st = os.stat(path)
+    return path, st.st_size, st.st_mtime_ns
+
+def _read_state(fname_state) -> dict:
+    try:
+        with open(fname_state, 'rt') as f:
+            return {tuple(json.loads(key)): value for key, value in json.load(f).items()}
+    except (OSError, ValueError):
+        return dict()
+
+def _write_state(fname_state, state):
+    os.makedirs(os.path.dirname(os.path.abspath(fname_state)), exist_ok=True)
+    with open(f'{fname_state}.tmp', 'wt') as f:
+        json.dump({json.dumps(key): value for key, value in state.items()}, f, indent=2)
+    os.replace(f'{fname_state}.tmp', fname_state)
@@ -0,0 +1,48 @@
+import os
+import pytest
+import Bio.Seq
+from miseq_tools import barcodes
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("MISEQ_TOOLS_CACHE", str(tmp_path / "cache"))
+    monkeypatch.setattr(barcodes, "_indexes", {})
+    return tmp_path / "cache"
+
+def _write_kit(path, i7, i5):
+    for read, seqs in (("i7", i7), ("i5", i5)):
+        os.makedirs(path / read, exist_ok=True)
+        with open(path / read / "kit.tsv", "wt") as f:
+            f.writelines(f"{read}_{i}\t{seq}\n" for i, seq in enumerate(seqs))
+
+@pytest.mark.parametrize("seq", ["ACGTTGCA", "GCTGAGAA", "AACCNNTT"])
+def test_reverse_complement(seq):
+    assert barcodes.reverse_complement(seq) == Bio.Seq.reverse_complement(seq)
+
+def test_user_barcodes(tmp_path, cache):
+    _write_kit(tmp_path / "kit", ["AAAACCCC"], ["GGGGTTTT"])
+    index = barcodes.load_barcode_index([tmp_path / "kit"])
+    assert "AAAACCCC" in index.i7
+    assert "GGGGTTTT" in index.i5
+    assert "AAAACCCC" in index.i5_rc
+    assert "TAAGGCGA" in index.i7 # shipped Nextera
+
+def test_disk_cache(tmp_path, cache, monkeypatch):
+    _write_kit(tmp_path / "kit", ["AAAACCCC"], ["GGGGTTTT"])
+    index = barcodes.load_barcode_index([tmp_path / "kit"])
+    assert len(os.listdir(cache)) == 1
+
+    # a fresh process reads the cache without parsing any barcode files
+    monkeypatch.setattr(barcodes, "_indexes", {})
+    def _build(files):
+        raise AssertionError("should have used the cache")
+    with monkeypatch.context() as m:
+        m.setattr(barcodes, "_build", _build)
+        assert barcodes.load_barcode_index([tmp_path / "kit"]) == index
+
+    # editing a barcode file invalidates the cache
+    _write_kit(tmp_path / "kit", ["CCCCAAAA"], ["GGGGTTTT"])
+    os.utime(tmp_path / "kit" / "i7" / "kit.tsv", ns=(0, 0))
+    index = barcodes.load_barcode_index([tmp_path / "kit"])
+    assert "CCCCAAAA" in index.i7
+    assert "AAAACCCC" not in index.i7
@@ -0,0 +1,78 @@
+import json
+import subprocess
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+from miseq_tools import calibration, store
+
+def _quants(rng, n):
+    # KAPA undercounts long amplicons, Qubit reads 30% high, and both are off by about 5%
+    bp = pd.Series(rng.uniform(200, 800, n), index=pd.Index([f"Pool{i}" for i in range(n)], name="Pool label"))
+    true = pd.Series(rng.uniform(5, 50, n), index=bp.index)
+    return bp, true, true * 400 / bp * rng.lognormal(0, 0.05, n), true * 1.3 * rng.lognormal(0, 0.05, n)
+
+def _write_run(path, rng, run_id, n=8, run_date="2024-01-01"):
+    bp, true, kapa, qubit = _quants(rng, n)
+    used = (kapa + qubit) / 2
+    intended = pd.Series(rng.uniform(1e5, 1e6, n), index=bp.index)
+    actual = 1e6 * intended * true / used
+    store.append(path, "combined", pd.DataFrame({"bp": bp, "nM": used, "KAPA nM": kapa, "Qubit nM": qubit}), run_id, run_date)
+    store.append(path, "demux", pd.DataFrame({"intended": intended, "actual": actual.round()}), run_id, run_date)
+
+def test_update_incremental(tmp_path):
+    rng = np.random.default_rng(0)
+    for i in range(4):
+        _write_run(tmp_path, rng, f"run{i}")
+    model = calibration.update(tmp_path)
+    assert model["runs"] == ["run0", "run1", "run2", "run3"]
+    assert model["n"] == 32
+    _write_run(tmp_path, rng, "run4")
+    # only the new run is added, and the result is the same as fitting everything at once
+    model = calibration.update(tmp_path)
+    assert model["n"] == 40
+    (tmp_path / "calibration.json").unlink()
+    assert calibration.update(tmp_path)["coef"] == pytest.approx(model["coef"])
+    # a blend of KAPA corrected for size and Qubit
+    intercept, kapa, qubit, bp = model["coef"]
+    assert kapa + qubit == pytest.approx(1, abs=0.1)
+    assert bp == pytest.approx(kapa, abs=0.1)
+
+def test_observations_rerun(tmp_path):
+    rng = np.random.default_rng(0)
+    _write_run(tmp_path, rng, "run0")
+    _write_run(tmp_path, rng, "run1")
+    # run0 quantified and sequenced again a week later
+    _write_run(tmp_path, rng, "run0", run_date="2024-01-08")
+    df = calibration._observations(tmp_path)
+    assert df["run_id"].value_counts().to_dict() == {"run0": 8, "run1": 8}
+    assert (df.loc[df["run_id"] == "run0", "run_date"] == "2024-01-08").all()
+
+@pytest.mark.parametrize("runs,calibrated", [(4, True), (1, False)])
+def test_combine_calibrated(tmp_path, runs, calibrated):
+    rng = np.random.default_rng(1)
+    for i in range(runs):
+        _write_run(tmp_path / "store", rng, f"run{i}")
+    bp, true, kapa, qubit = _quants(rng, 50)
+    pd.DataFrame({"bp": bp, "ng/uL": 1, "nM": kapa}).to_csv(tmp_path / "quant_kapa.csv")
+    pd.DataFrame({"bp": bp, "ng/uL": 1, "nM": qubit}).iloc[::-1].to_csv(tmp_path / "quant_qubit.csv")
+    out = subprocess.run(["python", "-m", "miseq_tools", "--no-plots", "--store", str(tmp_path / "store"), "--run-id", "SPS9", "combine", "--calibrated"], capture_output=True, cwd=tmp_path)
+    assert out.returncode == 0, out.stderr.decode()
+    assert ("using the mean" in out.stderr.decode()) != calibrated
+    combined = pd.read_csv(tmp_path / "quant_combined.csv", index_col=0)
+    assert combined.index.tolist() == bp.index.tolist()
+    if calibrated:
+        # relative concentrations are what pooling needs, and the mean is thrown off by KAPA's size bias
+        cv = lambda nM: (nM / true).std() / (nM / true).mean()
+        assert cv(combined["nM"]) < 0.08 < 0.12 < cv((kapa + qubit) / 2)
+    else:
+        assert combined["nM"].tolist() == pytest.approx(((kapa + qubit) / 2).tolist())
+    assert json.loads((tmp_path / "store" / "calibration.json").read_text())["n"] == 8 * runs
+
+def test_combine_calibrated_needs_store(tmp_path):
+    pd.DataFrame({"bp": [300], "ng/uL": 1, "nM": 10}, index=pd.Index(["PoolA"], name="Pool label")).to_csv(tmp_path / "quant_kapa.csv")
+    pd.DataFrame({"bp": [300], "ng/uL": 1, "nM": 10}, index=pd.Index(["PoolA"], name="Pool label")).to_csv(tmp_path / "quant_qubit.csv")
+    out = subprocess.run(["python", "-m", "miseq_tools", "--no-plots", "combine", "--calibrated"], capture_output=True, cwd=tmp_path)
+    assert out.returncode != 0
+    assert "--store" in out.stderr.decode()
@@ -0,0 +1,41 @@
+import itertools
+import numpy as np
+import pytest
+from miseq_tools.collisions import index_collisions, safe_barcode_mismatches
+
+def _hamming(a, b):
+    # compare over the common prefix; N matches anything
+    return sum(x != y and 'N' not in (x, y) for x, y in zip(a, b))
+
+@pytest.mark.parametrize("block_size", [7, 1024])
+def test_matches_naive(block_size):
+    rng = np.random.default_rng(0)
+    def random_seqs(n, length, alphabet="ACGT"):
+        return ["".join(rng.choice(list(alphabet), length)) for _ in range(n)]
+    # mixed lengths and Ns
+    i7 = random_seqs(60, 8) + random_seqs(20, 6) + random_seqs(20, 8, "ACGTN")
+    i5 = random_seqs(100, 8)
+    pairs, min_distance = index_collisions(i7, i5, max_mismatches=4, block_size=block_size)
+    expected = [(a, b, _hamming(i7[a], i7[b]), _hamming(i5[a], i5[b])) for a, b in itertools.combinations(range(len(i7)), 2)]
+    assert min_distance == min(max(d7, d5) for _, _, d7, d5 in expected)
+    assert set(pairs[["a", "b", "i7", "i5"]].itertuples(index=False, name=None)) == {e for e in expected if max(e[2], e[3]) <= 4}
+
+@pytest.mark.parametrize("i7,i5,expected", [
+    (["AAAAAAAA", "AAAAAAAC"], ["CCCCCCCC", "CCCCCCCC"], [(0, 1, 1, 0)]),
+    # far apart on i5, so no collision even though i7 is identical
+    (["AAAAAAAA", "AAAAAAAA"], ["CCCCCCCC", "GGGGGGGG"], []),
+    # shorter index only compared over its length
+    (["AAAAAA", "AAAAAACC"], ["CCCCCCCC", "CCCCCCCC"], [(0, 1, 0, 0)]),
+])
+def test_collisions(i7, i5, expected):
+    pairs, _ = index_collisions(i7, i5)
+    assert list(pairs[["a", "b", "i7", "i5"]].itertuples(index=False, name=None)) == expected
+
+def test_single_index():
+    pairs, min_distance = index_collisions(["AAAAAAAA", "AAAAAAAC", "GGGGGGGG"])
+    assert list(pairs[["a", "b", "i7"]].itertuples(index=False, name=None)) == [(0, 1, 1)]
+    assert min_distance == 1
+
+@pytest.mark.parametrize("min_distance,expected", [(None, 2), (0, 0), (1, 0), (2, 0), (3, 1), (4, 1), (5, 2), (8, 2)])
+def test_safe_barcode_mismatches(min_distance, expected):
+    assert safe_barcode_mismatches(min_distance) == expected
@@ -0,0 +1,174 @@
+import io
+import json
+import os
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from miseq_tools.barcodes import reverse_complement
+from miseq_tools.demux_stats import _JSONStream, _read_stats_json, _read_demultiplex_stats_csv, read_demux_counts, attribute_unknown, sample_report
+
+STATS = {
+    "Flowcell": "TEST",
+    "RunNumber": 1,
+    "ConversionResults": [
+        {
+            "LaneNumber": 1,
+            "TotalClustersRaw": 2000,
+            "TotalClustersPF": 1500,
+            "Yield": 453000,
+            "DemuxResults": [
+                {"SampleId": "A", "SampleName": "A", "IndexMetrics": [{"IndexSequence": "AAAA+CCCC", "MismatchCounts": {"0": 1000, "1": 10}}], "NumberReads": 1010, "Yield": 305020, "ReadMetrics": [{"ReadNumber": 1, "Yield": 152510}]},
+                {"SampleId": "B", "SampleName": "B", "IndexMetrics": [], "NumberReads": 400, "Yield": 120800, "ReadMetrics": []},
+            ],
+            "Undetermined": {"NumberReads": 90, "Yield": 27180, "ReadMetrics": []},
+        },
+        {
+            "LaneNumber": 2,
+            "TotalClustersRaw": 1000,
+            "TotalClustersPF": 800,
+            "DemuxResults": [
+                {"SampleId": "B", "NumberReads": 500},
+                {"SampleId": "C", "NumberReads": 250},
+            ],
+            "Undetermined": {"NumberReads": 50},
+        },
+    ],
+    "UnknownBarcodes": [
+        {"Lane": 1, "Barcodes": {"GGGG+TTTT": 60, "NNNN+NNNN": 30}},
+        {"Lane": 2, "Barcodes": {"GGGG+TTTT": 50}},
+    ],
+}
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_read_stats_json(tmp_path, chunk_size, indent):
+    fname = tmp_path / "Stats.json"
+    with open(fname, "wt") as f:
+        json.dump(STATS, f, indent=indent)
+    counts = _read_stats_json(fname, chunk_size=chunk_size)
+    assert counts.actual().to_dict() == {"A": 1010, "B": 900, "C": 250}
+    lanes = counts.lane_summary()
+    assert lanes.index.tolist() == [1, 2]
+    assert lanes["TotalClustersPF"].tolist() == [1500, 800]
+    assert lanes["Assigned"].tolist() == [1410, 750]
+    assert lanes["Undetermined"].tolist() == [90, 50]
+    assert counts.unknown_barcodes.values.tolist() == [[1, "GGGG", "TTTT", 60], [1, "NNNN", "NNNN", 30], [2, "GGGG", "TTTT", 50]]
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 9])
+def test_read_stats_json_split_float(tmp_path, chunk_size):
+    fname = tmp_path / "Stats.json"
+    with open(fname, "wt") as f:
+        json.dump(dict(X=12.5e-3, **STATS), f)
+    counts = _read_stats_json(fname, chunk_size=chunk_size)
+    assert counts.actual().to_dict() == {"A": 1010, "B": 900, "C": 250}
+    stream = _JSONStream(io.StringIO('{"X": 12.5, "Y": -1e+10}'), chunk_size)
+    assert {key: stream.value() for key in stream.items()} == {"X": 12.5, "Y": -1e10}
+
+def test_read_stats_json_truncated(tmp_path):
+    fname = tmp_path / "Stats.json"
+    with open(fname, "wt") as f:
+        f.write(json.dumps(STATS)[:200])
+    with pytest.raises(ValueError):
+        _read_stats_json(fname, chunk_size=16)
+
+def _write_bclconvert(folder, single_index=False):
+    os.makedirs(folder, exist_ok=True)
+    rows = []
+    for lane in STATS["ConversionResults"]:
+        for sample in lane["DemuxResults"]:
+            rows.append(dict(Lane=lane["LaneNumber"], SampleID=sample["SampleId"], Index="AAAA-CCCC", **{"# Reads": sample["NumberReads"], "% Reads": 0.5}))
+        rows.append(dict(Lane=lane["LaneNumber"], SampleID="Undetermined", Index=None, **{"# Reads": lane["Undetermined"]["NumberReads"], "% Reads": 0.1}))
+    pd.DataFrame(rows).to_csv(os.path.join(folder, "Demultiplex_Stats.csv"), index=False)
+    unknown = pd.DataFrame([
+        dict(Lane=lane["Lane"], index=barcode.split("+")[0], index2=barcode.split("+")[1], **{"# Reads": n, "% of Unknown Barcodes": 0.5, "% of All Reads": 0.01})
+        for lane in STATS["UnknownBarcodes"] for barcode, n in lane["Barcodes"].items()
+    ])
+    # BCL Convert leaves out the index2 column for single-index runs
+    unknown.drop(columns="index2" if single_index else []).to_csv(os.path.join(folder, "Top_Unknown_Barcodes.csv"), index=False)
+
+@pytest.mark.parametrize("chunksize", [1, 1 << 16])
+@pytest.mark.parametrize("single_index", [False, True])
+def test_read_demultiplex_stats_csv(tmp_path, chunksize, single_index):
+    _write_bclconvert(tmp_path, single_index)
+    counts = _read_demultiplex_stats_csv(tmp_path / "Demultiplex_Stats.csv", chunksize=chunksize)
+    assert counts.actual().to_dict() == {"A": 1010, "B": 900, "C": 250}
+    lanes = counts.lane_summary()
+    assert lanes.index.tolist() == [1, 2]
+    assert lanes["TotalClustersPF"].tolist() == [1500, 800]
+    assert lanes["Undetermined"].tolist() == [90, 50]
+    assert counts.unknown_barcodes["reads"].tolist() == [60, 30, 50]
+    assert counts.unknown_barcodes["index"].tolist() == ["GGGG", "NNNN", "GGGG"]
+    assert (counts.unknown_barcodes["index2"] == "").all() == single_index
+
+def test_find_stats(tmp_path):
+    _write_bclconvert(tmp_path / "run" / "Analysis" / "1" / "Data" / "Reports")
+    counts = read_demux_counts(tmp_path / "run")
+    assert counts.actual().to_dict() == {"A": 1010, "B": 900, "C": 250}
+    os.makedirs(tmp_path / "empty")
+    with pytest.raises(FileNotFoundError, match="Could not find"):
+        read_demux_counts(tmp_path / "empty")
+
+SAMPLES = pd.DataFrame({
+    "Sample_ID": ["A", "B", "C"],
+    "index": ["ACCTGAAG", "TGGACTTC", "GATCCATG"],
+    "index2": ["GTTCAGCA", "CAAGTCGT", "AGTCTTCG"],
+    "Pool label": ["Pool1", "Pool1", "Pool2"],
+    "Reads (million)": [1, 1, 2],
+})
+
+@pytest.mark.parametrize("i7,i5,expected", [
+    ("NNNNNNNN", "GTTCAGCA", ("no call", None)),
+    ("ACCTGAAG", "CAAGTCGT", ("index hopping", "A")),
+    (reverse_complement("TGGACTTC"), "CAAGTCGT", ("i7 reverse complement", "B")),
+    ("GATCCATG", reverse_complement("AGTCTTCG"), ("i5 reverse complement", "C")),
+    ("GTTCAGCA", "ACCTGAAG", ("i7/i5 swapped", "A")),
+    ("ACCTGATT", "GTTCAGCA", ("mismatches", "A")),
+    ("ACCTTTTT", "GTTCAGCA", ("unknown", None)),
+    ("TTTTTTTT", "AAAAAAAA", ("unknown", None)),
+])
+def test_attribute_unknown(i7, i5, expected):
+    unknown = attribute_unknown(SAMPLES, pd.DataFrame({"Lane": [1, 2], "index": [i7, i7.lower()], "index2": i5, "reads": [10, 20]}))
+    assert unknown["reads"].tolist() == [10, 20]
+    for _, row in unknown.iterrows():
+        assert (row["cause"], None if pd.isna(row["Sample_ID"]) else row["Sample_ID"]) == expected
+
+def test_sample_report(tmp_path):
+    with open(tmp_path / "Stats.json", "wt") as f:
+        json.dump(STATS, f)
+    counts = _read_stats_json(tmp_path / "Stats.json")
+    unknown = attribute_unknown(SAMPLES, pd.DataFrame({
+        "Lane": 1,
+        "index": ["ACCTGAAG", "ACCTGATT", "GGGGGGGG"],
+        "index2": ["CAAGTCGT", "GTTCAGCA", "GGGGGGGG"],
+        "reads": [10, 4, 100],
+    }))
+    report = sample_report(SAMPLES, counts, unknown)
+    assert report["actual"].to_dict() == {"A": 1010, "B": 900, "C": 250}
+    assert report["intended"].to_dict() == {"A": 1e6, "B": 1e6, "C": 2e6}
+    # hopped reads are split between the two samples
+    assert report["unknown: index hopping"].to_dict() == {"A": 5, "B": 5, "C": 0}
+    assert report["unknown"].to_dict() == {"A": 9, "B": 5, "C": 0}
+
+
+def test_attribute_unknown_scales():
+    rng = np.random.default_rng(0)
+    bases = np.array(list("ACGT"))
+    random_indexes = lambda n: pd.Series(["".join(row) for row in bases[rng.integers(0, 4, (n, 10))]])
+    samples = pd.DataFrame({"Sample_ID": [f"S{i}" for i in range(384)], "index": random_indexes(384), "index2": random_indexes(384)})
+    unknown = pd.DataFrame({"Lane": np.repeat([1, 2], 50000), "index": random_indexes(100000), "index2": random_indexes(100000), "reads": rng.integers(1, 1000, 100000)})
+    t = time.perf_counter()
+    result = attribute_unknown(samples, unknown)
+    assert time.perf_counter() - t < 5
+    assert len(result) == len(unknown)
+
+def test_demux_cli(tmp_path):
+    with open(tmp_path / "Stats.json", "wt") as f:
+        json.dump(STATS, f)
+    SAMPLES.to_csv(tmp_path / "sheet.csv", index=False, columns=["Sample_ID", "index", "index", "index2", "index2", "Pool label", "Reads (million)", "Reads (million)"], header=["Sample_ID", "I7_Index_ID", "index", "I5_Index_ID", "index2", "Pool label", "Reads (million)", "Amplicon size (bp)"])
+    out = subprocess.run(["python", "-m", "miseq_tools", "--no-plots", "demux", "sheet.csv", "Stats.json", "-o", "demux"], capture_output=True, cwd=tmp_path)
+    assert out.returncode == 0, out.stderr.decode()
+    assert "unknown barcodes by likely cause" in out.stderr.decode()
+    assert pd.read_csv(tmp_path / "demux" / "demux_samples.csv", index_col=0)["actual"].to_dict() == {"A": 1010, "B": 900, "C": 250}
+    assert pd.read_csv(tmp_path / "demux" / "demux_unknown.csv")["cause"].tolist() == ["unknown", "no call", "unknown"]
@@ -2,6 +2,8 @@ import subprocess
 import pytest
 import tempfile
 import os
+import numpy as np
+import pandas as pd
 
 @pytest.mark.parametrize(['kapafolder', 'samplesheet'], [
     ('data/SPS246/kapadata', 'data/SPS246/SPS246 miseq - Sheet1.csv'),
@@ -19,3 +21,94 @@ def test_kapa(kapafolder, samplesheet):
         assert 'R²:' in txt
         assert 'Intercept:' in txt
     os.chdir(curdir)
+
+def _write_plate(folder, pools, slope=-3.32, intercept=12.0, replicates=3, cq_offsets=None):
+    # 6 standards in rows A-F, then each pool's replicates, shifted by cq_offsets[pool] if given
+    os.makedirs(folder, exist_ok=True)
+    rows = []
+    for level, row in enumerate("ABCDEF"):
+        sq = 20e-12 / 10 ** level
+        for rep in range(replicates):
+            rows.append(dict(Well=f"{row}{rep + 1:02d}", Content="Std", Cq=intercept + slope * np.log10(sq * 1e12), SQ=sq))
+    cq_offsets = cq_offsets or {}
+    for i, (pool, pm) in enumerate(pools.items(), 1):
+        for offset in cq_offsets.get(pool, [0] * replicates):
+            rows.append(dict(Well=f"G{len(rows) + 1:02d}", Content=f"Unkn-{i:02d}", Cq=intercept + slope * np.log10(pm) + offset, SQ=np.nan))
+    df = pd.DataFrame(rows)
+    df.insert(0, "", "")
+    df.to_csv(os.path.join(folder, "test -  Quantification Summary_0.csv"), index=False)
+    pd.DataFrame({
+        "Sample_ID": list(pools),
+        "Pool label": list(pools),
+        "Reads (million)": 1.0,
+        "Amplicon size (bp)": 399,
+        "a": "", "b": "", "c": "", "d": "",
+    }).to_csv(os.path.join(folder, "sheet.csv"), index=False)
+
+def test_kapa_batch(tmp_path):
+    _write_plate(tmp_path / "plate1", {"PoolA": 1, "PoolB": 2})
+    _write_plate(tmp_path / "plate2", {"PoolA": 4})
+    os.makedirs(tmp_path / "empty")
+    pd.DataFrame({
+        "kapafolder": ["plate1", "plate2", "empty"],
+        "samplesheet": ["plate1/sheet.csv", "plate2/sheet.csv", "plate1/sheet.csv"],
+    }).to_csv(tmp_path / "manifest.csv", index=False)
+    out = subprocess.run(["python", "-m", "miseq_tools", "kapa-batch", str(tmp_path / "manifest.csv"), "-o", str(tmp_path / "out"), "--workers", "2"], capture_output=True)
+    assert out.returncode == 0, out.stderr.decode()
+    assert "Could not find quantification summary data" in out.stderr.decode()
+    quant = pd.read_csv(tmp_path / "out" / "quant_kapa_batch.csv", index_col=[0, 1])
+    # 1 pM of a standard-sized amplicon, diluted 1e4, is 10 nM
+    assert quant["nM"].to_dict() == pytest.approx({("plate1", "PoolA"): 10, ("plate1", "PoolB"): 20, ("plate2", "PoolA"): 40})
+    qc = pd.read_csv(tmp_path / "out" / "quant_kapa_qc.csv", index_col=0)
+    assert qc["status"].to_dict() == {"plate1": "ok", "plate2": "ok", "empty": "failed"}
+    assert qc.loc["plate1", "r2"] == pytest.approx(1)
+    assert qc.loc["plate1", "delta_cq_min"] == pytest.approx(3.32)
+    assert qc.loc["plate1", "passed"]
+    assert not list((tmp_path / "out").glob("*.pdf"))
+
+def test_no_plots_then_render(tmp_path):
+    _write_plate(tmp_path / "plate", {"PoolA": 1, "PoolB": 2})
+    out = subprocess.run(["python", "-m", "miseq_tools", "--no-plots", "kapa", str(tmp_path / "plate"), str(tmp_path / "plate" / "sheet.csv")], capture_output=True, cwd=tmp_path)
+    assert out.returncode == 0, out.stderr.decode()
+    assert (tmp_path / "quant_kapa.csv").exists()
+    assert not list(tmp_path.glob("*.pdf"))
+    out = subprocess.run(["python", "-m", "miseq_tools", "render", str(tmp_path)], capture_output=True)
+    assert out.returncode == 0, out.stderr.decode()
+    assert {f.name for f in tmp_path.glob("*.pdf")} == {"quant_kapa.pdf", "quant_kapa_standards.pdf"}
+
+def test_plot_combined_order(tmp_path, monkeypatch):
+    import matplotlib.axes
+    from miseq_tools import plots
+    labels = dict()
+    monkeypatch.setattr(matplotlib.axes.Axes, "annotate", lambda self, text, xy, **kwargs: labels.update({text: xy}))
+    kapa = pd.DataFrame({"nM": [1, 2, 3]}, index=pd.Index(["PoolA", "PoolB", "PoolC"], name="Pool label"))
+    plots.plot_combined(kapa, (kapa * 10).iloc[::-1], tmp_path / "quant_combined.pdf")
+    assert labels == {"PoolA": (10, 1), "PoolB": (20, 2), "PoolC": (30, 3)}
+
+@pytest.mark.parametrize("drop_outliers", [False, True])
+def test_replicate_qc(tmp_path, drop_outliers):
+    # PoolA has a bad well, PoolB only two replicates, PoolC a failed well and 4 replicates
+    _write_plate(tmp_path / "plate", {"PoolA": 1, "PoolB": 2, "PoolC": 4}, cq_offsets={
+        "PoolA": [0, 0.1, 3],
+        "PoolB": [0, 0.3],
+        "PoolC": [0, 0.2, -0.1, np.nan],
+    })
+    out = subprocess.run(["python", "-m", "miseq_tools", "--no-plots", "kapa", str(tmp_path / "plate"), str(tmp_path / "plate" / "sheet.csv")] + (["--drop-outliers"] if drop_outliers else []), capture_output=True, cwd=tmp_path)
+    assert out.returncode == 0, out.stderr.decode()
+    assert "PoolA: outlier wells" in out.stderr.decode()
+    quant = pd.read_csv(tmp_path / "quant_kapa.csv", index_col=0)
+    assert quant.index.tolist() == ["PoolA", "PoolB", "PoolC"]
+    assert quant["outliers"].tolist() == [1, 0, 1]
+    assert quant["replicates"].tolist() == ([2, 2, 3] if drop_outliers else [3, 2, 3])
+    assert (quant.loc["PoolA", "nM"] == pytest.approx(10, rel=0.05)) == drop_outliers
+    assert (quant.loc["PoolA", "CV"] < 0.1) == drop_outliers
+    wells = pd.read_csv(tmp_path / "quant_kapa_wells.csv")
+    assert wells.groupby("Pool label")["outlier"].sum().to_dict() == {"PoolA": 1, "PoolB": 0, "PoolC": 1, "Standards": 0}
+
+def test_flag_outliers_vectorized():
+    from miseq_tools.quant_kapa import _flag_outliers
+    rng = np.random.default_rng(0)
+    pools = np.repeat(np.arange(128), 3)
+    cq = pd.Series(20 + rng.normal(0, 0.1, len(pools)))
+    cq[::30] += 5
+    assert _flag_outliers(cq, pd.Series(pools)).to_numpy().nonzero()[0].tolist() == list(range(0, len(pools), 30))
@@ -0,0 +1,77 @@
+import pytest
+from miseq_tools.pipeline import Stage, run_stages
+
+@pytest.fixture
+def stages(tmp_path):
+    calls = []
+    def copy(src, dst, suffix):
+        calls.append(dst)
+        with open(src) as f_in, open(dst, "w") as f_out:
+            f_out.write(f_in.read() + suffix)
+    (tmp_path / "input.txt").write_text("x")
+    a, b, c = (str(tmp_path / name) for name in ("input.txt", "a.txt", "b.txt"))
+    return calls, [
+        Stage("first", copy, [a], [b], dict(src=a, dst=b, suffix="1")),
+        Stage("second", copy, [b], [c], dict(src=b, dst=c, suffix="2")),
+    ]
+
+def test_skips_current_stages(tmp_path, stages):
+    calls, stages = stages
+    run_stages(stages, tmp_path)
+    assert len(calls) == 2
+    run_stages(stages, tmp_path)
+    assert len(calls) == 2
+    assert (tmp_path / "b.txt").read_text() == "x12"
+
+def test_reruns_on_changed_input(tmp_path, stages):
+    calls, stages = stages
+    run_stages(stages, tmp_path)
+    (tmp_path / "input.txt").write_text("y")
+    run_stages(stages, tmp_path)
+    assert len(calls) == 4
+    assert (tmp_path / "b.txt").read_text() == "y12"
+
+def test_reruns_on_changed_params(tmp_path, stages):
+    calls, stages = stages
+    run_stages(stages, tmp_path)
+    stages[1].params["suffix"] = "3"
+    run_stages(stages, tmp_path)
+    assert calls[2:] == [str(tmp_path / "b.txt")]
+
+def test_reruns_on_missing_output(tmp_path, stages):
+    calls, stages = stages
+    run_stages(stages, tmp_path)
+    (tmp_path / "b.txt").unlink()
+    run_stages(stages, tmp_path)
+    assert calls[2:] == [str(tmp_path / "b.txt")]
+
+def test_reruns_on_changed_output(tmp_path, stages):
+    calls, stages = stages
+    run_stages(stages, tmp_path)
+    # e.g. written by a run for another sample sheet
+    (tmp_path / "b.txt").write_text("other")
+    run_stages(stages, tmp_path)
+    assert calls[2:] == [str(tmp_path / "b.txt")]
+    assert (tmp_path / "b.txt").read_text() == "x12"
+
+def test_reruns_on_changed_flags(tmp_path, stages, monkeypatch):
+    calls, stages = stages
+    monkeypatch.setenv("MISEQ_TOOLS_NO_PLOTS", "1")
+    run_stages(stages, tmp_path)
+    monkeypatch.delenv("MISEQ_TOOLS_NO_PLOTS")
+    run_stages(stages, tmp_path)
+    assert len(calls) == 4
+
+def test_force(tmp_path, stages):
+    calls, stages = stages
+    run_stages(stages, tmp_path)
+    run_stages(stages, tmp_path, force=True)
+    assert len(calls) == 4
+
+def test_from_stage(tmp_path, stages):
+    calls, stages = stages
+    run_stages(stages, tmp_path)
+    run_stages(stages, tmp_path, from_stage="second")
+    assert calls[2:] == [str(tmp_path / "b.txt")]
+    with pytest.raises(AssertionError):
+        run_stages(stages, tmp_path, from_stage="third")
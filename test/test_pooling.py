@@ -1,8 +1,13 @@
 import pandas as pd
-from miseq_tools.pooling import _pools, _check_samples_used_exactly_once, _check_dilution
+import numpy as np
+from miseq_tools.pooling import _pools, _check_samples_used_exactly_once, _check_dilution, _check_volumes, _pools_milp
 import pytest
 import subprocess
+import time
+import json
+import pstats
 
+@pytest.mark.parametrize("solver", ["fast", "legacy", "milp"])
 @pytest.mark.parametrize("min_ul_pipettable", [1, 2])
 @pytest.mark.parametrize("max_ul_pipettable", [10, 5])
 @pytest.mark.parametrize("num_reads,concs", [
@@ -23,13 +28,13 @@ import subprocess
         "II": 54.082907,
     })
 ])
-def test_pooling(num_reads, concs, min_ul_pipettable, max_ul_pipettable):
-    if min_ul_pipettable == 2 and max_ul_pipettable == 5 and set(num_reads.keys()) == {'SPS303A', 'SPS303B', 'II'}:
-        pytest.skip("Impossible to solve")
+def test_pooling(num_reads, concs, min_ul_pipettable, max_ul_pipettable, solver):
+    if min_ul_pipettable == 2 and max_ul_pipettable == 5 and set(num_reads.keys()) == {'SPS303A', 'SPS303B', 'II'} and solver != "milp":
+        pytest.skip("Impossible to solve with greedy tiers")
 
     num_reads = pd.Series(num_reads)
     concs = pd.Series(concs)
-    pools = _pools(num_reads, concs, min_ul_pipettable=min_ul_pipettable, max_ul_pipettable=max_ul_pipettable)
+    pools = _pools(num_reads, concs, min_ul_pipettable=min_ul_pipettable, max_ul_pipettable=max_ul_pipettable, solver=solver)
 
     for pool_i, pool in enumerate(pools, 1):
         for sample, ul in pool.items():
@@ -49,6 +54,130 @@ def test_pooling(num_reads, concs, min_ul_pipettable, max_ul_pipettable):
     # check dilution is correct
     _check_dilution(pools, num_reads, concs)
 
+# the seeds in range(16) where legacy finds a valid plan; on 7 and 13 it never converges, on 1, 2 and 14 it returns
+# volumes below the minimum, and on 4 it drops one of two water additions to the same pool
+@pytest.mark.parametrize("seed", [0, 3, 5, 6, 8, 9, 10, 11, 12, 15])
+def test_solvers_agree(seed):
+    rng = np.random.default_rng(seed)
+    n = rng.integers(2, 20)
+    num_reads = pd.Series(rng.integers(100000, 50000000, n), index=[f"Sample{i}" for i in range(n)])
+    concs = pd.Series(rng.uniform(5, 80, n), index=num_reads.index)
+    pools_legacy = _pools(num_reads, concs, solver="legacy")
+    pools_fast = _pools(num_reads, concs, solver="fast")
+    assert len(pools_fast) == len(pools_legacy)
+    for pool_fast, pool_legacy in zip(pools_fast, pools_legacy):
+        assert pool_fast == pytest.approx(pool_legacy)
+
+def _wide_range(seed, n):
+    # concentrations spanning three orders of magnitude, where greedy tiering can run out of water
+    rng = np.random.default_rng(seed)
+    num_reads = pd.Series(rng.integers(1, 100, n) * 1000, index=[f"Sample{i}" for i in range(n)])
+    concs = pd.Series(np.exp(rng.uniform(np.log(16), np.log(24000), n)), index=num_reads.index)
+    return num_reads, concs
+
+@pytest.mark.parametrize("seed", [1, 2, 7, 13, 14])
+def test_fast_solver_bounds(seed):
+    # fails rather than returning volumes nobody can pipette, on the inputs legacy gets wrong
+    rng = np.random.default_rng(seed)
+    n = rng.integers(2, 20)
+    num_reads = pd.Series(rng.integers(100000, 50000000, n), index=[f"Sample{i}" for i in range(n)])
+    concs = pd.Series(rng.uniform(5, 80, n), index=num_reads.index)
+    with pytest.raises((AssertionError, RuntimeError), match="milp"):
+        _pools(num_reads, concs, solver="fast")
+    assert len(_pools(num_reads, concs, solver="milp")) >= 1
+
+def test_fast_solver_bounds_wide_range():
+    num_reads, concs = _wide_range(2, 20)
+    with pytest.raises(AssertionError, match="not enough water"):
+        _pools(num_reads, concs, solver="fast")
+
+@pytest.mark.parametrize("pools,ok", [
+    ([{"Sample1": 5, "Water": 5}], True),
+    ([{"Sample1": 2, "Water": 12}, {"Sample2": 12, "Prev Pool": 14}], True),
+    ([{"Sample1": 1e-5, "Water": 5}, {"Sample2": 5, "Prev Pool": 5}], False),
+    ([{"Sample1": 11, "Water": 5}, {"Sample2": 5, "Prev Pool": 5}], False),
+    ([{"Sample1": 5, "Water": 5}, {"Sample2": 5, "Prev Pool": 1}], False),
+    ([{"Sample1": 5, "Water": -1}], False),
+])
+def test_check_volumes(pools, ok):
+    if ok:
+        _check_volumes(pools, 2, 10)
+    else:
+        with pytest.raises(AssertionError):
+            _check_volumes(pools, 2, 10)
+
+def test_fast_solver_scales():
+    rng = np.random.default_rng(0)
+    n = 10000
+    num_reads = pd.Series(rng.integers(100000, 50000000, n), index=[f"Sample{i}" for i in range(n)])
+    concs = pd.Series(rng.uniform(5, 80, n), index=num_reads.index)
+    t = time.perf_counter()
+    pools = _pools(num_reads, concs, min_ul_total=10 * n, solver="fast")
+    assert time.perf_counter() - t < 1
+    _check_samples_used_exactly_once(pools, set(num_reads.index))
+    _check_dilution(pools, num_reads, concs)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_milp_solver(seed):
+    # never more pools or pipetting steps than the greedy solver, and always within the pipetting limits
+    rng = np.random.default_rng(seed)
+    n = 100
+    num_reads = pd.Series(rng.integers(100000, 50000000, n), index=[f"Sample{i}" for i in range(n)])
+    concs = pd.Series(rng.uniform(5, 80, n), index=num_reads.index)
+    t = time.perf_counter()
+    pools = _pools(num_reads, concs, solver="milp")
+    assert time.perf_counter() - t < 5
+    pools_fast = _pools(num_reads, concs, solver="fast")
+    assert len(pools) <= len(pools_fast)
+    assert sum(map(len, pools)) <= sum(map(len, pools_fast))
+    for pool in pools[:-1]:
+        assert all(2 <= ul <= 10 for sample, ul in pool.items() if sample != "Prev Pool")
+    assert all(2 <= ul for ul in pools[-1].values())
+    assert sum(pools[-1].values()) == pytest.approx(10)
+    _check_samples_used_exactly_once(pools, set(num_reads.index))
+
+@pytest.mark.parametrize("seed", range(3))
+def test_milp_solver_wide_range(seed):
+    # where the greedy solver mostly can't find a plan at all (it can for seed 1)
+    num_reads, concs = _wide_range(seed, 50)
+    t = time.perf_counter()
+    pools = _pools(num_reads, concs, solver="milp")
+    assert time.perf_counter() - t < 10
+    _check_samples_used_exactly_once(pools, set(num_reads.index))
+    _check_dilution(pools, num_reads, concs)
+    try:
+        pools_fast = _pools(num_reads, concs, solver="fast")
+    except (AssertionError, RuntimeError):
+        return
+    assert len(pools) <= len(pools_fast)
+
+def test_milp_solver_time_limit():
+    # the limit covers the whole search, not each model solved along the way
+    num_reads, concs = _wide_range(0, 200)
+    t = time.perf_counter()
+    with pytest.raises(AssertionError, match="within 2 s"):
+        _pools_milp(num_reads, concs, time_limit=2)
+    assert time.perf_counter() - t < 4
+
+def _narrow_range(n):
+    rng = np.random.default_rng(0)
+    num_reads = pd.Series(rng.integers(100000, 50000000, n), index=[f"Sample{i}" for i in range(n)])
+    return num_reads, pd.Series(rng.uniform(5, 80, n), index=num_reads.index)
+
+def test_milp_solver_greedy_optimal():
+    # no plan has fewer tiers and water additions than the greedy one here, so there's nothing to search for
+    num_reads, concs = _narrow_range(200)
+    t = time.perf_counter()
+    assert _pools(num_reads, concs, min_ul_total=2000, solver="milp") == _pools(num_reads, concs, min_ul_total=2000, solver="fast")
+    assert time.perf_counter() - t < 1
+
+def test_milp_solver_greedy_fallback(caplog):
+    # out of time, the greedy plan is better than none
+    num_reads, concs = _narrow_range(100)
+    pools = _pools(num_reads, concs, max_ul_pipettable=5, min_ul_total=1000, solver="milp", time_limit=0)
+    assert pools == _pools(num_reads, concs, max_ul_pipettable=5, min_ul_total=1000, solver="fast")
+    assert "within 0 s" in caplog.text
+
 def test_pool_cli():
     out = subprocess.run(["python", "-m", "miseq_tools", "pool", "test/data/SPS303 miseq - Sheet1.csv", "test/data/quant_combined.csv"])
     assert out.returncode == 0
@@ -97,3 +226,49 @@ def test_check_dilutions(kwargs, expected):
     else:
         with pytest.raises(AssertionError):
             _check_dilution(**kwargs)
+
+def _write_run(tmp_path, run, concs):
+    pd.DataFrame({
+        "Sample_ID": [f"{pool}_{i}" for pool in concs for i in range(2)],
+        "I7_Index_ID": "",
+        "index": "",
+        "I5_Index_ID": "",
+        "index2": "",
+        "Pool label": [pool if i == 0 else None for pool in concs for i in range(2)],
+        "Reads (million)": 1.0,
+        "Amplicon size (bp)": 300,
+    }).to_csv(tmp_path / f"{run}.csv", index=False)
+    pd.DataFrame({"bp": 300, "ng/uL": 1, "nM": concs}).to_csv(tmp_path / f"{run}_quant.csv")
+
+def test_pool_batch(tmp_path):
+    _write_run(tmp_path, "good", {"PoolA": 10, "PoolB": 40})
+    _write_run(tmp_path, "bad", {"PoolA": 1, "PoolB": 1})
+    pd.DataFrame({
+        "samplesheet": ["good.csv", "bad.csv"],
+        "quant_csv": ["good_quant.csv", "bad_quant.csv"],
+    }).to_csv(tmp_path / "manifest.csv", index=False)
+    out = subprocess.run(["python", "-m", "miseq_tools", "pool-batch", str(tmp_path / "manifest.csv"), "-o", str(tmp_path / "out"), "--workers", "2"], capture_output=True)
+    assert out.returncode == 0
+    assert "not concentrated enough" in out.stderr.decode()
+    summary = pd.read_csv(tmp_path / "out" / "pooling_batch.csv", index_col=0)
+    assert summary.loc["good", "status"] == "ok"
+    assert summary.loc["bad", "status"] == "failed"
+    assert (tmp_path / "out" / "good_pooling.txt").exists()
+    assert not (tmp_path / "out" / "bad_pooling.txt").exists()
+
+@pytest.mark.parametrize("solver", ["fast", "legacy", "milp"])
+def test_profile(tmp_path, solver):
+    _write_run(tmp_path, "run", {"PoolA": 10, "PoolB": 40})
+    out = subprocess.run(["python", "-m", "miseq_tools", "--profile", str(tmp_path / "profile.json"), "--profile-pstats", str(tmp_path / "profile.pstats"),
+                          "pool", str(tmp_path / "run.csv"), str(tmp_path / "run_quant.csv"), "--solver", solver, "--time-limit", "5"], capture_output=True)
+    assert out.returncode == 0
+    with open(tmp_path / "profile.json") as f:
+        trace = json.load(f)
+    assert [stage["name"] for stage in trace["stages"]] == ["import", "parse", "solve", "validate", "write"]
+    assert all(stage["wall_s"] >= 0 and stage["cpu_s"] >= 0 for stage in trace["stages"])
+    assert trace["peak_rss_bytes"] > 0
+    peaks = [stage["process_peak_rss_bytes"] for stage in trace["stages"]]
+    assert peaks == sorted(peaks) and peaks[-1] <= trace["peak_rss_bytes"]
+    assert trace["counters"]["pools_iterations"] >= 1
+    assert trace["counters"]["assign_dilution_factors"] >= 1
+    pstats.Stats(str(tmp_path / "profile.pstats"))
@@ -0,0 +1,76 @@
+import subprocess
+import pandas as pd
+import pytest
+from miseq_tools.quant_qubit import read_qubit_export
+from .test_kapa import _write_plate
+from .test_samplesheet import _write_sheet
+
+def _write_flex(fname):
+    # as exported by a Qubit Flex, with replicate readings and one out of range
+    pd.DataFrame({
+        "Run ID": 1,
+        "Well": ["A1", "A2", "A3", "A4"],
+        "Sample Name": ["PoolA", "PoolA", "PoolB", "PoolC"],
+        "Original Sample Conc.": ["10", "12", "2500", "Too Low"],
+        "Original sample conc. units": ["ng/µL", "ng/µL", "ng/mL", "ng/µL"],
+        "Qubit® Tube Conc.": 1,
+    }).to_csv(fname, index=False, encoding="utf-8-sig")
+
+def _write_qubit4(fname):
+    # column order of a Qubit 4 export, where the tube concentration and its units come before the sample's
+    pd.DataFrame({
+        "Run ID": 1,
+        "Assay Name": "dsDNA HS",
+        "Test Date": "2024-06-30",
+        "Sample Name": ["PoolA", "PoolB"],
+        "Qubit® Tube Conc.": [50, 100],
+        "Qubit® Tube Conc. Units": "ng/mL",
+        "Original Sample Conc.": [10, 20],
+        "Original sample conc. units": "ng/µL",
+        "Sample Volume (µL)": 1,
+    }).to_csv(fname, index=False, encoding="utf-8-sig")
+
+@pytest.mark.parametrize("write,expected", [(_write_flex, {"PoolA": 11, "PoolB": 2.5}), (_write_qubit4, {"PoolA": 10, "PoolB": 20})])
+def test_read_qubit_export(tmp_path, write, expected):
+    write(tmp_path / "qubit.csv")
+    assert read_qubit_export(tmp_path / "qubit.csv").to_dict() == pytest.approx(expected)
+
+def test_read_qubit_export_wells(tmp_path):
+    pd.DataFrame({"Well": ["A01", "B01", "C01"], "Concentration": [4, 6, 8]}).to_csv(tmp_path / "reader.csv", index=False)
+    pd.DataFrame({"Well": ["A1", "B1", "C1"], "Pool label": ["PoolA", "PoolA", "PoolB"]}).to_csv(tmp_path / "wells.csv", index=False)
+    assert read_qubit_export(tmp_path / "reader.csv", tmp_path / "wells.csv").to_dict() == {"PoolA": 5, "PoolB": 8}
+
+def test_read_qubit_export_units(tmp_path):
+    pd.DataFrame({"Sample Name": ["PoolA"], "Original Sample Conc.": [1], "Original sample conc. units": ["nM"]}).to_csv(tmp_path / "flex.csv", index=False)
+    with pytest.raises(AssertionError, match="Unknown concentration units"):
+        read_qubit_export(tmp_path / "flex.csv")
+
+@pytest.mark.parametrize("prompt", [True, False])
+def test_qubit_cli(tmp_path, prompt):
+    _write_plate(tmp_path / "plate", {"PoolA": 1, "PoolB": 2, "PoolC": 4})
+    _write_flex(tmp_path / "flex.csv")
+    out = subprocess.run(["python", "-m", "miseq_tools", "qubit", str(tmp_path / "plate" / "sheet.csv"), "--export", str(tmp_path / "flex.csv")] + ([] if prompt else ["--no-prompt"]),
+                         input=b"7\n", capture_output=True, cwd=tmp_path)
+    if not prompt:
+        assert out.returncode != 0
+        assert "No Qubit reading for PoolC" in out.stderr.decode()
+        return
+    assert out.returncode == 0, out.stderr.decode()
+    # only the missing pool is asked for
+    assert out.stdout.decode().count("ng/uL for") == 1
+    quant = pd.read_csv(tmp_path / "quant_qubit.csv", index_col=0)
+    assert quant["ng/uL"].to_dict() == pytest.approx({"PoolA": 11, "PoolB": 2.5, "PoolC": 7})
+    assert quant["nM"].to_dict() == pytest.approx((1e6 * quant["ng/uL"] / (399 * 617.9)).to_dict())
+
+def test_pre_headless(tmp_path):
+    _write_plate(tmp_path / "plate", {"PoolA": 1, "PoolB": 2})
+    fname = _write_sheet(tmp_path / "sheet.csv", [
+        ("a", "i7a", "AAAAAAAA", "i5a", "CCCCCCCC", "PoolA", 1, 399),
+        ("b", "i7b", "GGGGGGGG", "i5b", "TTTTTTTT", "PoolB", 1, 399),
+        ("c", "i7c", "ACGTACGT", "i5c", "TGCATGCA", "PoolB", 1, 399),
+    ])
+    pd.DataFrame({"Sample Name": ["PoolA", "PoolB"], "Original Sample Conc.": [3, 6], "Original sample conc. units": "ng/µL"}).to_csv(tmp_path / "flex.csv", index=False)
+    out = subprocess.run(["python", "-m", "miseq_tools", "--no-plots", "pre", str(fname), str(tmp_path / "plate"), "--qubit-export", str(tmp_path / "flex.csv"), "--no-prompt"],
+                         stdin=subprocess.DEVNULL, capture_output=True, cwd=tmp_path)
+    assert out.returncode == 0, out.stderr.decode()
+    assert out.stdout.decode().startswith("Pool 1")
@@ -0,0 +1,44 @@
+import json
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from miseq_tools.rebalance import rebalance_targets
+from .test_pooling import _write_run
+
+def test_rebalance_targets():
+    df_pool = pd.DataFrame({"intended": [2e6, 2e6, 1e6], "actual": [1.5e6, 0.5e6, 0]}, index=pd.Index(["PoolA", "PoolB", "PoolC"], name="Pool label"))
+    targets = rebalance_targets(df_pool, pd.Series({"PoolC": 5, "PoolB": 40, "PoolA": 10}))
+    # PoolA got 1.5x its share of reads, so was 1.5x more concentrated than measured
+    assert targets["effective nM"].tolist() == pytest.approx([10 * 1.5 / (4 / 5), 40 * 0.5 / (4 / 5), 5])
+    assert targets["deficit"].tolist() == [0.5e6, 1.5e6, 1e6]
+
+def test_rebalance_targets_missing_quant():
+    df_pool = pd.DataFrame({"intended": [1e6], "actual": [1e6]}, index=["PoolA"])
+    with pytest.raises(AssertionError, match="No quantification for PoolA"):
+        rebalance_targets(df_pool, pd.Series({"PoolB": 10}))
+
+def test_rebalance_targets_scales():
+    rng = np.random.default_rng(0)
+    n = 10000
+    df_pool = pd.DataFrame({"intended": rng.integers(1e5, 1e7, n), "actual": rng.integers(0, 1e7, n)}, index=[f"Pool{i}" for i in range(n)])
+    t = time.perf_counter()
+    targets = rebalance_targets(df_pool, pd.Series(rng.uniform(5, 80, n), index=df_pool.index))
+    assert time.perf_counter() - t < 1
+    assert (targets["deficit"] >= 0).all()
+
+def test_rebalance_cli(tmp_path):
+    _write_run(tmp_path, "run", {"PoolA": 10, "PoolB": 40})
+    with open(tmp_path / "Stats.json", "wt") as f:
+        json.dump({"ConversionResults": [{
+            "LaneNumber": 1, "TotalClustersRaw": 3000000, "TotalClustersPF": 2500000,
+            "DemuxResults": [{"SampleId": sample, "NumberReads": n} for sample, n in [("PoolA_0", 1000000), ("PoolA_1", 500000), ("PoolB_0", 250000), ("PoolB_1", 250000)]],
+            "Undetermined": {"NumberReads": 500000},
+        }]}, f)
+    out = subprocess.run(["python", "-m", "miseq_tools", "rebalance", str(tmp_path / "run.csv"), str(tmp_path / "run_quant.csv"), str(tmp_path / "Stats.json"), "-o", str(tmp_path / "topup")], capture_output=True)
+    assert out.returncode == 0, out.stderr.decode()
+    assert out.stdout.decode().startswith("Pool 1")
+    targets = pd.read_csv(tmp_path / "topup" / "rebalance.csv", index_col=0)
+    assert targets["deficit"].to_dict() == {"PoolA": 0.5e6, "PoolB": 1.5e6}
+    assert targets["effective nM"].to_dict() == pytest.approx({"PoolA": 15, "PoolB": 20})
@@ -1,4 +1,4 @@
-from miseq_tools.samplesheet import check_indexes
+from miseq_tools.samplesheet import check_indexes, check_collisions, format_samplesheet
 import pandas as pd
 import logging
 import pytest
@@ -32,3 +32,40 @@ def test_swapped(caplog):
     with caplog.at_level(logging.WARNING):
         check_indexes(df)
     assert 'swapped' in caplog.text
+
+def test_collisions(caplog):
+    df = pd.DataFrame.from_records([
+        dict(Sample_ID="a", index="AAAAAAAA", index2="CCCCCCCC"),
+        dict(Sample_ID="b", index="AAAAAAAT", index2="CCCCCCCC"),
+        dict(Sample_ID="c", index="GGGGGGGG", index2="TTTTTTTT"),
+    ])
+    with caplog.at_level(logging.INFO):
+        check_collisions(df)
+    assert "['a', 'b', 1, 0]" in caplog.text
+    assert "Maximum safe BarcodeMismatches: 0" in caplog.text
+
+def _write_sheet(path, rows, index_len=8):
+    # raw layout: sample columns, a blank column, then read info in columns 9 and 10 of the first four lines
+    df = pd.DataFrame.from_records(rows, columns=["Sample_ID", "I7_Index_ID", "index", "I5_Index_ID", "index2", "Pool label", "Reads (million)", "Amplicon size (bp)"])
+    info = [("Read 2", 151), ("Index 1 (i7)", index_len), ("Index 2 (i5)", index_len)]
+    df[""] = ""
+    df["Read 1"] = [k for k, _ in info] + [""] * (len(df) - 3)
+    df["151"] = [v for _, v in info] + [""] * (len(df) - 3)
+    df.to_csv(path, index=False)
+    return path
+
+def test_format_samplesheet(tmp_path):
+    fname = _write_sheet(tmp_path / "in.csv", [
+        ("a", "i7a", "AAAAAAAA", "i5a", "CCCCCCCC", "Pool1", 1, 300),
+        ("b", "i7b", "GGGGGGGG", "i5b", "TTTTTTTT", None, 1, 300),
+        ("c", "i7c", "ACGTACGT", "i5c", "TGCATGCA", "Pool2", 1, 300),
+    ])
+    format_samplesheet(fname, tmp_path / "out.csv")
+    lines = (tmp_path / "out.csv").read_text().splitlines()
+    assert lines[:2] == ["[Header],,,,", "IEMFileVersion,4,,,"]
+    assert lines[lines.index("[Data],,,,") + 1:] == [
+        "Sample_ID,I7_Index_ID,index,I5_Index_ID,index2",
+        "a,i7a,AAAAAAAA,i5a,CCCCCCCC",
+        "b,i7b,GGGGGGGG,i5b,TTTTTTTT",
+        "c,i7c,ACGTACGT,i5c,TGCATGCA",
+    ]
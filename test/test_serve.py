@@ -0,0 +1,70 @@
+import http.client
+import json
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from miseq_tools.serve import make_server
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+@pytest.fixture(params=["tcp", "unix"])
+def connect(request, tmp_path):
+    if request.param == "tcp":
+        server = make_server(port=0, workers=4)
+        connect = lambda: http.client.HTTPConnection(*server.server_address[:2])
+    else:
+        server = make_server(socket=str(tmp_path / "miseq_tools.sock"), workers=4)
+        connect = lambda: _UnixConnection(str(tmp_path / "miseq_tools.sock"))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield connect
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+def _request(connect, method, path, body=None):
+    conn = connect()
+    conn.request(method, path, body=None if body is None else json.dumps(body), headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    result = response.status, json.loads(response.read())
+    conn.close()
+    return result
+
+def test_health(connect):
+    status, body = _request(connect, "GET", "/health")
+    assert status == 200
+    assert body["endpoints"] == ["/demux", "/kapa", "/pool", "/sheet"]
+
+def test_pool(connect):
+    status, body = _request(connect, "POST", "/pool", dict(num_reads={"PoolA": 1000, "PoolB": 1000}, concs={"PoolA": 10, "PoolB": 40}))
+    assert status == 200
+    assert set().union(*body["pools"]) >= {"PoolA", "PoolB", "Water"}
+    assert body["text"].startswith("Pool 1")
+
+@pytest.mark.parametrize("path,body,expected", [
+    ("/pool", dict(num_reads={"PoolA": 1000}, concs={"PoolA": 0.1}), (400, "not concentrated enough")),
+    ("/pool", dict(), (400, "Need samplesheet")),
+    ("/pool", dict(num_reads={"PoolA": 1000}, concs={"PoolA": 10}, bogus=1), (400, "bogus")),
+    ("/kapa", dict(kapafolder="missing", samplesheet="missing.csv"), (400, "No such file")),
+    ("/sheet", dict(samplesheet="missing.csv", fname_out="/tmp/out.csv"), (400, "fname_out")),
+    ("/nothing", dict(), (404, "Unknown endpoint")),
+])
+def test_errors(connect, path, body, expected):
+    status, body = _request(connect, "POST", path, body)
+    assert status == expected[0]
+    assert expected[1] in body["error"]
+
+def test_concurrent(connect):
+    # within the range the fast solver can pool
+    concs = [{"PoolA": 10, "PoolB": 10 + 3 * i} for i in range(16)]
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda c: _request(connect, "POST", "/pool", dict(num_reads={"PoolA": 1000, "PoolB": 1000}, concs=c)), concs))
+    assert all(status == 200 for status, _ in results)
@@ -0,0 +1,42 @@
+import subprocess
+import pandas as pd
+import pytest
+from miseq_tools.shard import assign_shards
+from .test_samplesheet import _write_sheet
+
+@pytest.mark.parametrize("reads,conflicts,capacity,lanes,expected", [
+    # first-fit decreasing fills the first run before opening another
+    ({"A": 6, "B": 5, "C": 4, "D": 3}, {}, 10, 1, {"A": (1, 1), "B": (2, 1), "C": (1, 1), "D": (2, 1)}),
+    # colliding pools go in different lanes even when there is room
+    ({"A": 2, "B": 2}, {"A": {"B"}, "B": {"A"}}, 10, 1, {"A": (1, 1), "B": (2, 1)}),
+    # lanes fill before runs
+    ({"A": 4, "B": 4, "C": 4}, {}, 10, 2, {"A": (1, 1), "B": (1, 2), "C": (2, 1)}),
+    # exactly full
+    ({"A": 5, "B": 5}, {}, 10, 1, {"A": (1, 1), "B": (1, 1)}),
+])
+def test_assign_shards(reads, conflicts, capacity, lanes, expected):
+    shards = assign_shards(pd.Series(reads, dtype=float), conflicts, capacity / lanes, lanes)
+    assert {pool: (row.run, row.lane) for pool, row in shards.iterrows()} == expected
+
+def test_assign_shards_too_big():
+    with pytest.raises(AssertionError, match="more reads than one lane"):
+        assign_shards(pd.Series({"A": 11.0}), {}, 10)
+
+def test_shard_cli(tmp_path):
+    # Pool3 is one mismatch from Pool1, so they can't share a run
+    fname = _write_sheet(tmp_path / "big.csv", [
+        ("a", "i7a", "AAAAAAAA", "i5a", "CCCCCCCC", "Pool1", 6, 300),
+        ("b", "i7b", "GGGGGGGG", "i5b", "TTTTTTTT", "Pool2", 3, 300),
+        ("c", "i7c", "AAAAAAAT", "i5c", "CCCCCCCC", "Pool3", 2, 300),
+        ("d", "i7d", "ACGTACGT", "i5d", "TGCATGCA", "Pool4", 4, 300),
+    ])
+    pd.DataFrame({"bp": 300, "ng/uL": 5, "nM": [20, 30, 40, 50]}, index=pd.Index(["Pool1", "Pool2", "Pool3", "Pool4"], name="Pool label")).to_csv(tmp_path / "quant.csv")
+    out = subprocess.run(["python", "-m", "miseq_tools", "shard", str(fname), "--capacity", "10", "--quant", str(tmp_path / "quant.csv"), "-o", str(tmp_path / "out")], capture_output=True)
+    assert out.returncode == 0, out.stderr.decode()
+    shards = pd.read_csv(tmp_path / "out" / "big_shards.csv", index_col=0)
+    assert shards.loc["Pool1", "run"] != shards.loc["Pool3", "run"]
+    assert (shards.groupby("run")["Reads (million)"].sum() <= 10).all()
+    for run in shards["run"].unique():
+        lines = (tmp_path / "out" / f"big_run{run}.csv").read_text().splitlines()
+        assert {line.split(",")[0] for line in lines[lines.index("Sample_ID,I7_Index_ID,index,I5_Index_ID,index2") + 1:]} == set(shards.index[shards["run"] == run].map({"Pool1": "a", "Pool2": "b", "Pool3": "c", "Pool4": "d"}))
+        assert (tmp_path / "out" / f"big_run{run}_pooling.txt").read_text().startswith("Pool 1")
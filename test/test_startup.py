@@ -0,0 +1,36 @@
+import subprocess
+import sys
+import pytest
+from miseq_tools import main, pooling
+
+SUBCOMMANDS = ["sheet", "kapa", "kapa-batch", "qubit", "combine", "pool", "pool-batch", "pre", "demux", "rebalance", "render", "serve", "shard", "watch", "history"]
+HEAVY_MODULES = ["pandas", "matplotlib", "seaborn", "scipy", "Bio"]
+
+@pytest.mark.parametrize("args", [["--help"]] + [[subcommand, "--help"] for subcommand in SUBCOMMANDS])
+def test_help_is_lazy(args):
+    code = f"""
+import sys
+from miseq_tools.main import main
+sys.argv = ["miseq-tools"] + {args!r}
+try:
+    main()
+except SystemExit:
+    pass
+print("LOADED:" + ",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))
+"""
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True)
+    assert out.returncode == 0
+    assert out.stdout.decode().strip().splitlines()[-1] == "LOADED:"
+
+def test_solvers_in_sync():
+    assert tuple(main.SOLVERS) == tuple(pooling.SOLVERS)
+
+@pytest.mark.parametrize("subcommand,options", [
+    (subcommand, ["--min-ul-pipettable", "--max-ul-pipettable", "--min-ul-total", "--solver", "--time-limit"]) for subcommand in ["pool", "pool-batch", "shard", "rebalance"]
+] + [
+    (subcommand, ["--dilution", "--standard-bp", "--drop-outliers", "--outlier-z", "--outlier-min-cq"]) for subcommand in ["kapa", "kapa-batch"]
+])
+def test_shared_options(subcommand, options):
+    out = subprocess.run([sys.executable, "-m", "miseq_tools", subcommand, "--help"], capture_output=True, text=True)
+    assert out.returncode == 0
+    assert all(option in out.stdout for option in options)
@@ -0,0 +1,77 @@
+import io
+import os
+import subprocess
+import pandas as pd
+import pytest
+from .test_kapa import _write_plate
+from .test_samplesheet import _write_sheet
+
+pytest.importorskip("pyarrow")
+from miseq_tools import store
+
+def _quant(nM):
+    return pd.DataFrame({"bp": 300, "nM": nM}, index=pd.Index([f"Pool{i}" for i in range(len(nM))], name="Pool label"))
+
+def test_append_read(tmp_path):
+    store.append(tmp_path, "kapa", _quant([1, 2]), "run1", "2024-01-01")
+    store.append(tmp_path, "kapa", _quant([3]), "run 2/b", "2024-06-01")
+    # older runs are missing newer columns
+    store.append(tmp_path, "kapa", _quant([4]).assign(CV=0.1), "run3", "2025-01-01")
+    df = store.read(tmp_path, "kapa")
+    assert df["run_id"].tolist() == ["run1", "run1", "run 2/b", "run3"]
+    assert df["nM"].tolist() == [1, 2, 3, 4]
+    assert df["CV"].isna().tolist() == [True, True, True, False]
+    assert store.read(tmp_path, "kapa", since="2024-02-01", until="2024-12-31")["run_id"].tolist() == ["run 2/b"]
+    assert store.read(tmp_path, "kapa", run_ids=["run3"], columns=["nM"]).columns.tolist() == ["run_date", "run_id", "nM"]
+
+def test_append_replaces_run(tmp_path):
+    store.append(tmp_path, "qubit", _quant([1, 2]), "run1", "2024-01-01")
+    store.append(tmp_path, "qubit", _quant([5]), "run1", "2024-01-01")
+    # the same run name on another date is kept
+    store.append(tmp_path, "qubit", _quant([6]), "run1", "2024-01-02")
+    df = store.read(tmp_path, "qubit")
+    assert df[["run_date", "nM"]].values.tolist() == [["2024-01-01", 5], ["2024-01-02", 6]]
+
+def test_record_run_id(tmp_path, monkeypatch):
+    monkeypatch.setenv("MISEQ_TOOLS_STORE", str(tmp_path))
+    monkeypatch.delenv("MISEQ_TOOLS_RUN_ID", raising=False)
+    monkeypatch.setenv("MISEQ_TOOLS_RUN_DATE", "2024-01-01")
+    store.record("kapa", _quant([1]), "runs/SPS1.csv")
+    store.record("combined", _quant([1]), "SPS1.csv")
+    monkeypatch.setenv("MISEQ_TOOLS_RUN_ID", "named")
+    store.record("kapa", _quant([2]), "runs/SPS1.csv")
+    assert store.read(tmp_path, "kapa")["run_id"].tolist() == ["SPS1", "named"]
+    assert store.read(tmp_path, "combined")["run_id"].tolist() == ["SPS1"]
+    monkeypatch.delenv("MISEQ_TOOLS_RUN_ID")
+    with pytest.raises(AssertionError, match="--run-id"):
+        store.record("combined", _quant([1]))
+
+def test_store_cli(tmp_path):
+    # two runs on two dates, both from the same working directory
+    for run, pm, date in [("SPS1", 1, "2024-06-30"), ("SPS2", 2, "2024-07-01")]:
+        _write_plate(tmp_path / run, {"PoolA": pm})
+        os.rename(tmp_path / run / "sheet.csv", tmp_path / run / f"{run}.csv")
+        out = subprocess.run(["python", "-m", "miseq_tools", "--no-plots", "--store", str(tmp_path / "store"), "--run-date", date,
+                              "kapa", str(tmp_path / run), str(tmp_path / run / f"{run}.csv")], capture_output=True, cwd=tmp_path)
+        assert out.returncode == 0, out.stderr.decode()
+    out = subprocess.run(["python", "-m", "miseq_tools", "history", str(tmp_path / "store"), "kapa", "--columns", "nM"], capture_output=True)
+    assert out.returncode == 0, out.stderr.decode()
+    df = pd.read_csv(io.StringIO(out.stdout.decode()))
+    assert df["run_date"].tolist() == ["2024-06-30", "2024-07-01"]
+    assert df.set_index("run_id")["nM"].to_dict() == pytest.approx({"SPS1": 10, "SPS2": 20})
+
+def test_store_cached_pre(tmp_path):
+    # a pre run that's already cached is still recorded when --store is added
+    _write_plate(tmp_path / "plate", {"PoolA": 1, "PoolB": 2})
+    fname = _write_sheet(tmp_path / "SPS1.csv", [
+        ("a", "i7a", "AAAAAAAA", "i5a", "CCCCCCCC", "PoolA", 1, 399),
+        ("b", "i7b", "GGGGGGGG", "i5b", "TTTTTTTT", "PoolB", 1, 399),
+        ("c", "i7c", "ACGTACGT", "i5c", "TGCATGCA", "PoolB", 1, 399),
+    ])
+    pd.DataFrame({"Sample Name": ["PoolA", "PoolB"], "Original Sample Conc.": [3, 6], "Original sample conc. units": "ng/µL"}).to_csv(tmp_path / "flex.csv", index=False)
+    for options in ([], ["--store", str(tmp_path / "store")]):
+        out = subprocess.run(["python", "-m", "miseq_tools", "--no-plots", *options, "pre", str(fname), str(tmp_path / "plate"), "--qubit-export", str(tmp_path / "flex.csv"), "--no-prompt"],
+                             stdin=subprocess.DEVNULL, capture_output=True, cwd=tmp_path)
+        assert out.returncode == 0, out.stderr.decode()
+    for table in ("kapa", "qubit", "combined"):
+        assert set(store.read(tmp_path / "store", table)["run_id"]) == {"SPS1"}
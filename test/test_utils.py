@@ -0,0 +1,48 @@
+import os
+import pytest
+from miseq_tools.utils import load_samplesheet, parse_samplesheet, pooled_bp, pooled_reads, capture_errors
+
+SHEET = """Sample_ID,I7_Index_ID,index,I5_Index_ID,index2,Pool label,Reads (million),Amplicon size (bp)
+a,,,,,PoolB,1,200
+b,,,,,,3,400
+c,,,,,PoolA,2,300
+,,,,,,,
+phix,,,,,PhiX,1,
+"""
+
+@pytest.fixture
+def sheet(tmp_path):
+    fname = tmp_path / "sheet.csv"
+    fname.write_text(SHEET)
+    return fname
+
+def test_pooled(sheet):
+    samples = parse_samplesheet(sheet)
+    assert samples["Sample_ID"].tolist() == ["a", "b", "c"]
+    assert samples["Pool label"].tolist() == ["PoolB", "PoolB", "PoolA"]
+    for s in (samples, load_samplesheet(sheet)):
+        # pools stay in sheet order
+        assert pooled_reads(s).to_dict() == {"PoolB": 4, "PoolA": 2}
+        assert pooled_bp(s).to_dict() == pytest.approx({"PoolB": 350, "PoolA": 300})
+        assert pooled_bp(s).index.name == "Pool label"
+
+def test_memoized(sheet):
+    assert load_samplesheet(sheet) is load_samplesheet(str(sheet))
+    # callers get their own copy of the samples
+    parse_samplesheet(sheet).drop(columns="Sample_ID", inplace=True)
+    assert "Sample_ID" in parse_samplesheet(sheet).columns
+
+def test_reparsed_on_change(sheet):
+    before = load_samplesheet(sheet)
+    sheet.write_text(SHEET.replace("PoolA,2,300", "PoolA,5,300"))
+    os.utime(sheet, ns=(0, 0))
+    after = load_samplesheet(sheet)
+    assert after is not before
+    assert after.pool_reads["PoolA"] == 5
+
+@pytest.mark.parametrize("arg,expected", [
+    (2, (0.5, None)),
+    (0, (None, "division by zero")),
+])
+def test_capture_errors(arg, expected):
+    assert capture_errors(lambda x, y=1: y / x, arg) == expected
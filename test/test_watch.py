@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import pandas as pd
+import pytest
+from miseq_tools import watch
+from miseq_tools.watch import find_jobs, find_samplesheet
+from .test_demux import STATS, SAMPLES
+from .test_kapa import _write_plate
+
+EXPORT = "test -  Quantification Summary_0"
+
+def _write_run(folder, stats=STATS):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "Stats.json"), "wt") as f:
+        json.dump(stats, f)
+
+def _write_demux_sheet(fname):
+    SAMPLES.assign(**{"I7_Index_ID": "", "I5_Index_ID": "", "Amplicon size (bp)": 300})[
+        ["Sample_ID", "I7_Index_ID", "index", "I5_Index_ID", "index2", "Pool label", "Reads (million)", "Amplicon size (bp)"]].to_csv(fname, index=False)
+
+def _watch(tmp_path, *args, options=()):
+    return subprocess.run([sys.executable, "-m", "miseq_tools", "--no-plots", *options, "watch", str(tmp_path / "share"), "--once", "--settle", "0", "--state", str(tmp_path / "state.json"), *args], capture_output=True, cwd=tmp_path)
+
+def test_find_jobs(tmp_path):
+    _write_plate(tmp_path / "plate", {"PoolA": 1})
+    _write_run(tmp_path / "run" / "Stats")
+    os.makedirs(tmp_path / "run" / "Stats" / "miseq_tools")
+    (tmp_path / "run" / "Stats" / "miseq_tools" / "Stats.json").write_text("{}")
+    assert find_jobs(tmp_path, settle=0) == [
+        ("kapa", str(tmp_path / "plate" / "test -  Quantification Summary_0.csv")),
+        ("demux", str(tmp_path / "run" / "Stats" / "Stats.json")),
+    ]
+    # still being written
+    assert find_jobs(tmp_path, settle=60) == []
+    assert len(find_jobs(tmp_path, settle=60, now=time.time() + 120)) == 2
+
+def test_find_jobs_vanished(tmp_path, caplog):
+    # removed between listing the folder and checking its age
+    os.symlink(tmp_path / "gone.json", tmp_path / "Stats.json")
+    _write_run(tmp_path / "run")
+    assert find_jobs(tmp_path, settle=0) == [("demux", str(tmp_path / "run" / "Stats.json"))]
+    assert "Skipping" in caplog.text
+
+def test_find_samplesheet(tmp_path):
+    _write_run(tmp_path / "run" / "Data" / "Stats")
+    _write_demux_sheet(tmp_path / "run" / "sheet.csv")
+    # results from an earlier stage have a Pool label column but aren't sample sheets
+    pd.DataFrame({"Pool label": ["Pool1"], "nM": 1}).to_csv(tmp_path / "run" / "Data" / "quant_combined.csv", index=False)
+    assert find_samplesheet(str(tmp_path / "run" / "Data" / "Stats" / "Stats.json"), str(tmp_path)) == str(tmp_path / "run" / "sheet.csv")
+    assert find_samplesheet(str(tmp_path / "run" / "Data" / "Stats" / "Stats.json"), str(tmp_path / "run" / "Data")) is None
+
+def test_watch_once(tmp_path):
+    _write_plate(tmp_path / "share" / "plate", {"PoolA": 1, "PoolB": 2})
+    _write_run(tmp_path / "share" / "run")
+    _write_demux_sheet(tmp_path / "share" / "run" / "sheet.csv")
+    # a failed file doesn't stop the others
+    os.makedirs(tmp_path / "share" / "broken")
+    _write_demux_sheet(tmp_path / "share" / "broken" / "sheet.csv")
+    (tmp_path / "share" / "broken" / "Stats.json").write_text('{"ConversionResults": [')
+
+    out = _watch(tmp_path)
+    assert out.returncode == 0, out.stderr.decode()
+    assert out.stderr.decode().count("Running") == 3
+    assert "Unexpected end of JSON" in out.stderr.decode()
+    quant = pd.read_csv(tmp_path / "share" / "plate" / "miseq_tools" / EXPORT / "quant_kapa.csv", index_col=0)
+    assert quant["nM"].to_dict() == pytest.approx({"PoolA": 10, "PoolB": 20})
+    assert pd.read_csv(tmp_path / "share" / "run" / "miseq_tools" / "demux_samples.csv", index_col=0)["actual"].to_dict() == {"A": 1010, "B": 900, "C": 250}
+    # no scratch folders left behind
+    assert sorted(os.listdir(tmp_path / "share" / "run" / "miseq_tools")) == ["demux_samples.csv", "demux_stats.csv", "demux_unknown.csv"]
+
+    # each file once, failed or not, until it changes
+    out = _watch(tmp_path)
+    assert "Running" not in out.stderr.decode()
+    _write_run(tmp_path / "share" / "run", stats={**STATS, "RunNumber": 2})
+    out = _watch(tmp_path)
+    assert out.stderr.decode().count("Running") == 1
+
+def test_watch_two_exports(tmp_path):
+    # each export in a folder is analysed on its own
+    _write_plate(tmp_path / "share" / "plate", {"PoolA": 1})
+    _write_plate(tmp_path / "other", {"PoolA": 4})
+    os.replace(tmp_path / "other" / f"{EXPORT}.csv", tmp_path / "share" / "plate" / "rerun -  Quantification Summary_0.csv")
+    out = _watch(tmp_path)
+    assert out.returncode == 0, out.stderr.decode()
+    for export, nM in [(EXPORT, 10), ("rerun -  Quantification Summary_0", 40)]:
+        quant = pd.read_csv(tmp_path / "share" / "plate" / "miseq_tools" / export / "quant_kapa.csv", index_col=0)
+        assert quant["nM"].to_dict() == pytest.approx({"PoolA": nM})
+
+def test_watch_run_id(tmp_path):
+    pytest.importorskip("pyarrow")
+    from miseq_tools import store
+    _write_plate(tmp_path / "share" / "plate", {"PoolA": 1})
+    out = _watch(tmp_path, options=["--store", str(tmp_path / "store"), "--run-id", "SPS1"])
+    assert out.returncode == 0, out.stderr.decode()
+    assert store.read(tmp_path / "store", "kapa")["run_id"].tolist() == ["SPS1"]
+
+def test_watch_outdir(tmp_path):
+    _write_plate(tmp_path / "share" / "plates" / "plate1", {"PoolA": 1})
+    out = _watch(tmp_path, "-o", str(tmp_path / "results"))
+    assert out.returncode == 0, out.stderr.decode()
+    assert (tmp_path / "results" / "share" / "plates" / "plate1" / EXPORT / "quant_kapa.csv").exists()
+    assert not (tmp_path / "share" / "plates" / "plate1" / "miseq_tools").exists()
+
+def test_watch_polls(tmp_path):
+    os.makedirs(tmp_path / "share")
+    proc = subprocess.Popen([sys.executable, "-m", "miseq_tools", "--no-plots", "watch", str(tmp_path / "share"), "--interval", "0.1", "--settle", "0.2", "--state", str(tmp_path / "state.json")],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=tmp_path)
+    try:
+        time.sleep(0.5)
+        # dropped onto the share after the watch started
+        _write_plate(tmp_path / "share" / "plate", {"PoolA": 1})
+        fname = tmp_path / "share" / "plate" / "miseq_tools" / EXPORT / "quant_kapa.csv"
+        deadline = time.time() + 30
+        while not fname.exists() and time.time() < deadline:
+            time.sleep(0.1)
+        assert fname.exists()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def _crash(*args):
+    os._exit(1)
+
+def test_watch_vanished_and_crashed(tmp_path, monkeypatch, caplog):
+    caplog.set_level(logging.INFO)
+    _write_run(tmp_path / "share" / "run")
+    _write_demux_sheet(tmp_path / "share" / "run" / "sheet.csv")
+    # removed after the scan found it
+    jobs = find_jobs(tmp_path / "share", settle=0) + [("demux", str(tmp_path / "share" / "gone" / "Stats.json"))]
+    monkeypatch.setattr(watch, "find_jobs", lambda *args: jobs)
+    monkeypatch.setattr(watch, "_process", _crash)
+    watch.watch([str(tmp_path / "share")], settle=0, workers=1, fname_state=str(tmp_path / "state.json"), once=True)
+    assert "Skipping" in caplog.text
+    # retried in a new pool, then recorded as failed
+    assert caplog.text.count("Running demux") == watch.MAX_CRASHES
+    state = json.loads((tmp_path / "state.json").read_text())
+    assert [value["error"] for value in state.values()] == ["Worker process died"]